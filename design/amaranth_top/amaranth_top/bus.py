@@ -1,18 +1,27 @@
 from amaranth import *
 from amaranth.lib.wiring import Component, In, Out, Signature
+from amaranth.lib.fifo import SyncFIFOBuffered
 
-# rather thin wrapper around AXI
+from .constants import AUDIO_BUS_WIDTH
+from .misc import FFDelay
+
+# rather thin wrapper around AXI. each beat carries several 16 bit samples
 class AudioRAMBus(Signature):
-    def __init__(self):
+    def __init__(self, data_width=AUDIO_BUS_WIDTH):
+        if data_width not in (32, 64, 128):
+            raise ValueError(f"unsupported data_width {data_width}")
+
         super().__init__({
             # note: write must not cross 4K page boundary which we choose to
-            # mean must start or must end on a 32 byte boundary
-            "addr": Out(32), # must be even
-            "length": Out(4), # 1-16 writes at a time
+            # mean must start or must end on a burst sized boundary
+            "addr": Out(32), # must be aligned to the beat size
+            "length": Out(4), # 1-16 beats at a time
             "addr_valid": Out(1),
             "addr_ready": In(1),
 
-            "data": Out(16),
+            "data": Out(data_width),
+            # which samples in the beat are valid and should be written
+            "data_lanes": Out(data_width//16),
             "data_valid": Out(1),
             "data_last": Out(1),
             "data_ready": In(1),
@@ -20,37 +29,129 @@ class AudioRAMBus(Signature):
             "txn_done": In(1),
         })
 
+# share one bus between several writers. addresses are granted round robin,
+# then data and responses are routed back in the same order
+class AudioRAMBusArbiter(Component):
+    def __init__(self, num_buses, data_width=AUDIO_BUS_WIDTH, *,
+            max_bursts=16):
+        self._num_buses = num_buses
+        # bursts which may be in flight at once across all the writers
+        self._max_bursts = max_bursts
+
+        super().__init__({
+            "audio_ram_i": In(AudioRAMBus(data_width)).array(num_buses),
+            "audio_ram_o": Out(AudioRAMBus(data_width)),
+        })
+
+    def elaborate(self, platform):
+        m = Module()
+
+        buses = self.audio_ram_i
+        abus = self.audio_ram_o
+
+        # which bus's bursts' data are to be sent and responses received next
+        m.submodules.data_order = data_order = SyncFIFOBuffered(
+            width=len(Signal(range(self._num_buses))), depth=self._max_bursts)
+        m.submodules.resp_order = resp_order = SyncFIFOBuffered(
+            width=len(data_order.w_data), depth=self._max_bursts)
+
+        # address from the currently granted bus. the grant can't change while
+        # its address is valid but not yet accepted
+        grant = Signal(range(self._num_buses))
+        room = Signal()
+        m.d.comb += room.eq(data_order.w_rdy & resp_order.w_rdy)
+        with m.Switch(grant):
+            for bi, bus in enumerate(buses):
+                with m.Case(bi):
+                    m.d.comb += [
+                        abus.addr.eq(bus.addr),
+                        abus.length.eq(bus.length),
+                        abus.addr_valid.eq(bus.addr_valid & room),
+                        bus.addr_ready.eq(abus.addr_ready & room),
+                    ]
+
+                    # once the granted bus is done, move on to the next one
+                    # which wants to go
+                    with m.If(~abus.addr_valid | abus.addr_ready):
+                        for oi in reversed(range(1, self._num_buses)):
+                            ni = (bi + oi) % self._num_buses
+                            with m.If(buses[ni].addr_valid):
+                                m.d.sync += grant.eq(ni)
+
+        m.d.comb += [
+            data_order.w_data.eq(grant),
+            resp_order.w_data.eq(grant),
+        ]
+        with m.If(abus.addr_valid & abus.addr_ready):
+            m.d.comb += [
+                data_order.w_en.eq(1),
+                resp_order.w_en.eq(1),
+            ]
+
+        # route data from the bus whose address went out first
+        with m.Switch(data_order.r_data):
+            for bi, bus in enumerate(buses):
+                with m.Case(bi):
+                    m.d.comb += [
+                        abus.data.eq(bus.data),
+                        abus.data_lanes.eq(bus.data_lanes),
+                        abus.data_valid.eq(bus.data_valid & data_order.r_rdy),
+                        abus.data_last.eq(bus.data_last),
+                        bus.data_ready.eq(abus.data_ready & data_order.r_rdy),
+                    ]
+        with m.If(abus.data_valid & abus.data_ready & abus.data_last):
+            m.d.comb += data_order.r_en.eq(1)
+
+        # and responses back in the same order (as we always write with the
+        # same ID)
+        with m.Switch(resp_order.r_data):
+            for bi, bus in enumerate(buses):
+                with m.Case(bi):
+                    m.d.comb += bus.txn_done.eq(abus.txn_done)
+        with m.If(abus.txn_done):
+            m.d.comb += resp_order.r_en.eq(1)
+
+        return m
+
 # intended just to always acknowledge writes, not necessarily implement a
-# complete AXI receiver
+# complete AXI receiver. each burst is acknowledged `latency` cycles after its
+# last beat is received, and any number of bursts may be in flight at once
 class FakeAudioRAMBusWriteReceiver(Component):
-    audio_ram: In(AudioRAMBus())
+    def __init__(self, data_width=AUDIO_BUS_WIDTH, *, latency=0):
+        self._latency = latency
+
+        super().__init__({"audio_ram": In(AudioRAMBus(data_width))})
 
     def elaborate(self, platform):
         m = Module()
 
         beats_received = Signal(64) # number of beats we've received
-        beats_target = Signal(64) # number of beats to receive before ack
+        bursts_addressed = Signal(64) # number of bursts whose address we got
+        bursts_received = Signal(64) # number of bursts whose data we got
 
         abus = self.audio_ram
 
-        # data can always be received
-        m.d.comb += abus.data_ready.eq(1)
-        with m.If(abus.data_valid):
-            m.d.sync += beats_received.eq(beats_received + 1)
+        # addresses can always be received, and data can be received once its
+        # address has been
+        m.d.comb += [
+            abus.addr_ready.eq(1),
+            abus.data_ready.eq(bursts_addressed != bursts_received),
+        ]
+        with m.If(abus.addr_valid & abus.addr_ready):
+            m.d.sync += bursts_addressed.eq(bursts_addressed + 1)
 
-        with m.FSM("IDLE"):
-            with m.State("IDLE"):
-                m.d.sync += abus.addr_ready.eq(1)
-                with m.If(abus.addr_valid & abus.addr_ready):
-                    m.d.sync += [
-                        abus.addr_ready.eq(0), # not ready until beats over
-                        beats_target.eq(beats_target + 1 + abus.length),
-                    ]
-                    m.next = "RECV"
+        burst_done = Signal()
+        with m.If(abus.data_valid & abus.data_ready):
+            m.d.sync += beats_received.eq(beats_received + 1)
+            with m.If(abus.data_last):
+                m.d.comb += burst_done.eq(1)
+                m.d.sync += bursts_received.eq(bursts_received + 1)
 
-            with m.State("RECV"):
-                with m.If(beats_received >= beats_target):
-                    m.d.comb += abus.txn_done.eq(1)
-                    m.next = "IDLE"
+        # acknowledge the burst once the latency is up
+        if self._latency == 0:
+            m.d.comb += abus.txn_done.eq(burst_done)
+        else:
+            m.submodules.done_delay = FFDelay(
+                burst_done, abus.txn_done, cycles=self._latency)
 
         return m
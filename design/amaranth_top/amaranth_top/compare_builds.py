@@ -0,0 +1,99 @@
+# build the design with each way of summing the convolver lanes and compare the
+# resources used and the Fmax achieved, so the better one can be chosen (using
+# DSP_CHAIN) for the current configuration. needs Quartus on the PATH
+
+import re
+import argparse
+import subprocess
+from pathlib import Path
+
+from .constants import MIC_FREQ_HZ, LANES
+from .fpga_top import gen_build
+from .top import Top
+
+# name of each build and the arguments it's generated with
+VARIANTS = {
+    "tree": dict(dsp_chain=False),
+    "chain": dict(dsp_chain=True),
+}
+
+# resources from the fitter summary worth comparing
+FIT_KEYS = [
+    "Logic utilization (in ALMs)",
+    "Total registers",
+    "Total block memory bits",
+    "Total RAM Blocks",
+    "Total DSP Blocks",
+]
+
+def parse_fit_summary(path):
+    # lines are of the form "key : value"
+    resources = {}
+    for line in Path(path).read_text().splitlines():
+        key, sep, value = line.partition(" : ")
+        if sep:
+            resources[key.strip()] = value.strip()
+    return resources
+
+def parse_fmax(path):
+    # grab the first (slowest model) Fmax summary table in the timing report,
+    # whose rows are of the form "; 123.45 MHz ; 123.45 MHz ; clock ; note ;"
+    fmax = {}
+    in_table = False
+    for line in Path(path).read_text().splitlines():
+        if "Fmax Summary" in line:
+            if fmax: break # only want the first table
+            in_table = True
+        elif in_table:
+            match = re.match(
+                r";\s*[\d.]+ MHz\s*;\s*([\d.]+) MHz\s*;\s*(.+?)\s*;", line)
+            if match:
+                # the restricted Fmax is what the clock can actually reach
+                fmax[match.group(2)] = float(match.group(1))
+            elif fmax and not line.startswith(("+", ";")):
+                break # table is over
+    return fmax
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="compare_builds",
+        description="Build the FPGA design with each way of summing the "
+            "convolver lanes and compare resources and Fmax.")
+    parser.add_argument('build_dir', type=str,
+        help="Directory to put a build for each variant in.")
+    parser.add_argument('--report-only', action="store_true",
+        help="Don't build, just compare the reports of previous builds.")
+
+    return parser.parse_args()
+
+def compare_builds():
+    args = parse_args()
+
+    results = {}
+    for name, variant_args in VARIANTS.items():
+        build_dir = Path(args.build_dir)/name
+        if not args.report_only:
+            gen_build(build_dir, **variant_args)
+            subprocess.run(["sh", "build_top.sh"], cwd=build_dir, check=True)
+
+        results[name] = (parse_fit_summary(build_dir/"top.fit.summary"),
+            parse_fmax(build_dir/"top.sta.rpt"))
+
+    convolver_freq = MIC_FREQ_HZ * Top().convolver_rel_freq
+    print(f"{LANES} lane(s), convolver needs {convolver_freq/1e6:.2f} MHz")
+
+    names = list(results.keys())
+    rows = [["", *names]]
+    for key in FIT_KEYS:
+        rows.append([key, *(results[n][0].get(key, "?") for n in names)])
+    clocks = sorted(set().union(*(fmax.keys() for _, fmax in results.values())))
+    for clock in clocks:
+        rows.append([f"Fmax {clock}", *(f"{results[n][1][clock]:.2f} MHz"
+            if clock in results[n][1] else "?" for n in names)])
+
+    widths = [max(len(row[col]) for row in rows) for col in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join(
+            cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+if __name__ == "__main__":
+    compare_builds()
@@ -3,17 +3,75 @@
 MIC_FREQ_HZ = 48000
 CAP_DATA_BITS = 16 # lowest 8 mic data bits thrown away
 
+# width of the FPGA -> HPS port sample data is written through (32, 64, or 128
+# bits). each bus beat carries as many 16 bit samples as will fit
+AUDIO_BUS_WIDTH = 64
+
 # total number of microphones to take input from (must be even)
 # right mics are even (0, 2, 4, ...), left mics are odd (1, 3, 5, ...)
 # should be good up to like 120 microphones (as there are 128 data times)
 NUM_MICS = 16
 
 # number of output channels to generate (slowest axis for coefficients)
-# limited to like 110 since that's how many DSP blocks we have spare and each
-# channel needs one DSP block
+# limited to like 110*CHANS_PER_DSP/LANES since that's how many DSP blocks we
+# have spare and each CHANS_PER_DSP channels need LANES DSP blocks
 NUM_CHANS = 25
 
+# number of channels which take turns using each DSP block. the convolver clock
+# must then be this many times faster, so this trades Fmax for channel count
+CHANS_PER_DSP = 1
+
+# number of lanes which each process a share of the mics in parallel, using
+# this many DSP blocks per channel. the convolver clock can then be this many
+# times slower, so this trades DSP blocks for Fmax. must be a power of two which
+# divides NUM_MICS
+LANES = 1
+
+# sum the lanes through the DSP blocks' dedicated chain-out adders (so the
+# partial sums don't go through logic) instead of accumulating each lane in its
+# own DSP block and adding them up with logic. `python3 -m
+# amaranth_top.compare_builds` builds both ways to compare resources and Fmax
+DSP_CHAIN = False
+
 # number of filter taps used for each channel (middle axis for coefficients)
 NUM_TAPS = 101
 
+# only process the (tap, mic) pairs whose coefficient is nonzero for some
+# channel instead of all of them, which lowers the convolver clock needed for
+# sparse coefficients. coefficients loaded at runtime must then be zero outside
+# those pairs
+SPARSE_TAPS = False
+
+# sum the samples at mirrored taps and only multiply by the first half of the
+# coefficients, which halves the convolver clock needed. only possible if the
+# coefficients of every channel are symmetric along the tap axis (linear phase).
+# None to fold if the built-in coefficients are, coefficients loaded at runtime
+# must then be symmetric too
+FOLDED_TAPS = None
+
+# form each channel by summing the mics' samples, each delayed by some number of
+# sets and weighted by a power of two, instead of convolving. this needs no DSP
+# blocks, just adders and RAM, so many more channels can be formed. the delays
+# and weights come from a table given to the build (see load_delay_table in
+# delay_sum.py), and coefficients can't be loaded at runtime
+DELAY_SUM = False
+
+# number of units the delay-and-sum engine splits the channels between, which
+# each sum their channels in parallel using their own copy of the sample
+# history. the clock can then be this many times slower
+DELAY_SUM_UNITS = 1
+
+# convolve in the frequency domain (using FFT overlap-save) instead of the time
+# domain. this needs only a handful of DSP blocks and far fewer operations per
+# sample for long filters, so the coefficients given to the build can have
+# thousands of taps instead of NUM_TAPS (see Top), but the output is delayed by
+# two blocks of about that many samples. coefficients can't be loaded at runtime
+FFT_CONVOLVE = False
+
+# factors the convolved channels can be decimated by (chosen at runtime), after
+# lowpass filtering so they don't alias. this lowers the rate of the stored
+# data, and so the memory and network bandwidth needed. must include 1 (not
+# decimated), and just 1 doesn't build the decimator
+DECIMATION_FACTORS = (1,)
+
 # then microphones is the fastest axis
@@ -1,14 +1,79 @@
 from amaranth import *
 from amaranth.lib.wiring import Component, In, Out, connect, flipped
-from amaranth.utils import ceil_log2
+from amaranth.lib.cdc import FFSynchronizer
+from amaranth.lib.fifo import AsyncFIFO
+from amaranth.utils import ceil_log2, bits_for
+
+from amaranth_soc import csr
+from amaranth_soc.csr import Field
 
 import numpy as np
 
-from .constants import NUM_MICS, CAP_DATA_BITS, NUM_CHANS, NUM_TAPS
-from .stream import SampleStream, SampleStreamFIFO
+from .constants import (NUM_MICS, CAP_DATA_BITS, NUM_CHANS, NUM_TAPS,
+    CHANS_PER_DSP, LANES)
+from .stream import SampleStream, SampleStreamFIFO, SampleSetSerializer
 from .misc import SignalConveyor
 
 COEFF_BITS = 19 # multiplier supports 18x19 mode
+# coefficients are stored in fields one bit wider, so the RAM can use the M10K
+# blocks' 10 bit byte enables to write just one field of a word
+COEFF_FIELD_BITS = 20
+# channel processors sharing each lane's coefficient RAM, each with its own
+# field of the word. they all read the same address at the same time, so
+# packing them fills the M10K blocks' widest (40 bit) mode
+COEFF_PACK = 2
+# bits to address one bank of coefficients for a channel
+COEFF_ADDR_BITS = ceil_log2(NUM_TAPS * NUM_MICS)
+# bits to address the channels sharing a DSP block
+SLOT_BITS = ceil_log2(CHANS_PER_DSP)
+# bits to select the lane which handles a mic, and mics handled by each lane
+LANE_BITS = ceil_log2(LANES)
+LANE_MICS = NUM_MICS // LANES
+assert LANES == 1 << LANE_BITS and LANE_MICS * LANES == NUM_MICS
+# fewest taps the dense sequencer can use, as each set of new samples must be
+# written before it's read back as the newest
+MIN_TAPS = LANES + 2
+# max fanout of each shared pipeline register before Quartus replicates it
+PIPELINE_MAX_FANOUT = 16
+TRUNC_WIDTH = 6 # enough to describe truncating any of the 64 accumulator bits
+
+def quantize_coefficients(coefficients, max_coefficient):
+    # convert coefficients as float values to fixed point. returns the fixed
+    # point values (as unsigned COEFF_BITS wide integers) and the number of
+    # fractional bits, which are truncated from the result. coefficients are
+    # expected to be within -1 to +1. the host does exactly the same thing when
+    # it loads new coefficients.
+
+    # coefficients are all -1 to 1. we need 2 integer bits for the
+    # coefficients, 1 for sign and 1 to accommodate coefficients == 1
+    # (and slightly beyond). the rest we can make fraction bits.
+    coeff_frac_bits = COEFF_BITS-2
+
+    # the coefficients might all be rather small to make the sum 1. add more
+    # fractional bits for precision without exceeding the allotted bits.
+    if max_coefficient > 0:
+        max_val = (1 << (COEFF_BITS-1))-1 # leave one bit for sign
+        while int(max_coefficient * (1 << (coeff_frac_bits+1))) <= max_val:
+            coeff_frac_bits += 1 # another bit to multiply by another 2
+
+    # convert coefficients to signed fixed point with the calculated number
+    # of fractional bits
+    coefficients = (coefficients * (1 << coeff_frac_bits)).astype(np.int64)
+    # make sure they're all in range to fit (input wasn't outside -1 to 1)
+    assert np.all(np.abs(coefficients) < (1 << (COEFF_BITS-1)))
+    # mask to final bit width (which also makes the values unsigned)
+    coefficients &= (1 << COEFF_BITS)-1
+
+    return coefficients, coeff_frac_bits
+
+# split (tap, mic) pairs into the lanes which handle each one's mic, and pad the
+# lists with None so each lane has the same number to visit
+def split_lanes(pairs):
+    lanes = [[] for _ in range(LANES)]
+    for tap, mic in pairs:
+        lanes[mic % LANES].append((tap, mic))
+    num_pairs = max(len(lane) for lane in lanes)
+    return [lane + [None]*(num_pairs-len(lane)) for lane in lanes]
 
 # generate the signals for all the channel blocks and store the sample data
 class Sequencer(Component):
@@ -17,8 +82,40 @@ class Sequencer(Component):
 
     # control and data signals to processing blocks
     clear_accum: Out(1) # if 1 then clear, else accumulate
-    curr_sample: Out(signed(CAP_DATA_BITS))
-    coeff_index: Out(range((NUM_TAPS * NUM_MICS)-1))
+    # sample for each lane. one more bit as in folded mode it's the sum of two
+    # samples
+    curr_sample: Out(signed(CAP_DATA_BITS+1)).array(LANES)
+    # coefficient index within each lane
+    coeff_index: Out(range(NUM_TAPS * LANE_MICS)).array(LANES)
+    coeff_bank: Out(1) # bank of coefficients to use for the current set
+    # which of the channels sharing each DSP block the signals are for. each
+    # channel is presented the whole set in turn, so one accumulator is enough
+    coeff_slot: Out(range(CHANS_PER_DSP))
+
+    bank: In(1) # bank to use, latched at the start of each set
+    # taps to use with each bank, latched along with it. only the first taps of
+    # the bank's coefficients are used, with the newest samples at the last of
+    # them. clamped to MIN_TAPS, and ignored when visiting pairs
+    taps: In(range(NUM_TAPS+1), init=NUM_TAPS).array(2)
+    coeff_taps: Out(range(NUM_TAPS+1)) # taps used for the current set
+
+    def __init__(self, pairs=None, *, folded=False):
+        # if given, only visit these (tap, mic) pairs in order instead of all
+        # of them
+        self._pairs = pairs
+        # if folded, the coefficients are symmetric along the tap axis, so the
+        # pairs are only in the first half of the taps and the sample is
+        # presented summed with the sample at the mirrored tap
+        self._folded = folded
+        if folded and pairs is None:
+            raise ValueError("folding requires pairs")
+        if pairs is None:
+            # the new samples are written while the first taps are read, so
+            # make sure we're done before we read them as the last taps
+            assert (MIN_TAPS-1) * LANE_MICS > NUM_MICS
+            assert NUM_TAPS >= MIN_TAPS
+
+        super().__init__()
 
     def elaborate(self, platform):
         m = Module()
@@ -26,37 +123,113 @@ class Sequencer(Component):
         # control and data signals are sent to the output bus synchronously to
         # improve timing
         clear_accum = Signal.like(self.clear_accum)
-        curr_sample = Signal.like(self.curr_sample)
-        coeff_index = Signal.like(self.coeff_index)
+        curr_sample = [Signal.like(s) for s in self.curr_sample]
+        coeff_index = [Signal.like(i) for i in self.coeff_index]
+        coeff_bank = Signal.like(self.coeff_bank)
+        coeff_slot = Signal.like(self.coeff_slot)
         m.d.sync += [
             self.clear_accum.eq(clear_accum),
-            self.curr_sample.eq(curr_sample),
-            self.coeff_index.eq(coeff_index),
+            self.coeff_bank.eq(coeff_bank),
+            self.coeff_slot.eq(coeff_slot),
         ]
+        for lane in range(LANES):
+            m.d.sync += [
+                self.curr_sample[lane].eq(curr_sample[lane]),
+                self.coeff_index[lane].eq(coeff_index[lane]),
+            ]
 
-        # memory to store sample data
+        # current slot, and whether it's the last so the set is done
+        slot = Signal.like(coeff_slot)
+        last_slot = Signal()
+        m.d.comb += last_slot.eq(slot == CHANS_PER_DSP-1)
+
+        # memory to store sample data for each lane, which holds the mics whose
+        # number mod LANES is the lane number. it's a circular buffer where each
+        # new set of samples overwrites the oldest, so samples don't need to be
+        # shifted along and only the new samples are written
         # storage must be a power of two so that Quartus will infer BRAM
-        mem_size = 1 << ceil_log2(NUM_TAPS * NUM_MICS)
-        sample_memory = Memory(width=CAP_DATA_BITS, depth=mem_size)
-        m.submodules.samp_w = samp_w = sample_memory.write_port()
-        m.submodules.samp_r = samp_r = sample_memory.read_port(
-            transparent=False)
-
-        # read data is connected to the sample output and has a one cycle delay
-        m.d.comb += curr_sample.eq(samp_r.data)
-        # write data does not have a delay, but we might write what we read or
-        # we might write new data
-        write_new = Signal()
-        m.d.comb += [
-            samp_w.data.eq(Mux(write_new, self.samples_i.data, samp_r.data)),
-            self.samples_i.ready.eq(write_new),
-        ]
+        mem_size = 1 << ceil_log2(NUM_TAPS * LANE_MICS)
+        sample_memories = []
+        samp_w = []
+        samp_r = []
+        for lane in range(LANES):
+            sample_memory = Memory(width=CAP_DATA_BITS, depth=mem_size)
+            sample_memories.append(sample_memory)
+            samp_w.append(sample_memory.write_port())
+            samp_r.append(sample_memory.read_port(transparent=False))
+            m.submodules[f"samp_w_{lane}"] = samp_w[lane]
+            m.submodules[f"samp_r_{lane}"] = samp_r[lane]
+
+            # read data is connected to the sample output and has a one cycle
+            # delay
+            m.d.comb += curr_sample[lane].eq(samp_r[lane].data.as_signed())
+
+        if self._pairs is not None:
+            m.d.comb += self.coeff_taps.eq(NUM_TAPS) # pairs cover all taps
+            self._elaborate_sparse(m, sample_memories, samp_w, samp_r,
+                clear_accum, curr_sample, coeff_index, coeff_bank, coeff_slot,
+                slot, last_slot)
+            return m
+
+        TOTAL = NUM_TAPS * LANE_MICS # samples stored in each lane
+
+        # write new data straight from the input, which has no delay, to the
+        # lane for its mic
+        write_en = Signal()
+        write_lane = Signal(range(LANES))
+        write_addr = Signal(range(TOTAL))
+        m.d.comb += self.samples_i.ready.eq(write_en)
+        for lane in range(LANES):
+            m.d.comb += [
+                samp_w[lane].data.eq(self.samples_i.data),
+                samp_w[lane].addr.eq(write_addr),
+                samp_w[lane].en.eq(write_en & (write_lane == lane)),
+            ]
+
+        # address of the newest set of samples in the circular buffers, and the
+        # address of the next sample to read, which starts at the oldest set in
+        # use and wraps around to end at the newest
+        newest = Signal(range(TOTAL))
+        sample_addr = Signal(range(TOTAL))
+        next_newest = Signal(range(TOTAL)) # once the next set comes in
+        m.d.comb += next_newest.eq(
+            Mux(newest == TOTAL-LANE_MICS, 0, newest + LANE_MICS))
+
+        # work out how far back each bank's taps reach and where processing its
+        # set starts and ends ahead of time. the host only changes a bank's taps
+        # while the bank isn't in use, and the newest set only moves at the
+        # start of each set. they start out with the values for all the taps,
+        # reading from the oldest set just past the first newest set
+        bank_taps = []
+        bank_start = []
+        bank_last = []
+        for bank, taps in enumerate(self.taps):
+            clamped = Signal.like(self.coeff_taps, name=f"taps_{bank}",
+                init=NUM_TAPS)
+            span = Signal(range(TOTAL), name=f"span_{bank}",
+                init=(NUM_TAPS-1)*LANE_MICS)
+            start = Signal(range(TOTAL), name=f"start_{bank}",
+                init=(2*LANE_MICS) % TOTAL)
+            last = Signal(range(TOTAL), name=f"last_{bank}", init=TOTAL-1)
+            m.d.sync += [
+                clamped.eq(Mux(taps < MIN_TAPS, MIN_TAPS,
+                    Mux(taps > NUM_TAPS, NUM_TAPS, taps))),
+                span.eq((clamped-1) * LANE_MICS),
+                start.eq(Mux(next_newest >= span,
+                    next_newest - span, next_newest + TOTAL - span)),
+                last.eq(clamped*LANE_MICS - 1),
+            ]
+            bank_taps.append(clamped)
+            bank_start.append(start)
+            bank_last.append(last)
 
         # main sequencer state machine
-        sample_num = Signal.like(coeff_index)
+        sample_num = Signal(range(TOTAL))
+        last_num = Signal(range(TOTAL)) # last sample of the set
+        first_addr = Signal(range(TOTAL)) # where each slot starts reading
         m.d.sync += [ # by default...
             clear_accum.eq(1), # tell accumulators to clear themselves
-            samp_w.en.eq(0), # not writing
+            write_en.eq(0), # not writing
         ]
         with m.FSM("IDLE"):
             with m.State("IDLE"):
@@ -67,41 +240,251 @@ class Sequencer(Component):
                         # we have a full set of samples (so we won't ever hit an
                         # invalid stream word) and the first sample is
                         # correctly flagged as the first
-                        m.d.sync += sample_num.eq(0) # reset sample counter
+                        m.d.sync += [
+                            sample_num.eq(0), # reset sample counter
+                            slot.eq(0),
+                            # the oldest set of samples becomes the newest
+                            newest.eq(next_newest),
+                            # switch banks (and their taps) only between sets
+                            # so each set uses just one
+                            coeff_bank.eq(self.bank),
+                            self.coeff_taps.eq(
+                                Mux(self.bank, bank_taps[1], bank_taps[0])),
+                            sample_addr.eq(
+                                Mux(self.bank, bank_start[1], bank_start[0])),
+                            first_addr.eq(
+                                Mux(self.bank, bank_start[1], bank_start[0])),
+                            last_num.eq(
+                                Mux(self.bank, bank_last[1], bank_last[0])),
+                        ]
                         m.next = "PROCESS"
 
+            if CHANS_PER_DSP > 1:
+                with m.State("CLEAR"):
+                    # give the accumulator a cycle to clear for the next slot
+                    m.next = "PROCESS"
+
             with m.State("PROCESS"):
-                # are we on the first set of mics (and need to write new data)
+                # are we on the first mics (and need to write new data)
                 first_set = Signal()
                 m.d.comb += first_set.eq(sample_num < NUM_MICS)
 
                 # this cycle (combinatorially)
-                m.d.comb += [
-                    # read sample data
-                    samp_r.addr.eq(sample_num),
-                    samp_r.en.eq(1),
-                ]
+                for lane in range(LANES):
+                    m.d.comb += [
+                        # read sample data
+                        samp_r[lane].addr.eq(sample_addr),
+                        samp_r[lane].en.eq(1),
+                    ]
                 # next cycle (synchronously)
                 m.d.sync += [
-                    # write sample data (first set of mics are new)
-                    write_new.eq(first_set),
-                    samp_w.addr.eq(Mux(first_set, # to the previous time block
-                        sample_num + ((NUM_TAPS-1) * NUM_MICS),
-                        sample_num - NUM_MICS)),
-                    samp_w.en.eq(1),
+                    # write new sample data (counting through the mics) over
+                    # the set which just left the window, but only during the
+                    # first slot. it's read back as the newest set
+                    write_addr.eq(newest + (sample_num >> LANE_BITS)),
+                    write_lane.eq(sample_num[:LANE_BITS]),
+                    write_en.eq(first_set & (slot == 0)),
 
                     # the read data will be available next cycle so update the
                     # coefficient index and tell accumulators to stop clearing
-                    coeff_index.eq(sample_num),
+                    coeff_slot.eq(slot),
                     clear_accum.eq(0),
                 ]
+                for lane in range(LANES):
+                    m.d.sync += coeff_index[lane].eq(sample_num)
 
-                m.d.sync += sample_num.eq(sample_num + 1) # next sample
-                with m.If(sample_num == (NUM_TAPS * NUM_MICS) - 1):
+                m.d.sync += [
+                    sample_num.eq(sample_num + 1), # next sample
+                    sample_addr.eq(Mux(sample_addr == TOTAL-1,
+                        0, sample_addr + 1)),
+                ]
+                with m.If(sample_num == last_num):
                     m.next = "IDLE" # done with the sequence
+                    if CHANS_PER_DSP > 1:
+                        with m.If(~last_slot):
+                            # go through the set again for the next slot
+                            m.d.sync += [
+                                sample_num.eq(0),
+                                sample_addr.eq(first_addr),
+                                slot.eq(slot + 1),
+                            ]
+                            m.next = "CLEAR"
 
         return m
 
+    def _elaborate_sparse(self, m, sample_memories, samp_w, samp_r,
+            clear_accum, curr_sample, coeff_index, coeff_bank, coeff_slot,
+            slot, last_slot):
+        TOTAL = NUM_TAPS * LANE_MICS # samples stored in each lane
+
+        # address of the newest set of samples in the circular buffers
+        newest = Signal(range(TOTAL))
+
+        # the pair ROM data is available next cycle, then the sample data the
+        # cycle after that along with the rest of the control signals
+        pair_valid = Signal()
+        pair_slot = Signal.like(slot)
+        m.d.sync += [ # by default...
+            clear_accum.eq(1), # tell accumulators to clear themselves
+            pair_valid.eq(0), # not reading a pair
+        ]
+        with m.If(pair_valid):
+            m.d.sync += [
+                coeff_slot.eq(pair_slot),
+                clear_accum.eq(0),
+            ]
+
+        # each lane visits its pairs in step with the others
+        lane_pairs = split_lanes(self._pairs)
+        pair_num = Signal(range(len(lane_pairs[0])))
+        offset_shape = signed(ceil_log2(TOTAL)+1)
+        offset_mask = (1 << offset_shape.width)-1
+        index_bits = len(coeff_index[0])
+        for lane, pairs in enumerate(lane_pairs):
+            # ROM holding each pair's coefficient index along with the offset
+            # from the newest set of samples to that pair's sample, and whether
+            # it's a real pair and not padding. the last tap is the newest
+            # sample, like in dense mode. if folded, also the offset to the
+            # mirrored sample and whether there is one (the middle tap has none)
+            pair_rom_data = []
+            for pair in pairs:
+                if pair is None: # padding, so the sample is zeroed
+                    pair_rom_data.append(0)
+                    continue
+                tap, mic = pair
+                offset = mic//LANES - (NUM_TAPS-1-tap)*LANE_MICS
+                data = (tap*LANE_MICS + mic//LANES) | \
+                    ((offset & offset_mask) << index_bits) | \
+                    (1 << (index_bits + offset_shape.width))
+                if self._folded:
+                    mirror_offset = mic//LANES - tap*LANE_MICS
+                    data |= (mirror_offset & offset_mask) << \
+                        (index_bits + offset_shape.width + 1)
+                    data |= int(tap != NUM_TAPS-1-tap) << \
+                        (index_bits + 2*offset_shape.width + 1)
+                pair_rom_data.append(data)
+            pair_width = index_bits + offset_shape.width + 1
+            if self._folded:
+                pair_width += offset_shape.width + 1
+            pair_memory = Memory(width=pair_width,
+                depth=len(pair_rom_data), init=pair_rom_data)
+            m.submodules[f"pair_r_{lane}"] = pair_r = pair_memory.read_port(
+                transparent=False)
+            pair_index = Signal.like(coeff_index[lane])
+            pair_offset = Signal(offset_shape)
+            pair_real = Signal()
+            pair_mirror_offset = Signal(offset_shape)
+            pair_mirrored = Signal()
+            m.d.comb += [
+                pair_r.addr.eq(pair_num),
+                pair_r.en.eq(1), # always reading
+                Cat(pair_index, pair_offset, pair_real,
+                    pair_mirror_offset, pair_mirrored).eq(pair_r.data),
+            ]
+            with m.If(pair_valid):
+                m.d.sync += coeff_index[lane].eq(pair_index)
+
+            # address of the current pair's sample, wrapped into the buffer
+            pair_addr = Signal(signed(offset_shape.width+1))
+            m.d.comb += [
+                pair_addr.eq(newest + pair_offset),
+                samp_r[lane].addr.eq(Mux(pair_addr < 0,
+                    pair_addr + TOTAL, pair_addr)),
+                samp_r[lane].en.eq(pair_valid),
+            ]
+
+            # whether the sample read is from a real pair, registered along
+            # with the read
+            real = Signal()
+            with m.If(pair_valid):
+                m.d.sync += real.eq(pair_real)
+
+            sample = samp_r[lane].data.as_signed()
+            if self._folded:
+                # read the mirrored sample at the same time and add it in. the
+                # pre-added sum is exact, so this is the same as multiplying
+                # each sample by its (equal) coefficient separately
+                samp_mirror_r = sample_memories[lane].read_port(
+                    transparent=False)
+                m.submodules[f"samp_mirror_r_{lane}"] = samp_mirror_r
+                mirror_addr = Signal.like(pair_addr)
+                mirrored = Signal() # registered along with the read
+                m.d.comb += [
+                    mirror_addr.eq(newest + pair_mirror_offset),
+                    samp_mirror_r.addr.eq(Mux(mirror_addr < 0,
+                        mirror_addr + TOTAL, mirror_addr)),
+                    samp_mirror_r.en.eq(pair_valid),
+                ]
+                with m.If(pair_valid):
+                    m.d.sync += mirrored.eq(pair_mirrored)
+                sample = sample + \
+                    Mux(mirrored, samp_mirror_r.data.as_signed(), 0)
+            m.d.comb += curr_sample[lane].eq(Mux(real, sample, 0))
+
+            # write new data straight from the input
+            m.d.comb += samp_w[lane].data.eq(self.samples_i.data)
+
+        # main sequencer state machine
+        mic_num = Signal(range(NUM_MICS))
+        with m.FSM("IDLE"):
+            with m.State("IDLE"):
+                with m.If(self.samples_i.valid): # at least one sample
+                    with m.If(~self.samples_i.first): # not the first sample?
+                        m.d.comb += self.samples_i.ready.eq(1) # discard it
+                    with m.Elif(self.samples_i_count >= NUM_MICS):
+                        # we have a full set of samples (so we won't ever hit an
+                        # invalid stream word) and the first sample is
+                        # correctly flagged as the first
+                        m.d.sync += [
+                            mic_num.eq(0),
+                            slot.eq(0),
+                            # the oldest set of samples becomes the newest
+                            newest.eq(Mux(newest == TOTAL-LANE_MICS,
+                                0, newest + LANE_MICS)),
+                            # switch banks only between sets so each set
+                            # uses just one
+                            coeff_bank.eq(self.bank),
+                        ]
+                        m.next = "LOAD"
+
+            with m.State("LOAD"):
+                # write the new samples over the oldest ones in their lanes
+                for lane in range(LANES):
+                    m.d.comb += [
+                        samp_w[lane].addr.eq(newest + (mic_num >> LANE_BITS)),
+                        samp_w[lane].en.eq(mic_num[:LANE_BITS] == lane),
+                    ]
+                m.d.comb += self.samples_i.ready.eq(1)
+                m.d.sync += mic_num.eq(mic_num + 1)
+                with m.If(mic_num == NUM_MICS-1):
+                    m.d.sync += [
+                        pair_num.eq(0),
+                        slot.eq(0),
+                    ]
+                    m.next = "PROCESS"
+
+            with m.State("PROCESS"):
+                m.d.sync += [
+                    pair_valid.eq(1),
+                    pair_slot.eq(slot),
+                    pair_num.eq(pair_num + 1), # next pair
+                ]
+                with m.If(pair_num == len(lane_pairs[0])-1):
+                    m.next = "IDLE" # done with the sequence
+                    if CHANS_PER_DSP > 1:
+                        with m.If(~last_slot):
+                            # go through the pairs again for the next slot
+                            m.d.sync += [
+                                pair_num.eq(0),
+                                slot.eq(slot + 1),
+                            ]
+                            m.next = "CLEAR"
+
+            if CHANS_PER_DSP > 1:
+                with m.State("CLEAR"):
+                    # give the accumulator a cycle to clear for the next slot
+                    m.next = "PROCESS"
+
 # Cyclone V DSP block which does what we want and hopefully gets inferred
 # properly
 class DSPMACBlock(Component):
@@ -124,103 +507,344 @@ class DSPMACBlock(Component):
 
         return m
 
-class ChannelProcessor(Component):
-    clear_accum: In(1) # if 1 then clear, else accumulate
-    curr_sample: In(signed(CAP_DATA_BITS))
-    coeff_index: In(range((NUM_TAPS * NUM_MICS)-1))
+# chain of Cyclone V DSP blocks, one for each lane, which sums the lanes'
+# products through the dedicated chain-out adders between adjacent blocks
+# instead of logic, then accumulates at the end of the chain. each block's
+# inputs must be one cycle later than the previous block's (i.e. systolic) so
+# the products of the same sample meet, and the clear goes with the last block's
+class DSPChain(Component):
+    # using 18x19 mode
+    mul_a: In(signed(18)).array(LANES)
+    mul_b: In(signed(19)).array(LANES)
+    # accumulator of the last block, like the DSPMACBlock's
+    result: Out(signed(64))
 
-    sample_out: Out(signed(CAP_DATA_BITS))
-    sample_new: Out(1) # pulsed when new sample data is available
+    clear: In(1) # synchronously clear the accumulator (else accumulate)
 
-    def __init__(self, coefficients, max_coefficient):
-        # coefficients as float values, we convert them to fixed point ourselves
-        expected_shape = (NUM_TAPS, NUM_MICS)
-        if coefficients.shape != expected_shape:
-            raise ValueError(
-                f"shape {coefficients.shape} != expected {expected_shape}")
+    def elaborate(self, platform):
+        m = Module()
 
-        assert CAP_DATA_BITS <= 18 # DSP A input
-        assert COEFF_BITS <= 19 # DSP B input
+        # each block but the last adds its product to the previous block's sum
+        chain = 0
+        for lane in range(LANES-1):
+            chain_out = Signal(signed(64), name=f"chain_out_{lane}")
+            m.d.sync += chain_out.eq(chain +
+                (self.mul_a[lane] * self.mul_b[lane]))
+            chain = chain_out
 
-        # coefficients are all -1 to 1. we need 2 integer bits for the
-        # coefficients, 1 for sign and 1 to accommodate coefficients == 1
-        # (and slightly beyond). the rest we can make fraction bits.
-        coeff_frac_bits = COEFF_BITS-2
-
-        # the coefficients might all be rather small to make the sum 1. add more
-        # fractional bits for precision without exceeding the allotted bits.
-        if max_coefficient > 0:
-            max_val = (1 << (COEFF_BITS-1))-1 # leave one bit for sign
-            while int(max_coefficient * (1 << (coeff_frac_bits+1))) <= max_val:
-                coeff_frac_bits += 1 # another bit to multiply by another 2
-
-        # we want integral output, so throw away fractional bits from the
-        # result. coefficients are the only part with fractions, input is
-        # integral, and processing doesn't add bits since the coefficient sum
-        # is (allegedly) at most 1, so that's all we need to truncate.
-        self._trunc_bits = coeff_frac_bits
-
-        # multiplication produces at most CAP_DATA_BITS+COEFF_BITS of result. we
-        # sum NUM_TAPS*NUM_MICS results, so we need enough bits for that in the
-        # accumulator, although the final sum width is just CAP_DATA_BITS.
-        accum_bits = CAP_DATA_BITS + COEFF_BITS + ceil_log2(NUM_TAPS * NUM_MICS)
-        assert accum_bits <= 64 # accumulator size
+        with m.If(self.clear):
+            m.d.sync += self.result.eq(0)
+        with m.Else():
+            m.d.sync += self.result.eq(self.result + chain +
+                (self.mul_a[-1] * self.mul_b[-1]))
 
-        # convert coefficients to signed fixed point with the calculated number
-        # of fractional bits
-        coefficients = (coefficients * (1 << coeff_frac_bits)).astype(np.int64)
-        # make sure they're all in range to fit (input wasn't outside -1 to 1)
-        assert np.all(np.abs(coefficients) < (1 << (COEFF_BITS-1)))
-        # mask to final bit width (which also makes the values unsigned)
-        coefficients &= (1 << COEFF_BITS)-1
+        return m
 
-        # save as a list for the ROM in Amaranth
-        self._coeff_rom_data = [int(v) for v in coefficients.reshape(-1)]
+# processes CHANS_PER_DSP channels, which take turns using the DSP block(s).
+# the coefficients and control signals come pre-delayed from the Convolver's
+# shared RAMs and pipeline
+class ChannelProcessor(Component):
+    # coefficient for each lane, straight from the RAM, and one cycle later, the
+    # sample to multiply it with
+    coeff: In(COEFF_BITS).array(LANES)
+    mul_a: In(signed(CAP_DATA_BITS+1)).array(LANES)
+    # if 1 then clear, else accumulate. same time as the last lane's mul_a
+    clear: In(1)
+    # slot of the channel being accumulated, along with the clear. the slots
+    # take turns, each accumulating over the whole set then clearing
+    slot: In(range(CHANS_PER_DSP))
+
+    # bits to truncate from the result, for the bank the output samples were
+    # computed with
+    trunc_bits: In(TRUNC_WIDTH)
+
+    # output sample for each channel, from the cycle after the clear which
+    # ends its turn until the end of its next one
+    sample_out: Out(signed(CAP_DATA_BITS)).array(CHANS_PER_DSP)
+
+    def __init__(self, *, dsp_chain=False):
+        # if chained, sum the lanes using a DSPChain instead of a DSPMACBlock
+        # for each lane and an adder tree in logic
+        self._dsp_chain = dsp_chain
 
         super().__init__()
 
     def elaborate(self, platform):
         m = Module()
 
-        # ROM to hold coefficients
-        mem_size = 1 << ceil_log2(NUM_TAPS * NUM_MICS)
-        coeff_memory = Memory(
-            width=COEFF_BITS, depth=mem_size, init=self._coeff_rom_data)
-        m.submodules.coeff_r = coeff_r = coeff_memory.read_port(
-            transparent=False)
-        m.d.comb += coeff_r.en.eq(1) # always reading
-
-        # put control and data signals onto the conveyor
-        clear_accum = self.clear_accum
-        curr_sample = self.curr_sample
-        coeff_index = self.coeff_index
-        sc = SignalConveyor(clear_accum, curr_sample, coeff_index)
-
-        # set up RAM with one cycle of latency from conveyor start for timing
-        sc.get(+1, coeff_index, dst=coeff_r.addr, rel=coeff_index)
-        sc.put(+1, coeff_r.data, rel=coeff_r.addr) # one cycle of read latency
-
-        # set up DSP block to do our multiply-accumulate
-        m.submodules.mac = mac = DSPMACBlock()
-        # interface with conveyor with one cycle of latency from RAM data
-        # retrieval for timing. we put the memory coefficient in the B port
-        # since that's one bit wider and we want that extra bit
-        sc.get(+1, coeff_r.data, dst=mac.mul_b, rel=coeff_r.data)
-        sc.get(+0, curr_sample, dst=mac.mul_a, rel=mac.mul_b) # same time as
-        sc.get(+0, clear_accum, dst=mac.clear, rel=mac.mul_b) # coeff input
-        sc.put(+1, mac.result, rel=mac.mul_b) # one cycle of computation latency
-
-        # hook up (truncated) output with one cycle of latency from result
-        sample_out = Signal.like(mac.result)
-        sc.get(+1, mac.result, dst=sample_out, rel=mac.result)
-        m.d.comb += self.sample_out.eq(sample_out[self._trunc_bits:])
-        # and new flag (which is true when the MAC clear is asserted the cycle
-        # after the sample is retrieved)
-        m.d.comb += self.sample_new.eq(
-            ~sc.get(+0, clear_accum, rel=sample_out)
-            & sc.get(-1, clear_accum, rel=sample_out))
+        if self._dsp_chain:
+            m.submodules.chain = dsp_chain = DSPChain()
+
+        macs = []
+        for lane in range(LANES):
+            if self._dsp_chain:
+                mul_a = dsp_chain.mul_a[lane]
+                mul_b = dsp_chain.mul_b[lane]
+            else:
+                # set up DSP block to do our multiply-accumulate
+                m.submodules[f"mac_{lane}"] = mac = DSPMACBlock()
+                macs.append(mac)
+                mul_a, mul_b = mac.mul_a, mac.mul_b
+                m.d.comb += mac.clear.eq(self.clear)
+            # register the coefficient from RAM for timing, the sample arrives
+            # already delayed to match. we put the memory coefficient in the B
+            # port since that's one bit wider and we want that extra bit
+            m.d.sync += mul_b.eq(self.coeff[lane])
+            m.d.comb += mul_a.eq(self.mul_a[lane])
+
+        if self._dsp_chain:
+            # the last block clears, and the chain already summed up the lanes
+            m.d.comb += dsp_chain.clear.eq(self.clear)
+            lane_sum = dsp_chain.result
+        else:
+            # sum up the lanes' results, adding pairs of results at a time to
+            # form a tree
+            results = [mac.result for mac in macs]
+            while len(results) > 1:
+                results = [a + b for a, b in
+                        zip(results[::2], results[1::2])] + \
+                    results[len(results) & ~1:]
+            lane_sum = Signal(signed(64))
+            m.d.comb += lane_sum.eq(results[0])
+
+        # hook up (truncated) output with one cycle of latency from the sum
+        max_val = (1<<(CAP_DATA_BITS-1))-1
+        min_val = -(max_val)-1
+        sum_out = Signal.like(lane_sum)
+        m.d.sync += sum_out.eq(lane_sum)
+        # clamp instead of wrapping if the truncated result doesn't fit. it
+        # fits if the bits above the output's are all copies of its sign
+        trunc_out = Signal.like(sum_out)
+        m.d.comb += trunc_out.eq(sum_out >> self.trunc_bits)
+        out = Signal(signed(CAP_DATA_BITS))
+        top_bits = trunc_out[CAP_DATA_BITS-1:]
+        with m.If(top_bits.all() | ~top_bits.any()):
+            m.d.comb += out.eq(trunc_out)
+        with m.Else():
+            m.d.comb += out.eq(Mux(sum_out[-1], min_val, max_val))
+
+        if CHANS_PER_DSP == 1:
+            m.d.comb += self.sample_out[0].eq(out)
+            return m
+
+        # the accumulator holds a slot's result when the clear which ends its
+        # turn starts, so hold onto the output for that slot from then on. only
+        # the truncated output is held, so the accumulator stays in the DSP
+        # block and there's just CAP_DATA_BITS of logic for each slot
+        prev_clear = Signal()
+        done = Signal()
+        done_slot = Signal.like(self.slot)
+        m.d.sync += [
+            prev_clear.eq(self.clear),
+            done.eq(self.clear & ~prev_clear),
+            done_slot.eq(self.slot),
+        ]
+        for slot, sample_out in enumerate(self.sample_out):
+            held = Signal.like(sample_out, name=f"held_{slot}")
+            with m.If(done & (done_slot == slot)):
+                m.d.sync += held.eq(out)
+                m.d.comb += sample_out.eq(out)
+            with m.Else():
+                m.d.comb += sample_out.eq(held)
 
-        m.submodules.sc = sc
+        return m
+
+class ConvolverRegs(Component):
+    csr_bus: In(csr.Signature(addr_width=4, data_width=32))
+
+    # settings, synced to convolver domain (given by o_domain)
+    coeff_bank: Out(1)
+    trunc_bits: Out(TRUNC_WIDTH).array(2)
+
+    # coefficient writes, in the convolver domain
+    coeff_w_en: Out(1)
+    coeff_w_chan: Out(range(NUM_CHANS))
+    coeff_w_addr: Out(COEFF_ADDR_BITS+1) # (index, bank)
+    coeff_w_data: Out(COEFF_BITS)
+
+    # taps to use with each bank, synced to the convolver domain
+    taps: Out(range(NUM_TAPS+1), init=NUM_TAPS).array(2)
+
+    # bank the convolver is currently using and the taps used with it, in the
+    # convolver domain
+    coeff_bank_active: In(1)
+    taps_active: In(range(NUM_TAPS+1), init=NUM_TAPS)
+
+    class CoeffParams(csr.Register, access="r"):
+        coeff_bits: Field(csr.action.R, 8)
+        # only the first half of the taps are loaded, the rest are mirrored
+        folded: Field(csr.action.R, 1)
+        # the design has no coefficients to load (delay-and-sum or FFT engine)
+        fixed: Field(csr.action.R, 1)
+        # fewest taps the coefficients can have, NUM_TAPS if they can't be cut
+        min_taps: Field(csr.action.R, 16)
+        # only the (tap, mic) pairs in the pair mask are used, coefficients
+        # must be zero everywhere else
+        sparse: Field(csr.action.R, 1)
+
+    class BankCtrl(csr.Register, access="rw"):
+        # bank of coefficients to use. takes effect at the start of the next
+        # set of samples
+        bank: Field(csr.action.RW, 1)
+        active: Field(csr.action.R, 1) # bank currently in use
+        taps: Field(csr.action.R, 16) # taps used with it
+        # a coefficient write was lost since the address was last written
+        lost: Field(csr.action.R, 1)
+        # a coefficient written now would be lost
+        full: Field(csr.action.R, 1)
+
+    class CoeffAddr(csr.Register, access="w"):
+        # where the next coefficient is written. index is tap*NUM_MICS+mic
+        index: Field(csr.action.W, 16)
+        chan: Field(csr.action.W, 15)
+        bank: Field(csr.action.W, 1)
+
+    class CoeffData(csr.Register, access="w"):
+        # write a coefficient then move on to the next index
+        data: Field(csr.action.W, COEFF_BITS)
+
+    class PairSelect(csr.Register, access="w"):
+        # word of the pair mask to read
+        index: Field(csr.action.W, 16)
+
+    class PairMask(csr.Register, access="r"):
+        # bit N set if the pair at coefficient index 32*word+N is used. only
+        # the loaded taps are included, i.e. the first half if folded
+        mask: Field(csr.action.R, 32)
+
+    def __init__(self, *, o_domain, trunc_bits, folded=False, fixed=False,
+            min_taps=NUM_TAPS, pair_mask=None):
+        self._o_domain = o_domain
+        # fractional bits of the coefficients the convolver was built with
+        self._trunc_bits = trunc_bits
+        # whether the convolver was built to fold the coefficients
+        self._folded = folded
+        # whether the coefficients are fixed because there isn't a convolver
+        self._fixed = fixed
+        # fewest taps the convolver can be told to use
+        self._min_taps = min_taps
+        # if the convolver is sparse, which (tap, mic) pairs it uses, shaped
+        # (tap, mic)
+        self._pair_mask = pair_mask
+
+        self._coeff_params = self.CoeffParams()
+        self._bank_ctrl = self.BankCtrl()
+        # fractional bits of the coefficients in each bank, which are truncated
+        # from the result. only change this for the bank not in use!
+        self._trunc = [csr.Register({"trunc_bits": Field(
+                csr.action.RW, TRUNC_WIDTH, init=trunc_bits)}, access="rw")
+            for _ in range(2)]
+        # taps the coefficients in each bank have. only change this for the
+        # bank not in use too!
+        self._taps = [csr.Register({"taps": Field(
+                csr.action.RW, bits_for(NUM_TAPS), init=NUM_TAPS)}, access="rw")
+            for _ in range(2)]
+        self._coeff_addr = self.CoeffAddr()
+        self._coeff_data = self.CoeffData()
+        self._pair_select = self.PairSelect()
+        self._pair_mask_reg = self.PairMask()
+
+        csr_sig = self.__annotations__["csr_bus"].signature
+        builder = csr.Builder(
+            addr_width=csr_sig.addr_width, data_width=csr_sig.data_width)
+        builder.add("coeff_params", self._coeff_params)
+        builder.add("bank_ctrl", self._bank_ctrl)
+        builder.add("trunc_0", self._trunc[0])
+        builder.add("trunc_1", self._trunc[1])
+        builder.add("coeff_addr", self._coeff_addr)
+        builder.add("coeff_data", self._coeff_data)
+        builder.add("taps_0", self._taps[0])
+        builder.add("taps_1", self._taps[1])
+        builder.add("pair_select", self._pair_select)
+        builder.add("pair_mask", self._pair_mask_reg)
+
+        self._csr_bridge = csr.Bridge(builder.as_memory_map())
+
+        super().__init__() # initialize component and attributes from signature
+
+        self.csr_bus.memory_map = self._csr_bridge.bus.memory_map
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # bridge containing CSRs
+        m.submodules.csr_bridge = csr_bridge = self._csr_bridge
+        connect(m, flipped(self.csr_bus), csr_bridge.bus)
+
+        m.d.comb += [
+            self._coeff_params.f.coeff_bits.r_data.eq(COEFF_BITS),
+            self._coeff_params.f.folded.r_data.eq(self._folded),
+            self._coeff_params.f.fixed.r_data.eq(self._fixed),
+            self._coeff_params.f.min_taps.r_data.eq(self._min_taps),
+            self._coeff_params.f.sparse.r_data.eq(self._pair_mask is not None),
+        ]
+
+        # words of the pair mask, all set if every pair is used
+        if self._pair_mask is not None:
+            bits = np.asarray(self._pair_mask, dtype=bool).reshape(-1)
+            words = [sum(1 << n for n, bit in enumerate(bits[wi:wi+32]) if bit)
+                for wi in range(0, len(bits), 32)]
+        else:
+            words = [0xFFFF_FFFF]
+        pair_index = Signal(range(len(words)))
+        with m.If(self._pair_select.f.index.w_stb):
+            m.d.sync += pair_index.eq(self._pair_select.f.index.w_data)
+        m.d.comb += self._pair_mask_reg.f.mask.r_data.eq(
+            Array(Const(word, 32) for word in words)[pair_index])
+
+        m.submodules += FFSynchronizer(self._bank_ctrl.f.bank.data,
+            self.coeff_bank, o_domain=self._o_domain)
+        m.submodules += FFSynchronizer(self.coeff_bank_active,
+            self._bank_ctrl.f.active.r_data)
+        # the host only changes these while the bank isn't in use, so tearing
+        # doesn't matter
+        for reg, trunc_bits in zip(self._trunc, self.trunc_bits):
+            m.submodules += FFSynchronizer(reg.f.trunc_bits.data, trunc_bits,
+                o_domain=self._o_domain, init=self._trunc_bits)
+        for reg, taps in zip(self._taps, self.taps):
+            m.submodules += FFSynchronizer(reg.f.taps.data, taps,
+                o_domain=self._o_domain, init=NUM_TAPS)
+        # only changes at the start of a set, so tearing doesn't matter either
+        m.submodules += FFSynchronizer(self.taps_active,
+            self._bank_ctrl.f.taps.r_data, init=NUM_TAPS)
+
+        # address of the next coefficient to write
+        w_index = Signal(COEFF_ADDR_BITS)
+        w_chan = Signal.like(self.coeff_w_chan)
+        w_bank = Signal()
+        lost = Signal()
+        with m.If(self._coeff_addr.f.index.w_stb):
+            m.d.sync += [
+                w_index.eq(self._coeff_addr.f.index.w_data),
+                w_chan.eq(self._coeff_addr.f.chan.w_data),
+                w_bank.eq(self._coeff_addr.f.bank.w_data),
+                lost.eq(0),
+            ]
+
+        # send writes over to the convolver domain. it can write every cycle,
+        # but may run slower than we do (e.g. if sparse), so the FIFO can fill
+        # up. writes made then are lost and noted so the host can retry
+        m.submodules.coeff_fifo = coeff_fifo = AsyncFIFO(
+            width=len(w_chan)+COEFF_ADDR_BITS+1+COEFF_BITS, depth=4,
+            w_domain="sync", r_domain=self._o_domain)
+        m.d.comb += coeff_fifo.w_data.eq(Cat(w_chan, w_index, w_bank,
+            self._coeff_data.f.data.w_data))
+        with m.If(self._coeff_data.f.data.w_stb):
+            m.d.comb += coeff_fifo.w_en.eq(1)
+            m.d.sync += w_index.eq(w_index + 1)
+            with m.If(~coeff_fifo.w_rdy):
+                m.d.sync += lost.eq(1)
+        m.d.comb += [
+            self._bank_ctrl.f.lost.r_data.eq(lost),
+            self._bank_ctrl.f.full.r_data.eq(~coeff_fifo.w_rdy),
+        ]
+
+        m.d.comb += [
+            Cat(self.coeff_w_chan, self.coeff_w_addr, self.coeff_w_data).eq(
+                coeff_fifo.r_data),
+            self.coeff_w_en.eq(coeff_fifo.r_rdy),
+            coeff_fifo.r_en.eq(1),
+        ]
 
         return m
 
@@ -230,14 +854,25 @@ class Convolver(Component):
 
     samples_o: Out(SampleStream())
 
-    # frequency relative to the microphone sample frequency (i.e. multiply that
-    # by this to get the expected operation frequency)
-    # for each sample frequency we need to process all taps and all mics then
-    # clear the accumulators, so we do that, plus 1% more to be sure we're
-    # always ahead of capture
-    REL_FREQ = int(((NUM_MICS * NUM_TAPS)+1)*1.01)
-
-    def __init__(self, coefficients):
+    # bank of coefficients to use, switched at the start of each set, and the
+    # bank currently in use
+    coeff_bank: In(1)
+    coeff_bank_active: Out(1)
+    # bits to truncate from the result when using each bank. initially both
+    # should be `coeff_frac_bits` to match the given coefficients
+    trunc_bits: In(TRUNC_WIDTH).array(2)
+    # taps used with each bank (see Sequencer), and those currently in use
+    taps: In(range(NUM_TAPS+1), init=NUM_TAPS).array(2)
+    taps_active: Out(range(NUM_TAPS+1))
+
+    # write port to load coefficients into either bank of a channel
+    coeff_w_en: In(1)
+    coeff_w_chan: In(range(NUM_CHANS))
+    coeff_w_addr: In(COEFF_ADDR_BITS+1) # (index, bank)
+    coeff_w_data: In(COEFF_BITS)
+
+    def __init__(self, coefficients, *, sparse=False, folded=None,
+            dsp_chain=False):
         # coefficients as float values, we convert them to fixed point
         # ourselves. coefficients are expected to be within -1 to +1 and the
         # absolute value of the sum of the coefficients for a particular output
@@ -251,6 +886,99 @@ class Convolver(Component):
         np.copyto(self._coefficients, coefficients)
         # max over all to ensure all channel processors use the same scaling
         self._max_coefficient = np.absolute(self._coefficients).max()
+        _, self.coeff_frac_bits = quantize_coefficients(
+            self._coefficients, self._max_coefficient)
+
+        # if folded, the coefficients of every channel are symmetric along the
+        # tap axis (linear phase), so we sum the samples at mirrored taps and
+        # only multiply by the first half of the coefficients. if None, fold if
+        # the given coefficients happen to be symmetric. coefficients loaded
+        # later must then be symmetric too
+        symmetric = np.array_equal(
+            self._coefficients, self._coefficients[:, ::-1, :])
+        if folded is None:
+            folded = symmetric
+        elif folded and not symmetric:
+            raise ValueError("folded coefficients must be symmetric")
+        self.folded = folded
+        taps = (NUM_TAPS+1)//2 if folded else NUM_TAPS
+
+        # if chained, the lanes are summed through the DSP blocks' chain-out
+        # adders instead of logic
+        self._dsp_chain = dsp_chain
+
+        # if sparse, only visit the (tap, mic) pairs which have a nonzero
+        # coefficient for some channel. coefficients loaded later must then be
+        # zero everywhere else. folding also needs the pairs to visit
+        if sparse or folded:
+            nonzero = np.any(self._coefficients[:, :taps, :] != 0, axis=0)
+            if not sparse:
+                nonzero[:] = True
+            self._pairs = [(int(t), int(c)) for t, c in np.argwhere(nonzero)]
+            if len(self._pairs) == 0:
+                self._pairs = [(0, 0)] # we need to visit something
+            # we need to load all the mics then process each lane's pairs for
+            # each channel sharing a DSP
+            set_cycles = NUM_MICS + \
+                CHANS_PER_DSP * len(split_lanes(self._pairs)[0])
+        else:
+            self._pairs = None
+            # we need to process all taps and each lane's mics for each channel
+            # sharing a DSP
+            set_cycles = CHANS_PER_DSP * LANE_MICS * NUM_TAPS
+        # fewest taps which can be used, the sequencer must visit all the pairs
+        self.min_taps = NUM_TAPS if self._pairs is not None else MIN_TAPS
+        # if sparse, which (tap, mic) pairs of the stored taps are visited
+        self.pair_mask = None
+        if sparse:
+            self.pair_mask = np.zeros((taps, NUM_MICS), dtype=bool)
+            for tap, mic in self._pairs:
+                self.pair_mask[tap, mic] = True
+
+        assert CAP_DATA_BITS+1 <= 18 # DSP A input (with a folded sum)
+        assert COEFF_BITS <= 19 # DSP B input
+
+        # multiplication produces at most CAP_DATA_BITS+1+COEFF_BITS of result.
+        # we sum up to NUM_TAPS*NUM_MICS results, so we need enough bits for
+        # that in the accumulator, although the final sum width is just
+        # CAP_DATA_BITS.
+        accum_bits = (CAP_DATA_BITS + 1 + COEFF_BITS
+            + ceil_log2(NUM_TAPS * NUM_MICS))
+        assert accum_bits <= 64 # accumulator size
+
+        # pad out the coefficients so each processor has a full set of channels
+        self._num_processors = (NUM_CHANS+CHANS_PER_DSP-1)//CHANS_PER_DSP
+        coefficients = np.zeros(
+            (self._num_processors*CHANS_PER_DSP, taps, NUM_MICS),
+            dtype=np.int64)
+        # if folded, the sequencer only visits the first half of the taps, so
+        # we only store that half
+        coefficients[:NUM_CHANS], _ = quantize_coefficients(
+            self._coefficients[:, :taps, :], self._max_coefficient)
+        # each lane gets the mics whose number mod LANES is the lane number. the
+        # RAM for each lane of a group of COEFF_PACK processors holds both banks
+        # of every channel back to back (without padding to a power of two),
+        # each word holding the coefficient for each processor of the group
+        self._lane_coeffs = taps * LANE_MICS
+        coefficients = coefficients.reshape(self._num_processors,
+            CHANS_PER_DSP, taps, LANE_MICS, LANES)
+        self._coeff_ram_data = []
+        for first_proc in range(0, self._num_processors, COEFF_PACK):
+            group = coefficients[first_proc:first_proc+COEFF_PACK]
+            words = 0
+            for field, proc_coeffs in enumerate(group):
+                words = words | (proc_coeffs << (field*COEFF_FIELD_BITS))
+            # both banks start out with the given coefficients
+            self._coeff_ram_data.append(
+                [[int(v) for v in words[..., lane].reshape(-1)]*2
+                    for lane in range(LANES)])
+
+        # frequency relative to the microphone sample frequency (i.e. multiply
+        # that by this to get the expected operation frequency)
+        # for each sample frequency we need to process the set then clear the
+        # accumulators (and have time to shift out all the channels), so we do
+        # that, plus 1% more to be sure we're always ahead of capture
+        self.rel_freq = int((max(set_cycles, NUM_CHANS)+CHANS_PER_DSP)*1.01)
 
         super().__init__()
 
@@ -258,67 +986,161 @@ class Convolver(Component):
         m = Module()
 
         # sequencer to generate sample numbers and store the data
-        m.submodules.sequencer = sequencer = Sequencer()
+        m.submodules.sequencer = sequencer = Sequencer(
+            self._pairs, folded=self.folded)
         connect(m, flipped(self.samples_i), sequencer.samples_i)
-        m.d.comb += sequencer.samples_i_count.eq(self.samples_i_count)
-
-        # wire up channel processors
-        sample_out = []
-        sample_new = Signal()
-        for ci in range(0, NUM_CHANS):
-            processor = ChannelProcessor(
-                self._coefficients[ci], self._max_coefficient)
-            m.submodules[f"processor_{ci}"] = processor
+        m.d.comb += [
+            sequencer.samples_i_count.eq(self.samples_i_count),
+            sequencer.bank.eq(self.coeff_bank),
+            self.coeff_bank_active.eq(sequencer.coeff_bank),
+            sequencer.taps[0].eq(self.taps[0]),
+            sequencer.taps[1].eq(self.taps[1]),
+            self.taps_active.eq(sequencer.coeff_taps),
+        ]
 
-            this_sample = Signal(signed(CAP_DATA_BITS), name=f"sample_{ci}")
-            sample_out.append(this_sample)
+        # shared pipeline to delay the sequencer's outputs to when the RAMs and
+        # channel processors need them. the processors all run in lockstep, so
+        # one pipeline serves them all, and each register is only replicated
+        # once its fanout gets too big to meet timing
+        attrs = {"maxfan": PIPELINE_MAX_FANOUT}
+        clear_accum = Signal(attrs=attrs)
+        coeff_bank = Signal(attrs=attrs)
+        coeff_slot = Signal.like(sequencer.coeff_slot, attrs=attrs)
+        m.d.comb += [
+            clear_accum.eq(sequencer.clear_accum),
+            coeff_bank.eq(sequencer.coeff_bank),
+            coeff_slot.eq(sequencer.coeff_slot),
+        ]
+        sc = SignalConveyor(clear_accum, coeff_bank, coeff_slot)
+        m.submodules.sc = sc
 
+        lane_coeffs = self._lane_coeffs
+        ram_depth = 2 * CHANS_PER_DSP * lane_coeffs
+        coeff_addrs, mul_as = [], []
+        for lane in range(LANES):
+            curr_sample = Signal(signed(CAP_DATA_BITS+1),
+                name=f"curr_sample_{lane}", attrs=attrs)
+            coeff_addr = Signal(range(ram_depth),
+                name=f"coeff_addr_{lane}", attrs=attrs)
             m.d.comb += [
-                processor.clear_accum.eq(sequencer.clear_accum),
-                processor.curr_sample.eq(sequencer.curr_sample),
-                processor.coeff_index.eq(sequencer.coeff_index),
-                this_sample.eq(processor.sample_out),
+                curr_sample.eq(sequencer.curr_sample[lane]),
+                coeff_addr.eq(sequencer.coeff_index[lane] + lane_coeffs *
+                    (coeff_bank*CHANS_PER_DSP + coeff_slot)),
             ]
+            sc.put(0, curr_sample)
+            sc.put(0, coeff_addr)
+
+            # one cycle of latency from the sequencer to the RAM address for
+            # timing, and if chained, one more for each lane down the chain
+            delay = lane if self._dsp_chain else 0
+            coeff_addrs.append(sc.get(+1+delay, coeff_addr))
+            # then one cycle of RAM read latency and one for registering the
+            # coefficient before the sample goes into the multiplier with it
+            mul_as.append(sc.get(+2, curr_sample, rel=coeff_addrs[-1]))
+        # the (last) DSP block clears along with the last lane's multiply, and
+        # the slot goes along with it
+        clear = sc.get(+0, clear_accum, rel=mul_as[-1])
+        clear_slot = sc.get(+0, coeff_slot, rel=clear)
+        # one cycle of computation latency and one to register the output. the
+        # truncation is that of the bank the sample was computed with
+        trunc_bits = Signal(TRUNC_WIDTH, attrs=attrs)
+        m.d.sync += trunc_bits.eq(Mux(sc.get(+1, coeff_bank, rel=clear),
+            self.trunc_bits[1], self.trunc_bits[0]))
+        # and new flag (which is true when the MAC clear is asserted the cycle
+        # after the sample is retrieved), once the last slot is done
+        sample_new = Signal()
+        m.d.comb += sample_new.eq(~sc.get(+2, clear_accum, rel=clear)
+            & sc.get(+1, clear_accum, rel=clear)
+            & (sc.get(+1, coeff_slot, rel=clear) == CHANS_PER_DSP-1))
+
+        # work out the processor and slot the written channel belongs to
+        w_proc = Signal(range(self._num_processors))
+        w_slot = Signal(range(CHANS_PER_DSP))
+        for pi in range(self._num_processors):
+            first_chan = pi*CHANS_PER_DSP
+            with m.If((self.coeff_w_chan >= first_chan)
+                    & (self.coeff_w_chan < first_chan+CHANS_PER_DSP)):
+                m.d.comb += [
+                    w_proc.eq(pi),
+                    w_slot.eq(self.coeff_w_chan - first_chan),
+                ]
+        # then register the write along with its lane and RAM address for
+        # timing. the mic, and so the lane, is the low bits of the index
+        w_en = Signal()
+        w_lane = Signal(range(LANES))
+        w_proc_r = Signal.like(w_proc)
+        w_addr = Signal(range(ram_depth))
+        w_data = Signal(COEFF_FIELD_BITS) # zero-extended to fill the field
+        m.d.sync += [
+            w_en.eq(self.coeff_w_en),
+            w_lane.eq(self.coeff_w_addr[:LANE_BITS]),
+            w_proc_r.eq(w_proc),
+            w_addr.eq(self.coeff_w_addr[LANE_BITS:COEFF_ADDR_BITS]
+                + lane_coeffs * (self.coeff_w_addr[COEFF_ADDR_BITS]
+                    * CHANS_PER_DSP + w_slot)),
+            w_data.eq(self.coeff_w_data),
+        ]
 
-            # all processors run off the same clock so we only need to grab the
-            # new sample flag from the first one
-            if ci == 0:
-                m.d.comb += sample_new.eq(processor.sample_new)
-
-        # shift out all the sample data in sequence through the buffer
-        sample_buf = Signal(NUM_CHANS*CAP_DATA_BITS)
-        # we shift the lower bits out
-        m.d.comb += self.samples_o.data.eq(sample_buf[:CAP_DATA_BITS])
-
-        chan_counter = Signal(range(NUM_CHANS-1))
-        with m.FSM("IDLE"):
-            with m.State("IDLE"):
-                with m.If(sample_new):
-                    # latch all the processed data into the sample buffer
-                    for ci in range(0, NUM_CHANS):
-                        m.d.sync += sample_buf.word_select(
-                            ci, CAP_DATA_BITS).eq(sample_out[ci])
-                    m.d.sync += [
-                        chan_counter.eq(NUM_CHANS-1), # reset output counter
-                        self.samples_o.first.eq(1), # prime first output flag
-                        self.samples_o.valid.eq(1), # notify about new samples
-                    ]
-                    m.next = "OUTPUT"
+        # wire up channel processors
+        processors = []
+        sample_out = []
+        for pi in range(0, self._num_processors):
+            processor = ChannelProcessor(dsp_chain=self._dsp_chain)
+            m.submodules[f"processor_{pi}"] = processor
+            processors.append(processor)
 
-            with m.State("OUTPUT"):
-                with m.If(self.samples_o.valid & self.samples_o.ready):
-                    # remaining samples are not the first
-                    m.d.sync += self.samples_o.first.eq(0)
+            first_chan = pi*CHANS_PER_DSP
+            for slot in range(CHANS_PER_DSP):
+                ci = first_chan + slot
+                if ci >= NUM_CHANS: # padding channel
+                    continue
 
-                    # shift out processed data
-                    m.d.sync += [
-                        sample_buf.eq(sample_buf >> CAP_DATA_BITS),
-                        chan_counter.eq(chan_counter-1),
-                    ]
+                this_sample = Signal(signed(CAP_DATA_BITS), name=f"sample_{ci}")
+                sample_out.append(this_sample)
+                m.d.comb += this_sample.eq(processor.sample_out[slot])
 
-                    with m.If(chan_counter == 0): # last channel
-                        m.d.sync += self.samples_o.valid.eq(0)
-                        m.next = "IDLE"
+            m.d.comb += [
+                processor.clear.eq(clear),
+                processor.slot.eq(clear_slot),
+                processor.trunc_bits.eq(trunc_bits),
+            ]
+            for lane in range(LANES):
+                m.d.comb += processor.mul_a[lane].eq(mul_as[lane])
+
+        # RAMs to hold the coefficients for each lane of each group of
+        # processors, with two banks so one can be loaded while the other is in
+        # use. each processor of the group gets one field of the word
+        for gi, first_proc in enumerate(
+                range(0, self._num_processors, COEFF_PACK)):
+            group = processors[first_proc:first_proc+COEFF_PACK]
+            for lane in range(LANES):
+                coeff_memory = Memory(width=COEFF_FIELD_BITS*len(group),
+                    depth=ram_depth, init=self._coeff_ram_data[gi][lane])
+                coeff_r = coeff_memory.read_port(transparent=False)
+                m.submodules[f"coeff_r_{gi}_{lane}"] = coeff_r
+                coeff_w = coeff_memory.write_port(
+                    granularity=COEFF_FIELD_BITS//2)
+                m.submodules[f"coeff_w_{gi}_{lane}"] = coeff_w
+                m.d.comb += [
+                    coeff_r.en.eq(1), # always reading
+                    coeff_r.addr.eq(coeff_addrs[lane]),
+                    coeff_w.addr.eq(w_addr),
+                    coeff_w.data.eq(w_data.replicate(len(group))),
+                ]
+                for field, processor in enumerate(group):
+                    # write both bytes of the field
+                    m.d.comb += coeff_w.en[field*2:field*2+2].eq((w_en
+                        & (w_lane == lane) & (w_proc_r == first_proc+field)
+                    ).replicate(2))
+                    m.d.comb += processor.coeff[lane].eq(coeff_r.data[
+                        field*COEFF_FIELD_BITS:][:COEFF_BITS])
+
+        # send out all the processed data
+        m.submodules.serializer = serializer = SampleSetSerializer(NUM_CHANS)
+        connect(m, serializer.samples_o, flipped(self.samples_o))
+        m.d.comb += serializer.load.eq(sample_new)
+        for ci in range(0, NUM_CHANS):
+            m.d.comb += serializer.data[ci].eq(sample_out[ci])
 
         return m
 
@@ -329,8 +1151,8 @@ class ConvolverDemo(Component):
     samp_o: Out(signed(CAP_DATA_BITS))
     samp_o_first: Out(1)
 
-    def __init__(self, coefficients):
-        self._coefficients = coefficients
+    def __init__(self, coefficients, *, sparse=False, folded=None):
+        self.convolver = Convolver(coefficients, sparse=sparse, folded=folded)
 
         super().__init__()
 
@@ -345,10 +1167,14 @@ class ConvolverDemo(Component):
 
         # set up convolver
         m.submodules.convolver = convolver = \
-            DomainRenamer("convolver")(Convolver(self._coefficients))
+            DomainRenamer("convolver")(self.convolver)
         connect(m, sample_i_fifo.samples_r, convolver.samples_i)
         connect(m, convolver.samples_o, sample_o_fifo.samples_w)
-        m.d.comb += convolver.samples_i_count.eq(sample_i_fifo.samples_count)
+        m.d.comb += [
+            convolver.samples_i_count.eq(sample_i_fifo.samples_count),
+            convolver.trunc_bits[0].eq(convolver.coeff_frac_bits),
+            convolver.trunc_bits[1].eq(convolver.coeff_frac_bits),
+        ]
 
         # generate increasing samples forever sort of like the fake mics
         # (our sync domain runs at MIC_FREQ_HZ*NUM_MICS so a new sample every
@@ -392,10 +1218,11 @@ def demo():
     for x in range(NUM_MICS):
         coefficients[x, -1, x] = 1
 
-    top = ConvolverDemo(coefficients)
+    # which is very sparse, so the convolver can run much slower
+    top = ConvolverDemo(coefficients, sparse=True)
     sim = Simulator(top)
     sim.add_clock(1/(MIC_FREQ_HZ*NUM_MICS), domain="sync")
-    sim.add_clock(1/(MIC_FREQ_HZ*Convolver.REL_FREQ), domain="convolver")
+    sim.add_clock(1/(MIC_FREQ_HZ*top.convolver.rel_freq), domain="convolver")
 
     mod_traces = []
     for name in top.signature.members.keys():
@@ -0,0 +1,288 @@
+from amaranth import *
+from amaranth.lib.wiring import Component, In, Out, connect, flipped
+from amaranth.lib.cdc import FFSynchronizer
+from amaranth.utils import ceil_log2, exact_log2
+
+from amaranth_soc import csr
+from amaranth_soc.csr import Field
+
+import numpy as np
+
+from .constants import CAP_DATA_BITS, NUM_CHANS
+from .stream import SampleStream
+
+FILTER_BITS = 18 # DSP block input
+FILTER_FRAC_BITS = FILTER_BITS-2 # 1 sign and 1 integer bit to hold 1 exactly
+FACTOR_WIDTH = 4 # enough for any factor we'd want
+
+def design_filter(factor, taps_per_phase):
+    # design the anti-alias filter for decimating by the given factor, a
+    # windowed sinc lowpass with unity DC gain and its cutoff at 80% of the
+    # decimated Nyquist frequency. returns factor*taps_per_phase taps quantized
+    # to FILTER_FRAC_BITS fractional bits. decimating by 1 passes the samples
+    # straight through
+    num_taps = factor * taps_per_phase
+    if factor == 1:
+        taps = np.zeros(num_taps)
+        taps[0] = 1
+    else:
+        n = np.arange(num_taps) - (num_taps-1)/2
+        taps = np.sinc(2*(0.4/factor)*n) * np.kaiser(num_taps, 6)
+        taps /= taps.sum()
+
+    taps = np.round(taps * (1 << FILTER_FRAC_BITS)).astype(np.int64)
+    assert np.all(np.abs(taps) < (1 << (FILTER_BITS-1)))
+    return taps
+
+# lowpass filter and decimate each channel of the stream, so only one of every
+# `factor` sets of samples comes out. it's done in polyphase form: each input
+# sample is multiplied by the filter taps of its phase and added into the
+# accumulators of the taps_per_phase outputs it contributes to, so the work is
+# spread evenly over the input sets. the accumulator of the oldest output is
+# done once the last set of its block has been added in
+class Decimator(Component):
+    samples_i: In(SampleStream())
+    samples_o: Out(SampleStream())
+
+    # factor to decimate by, switched at the start of a block of sets. must be
+    # one the decimator was built with, otherwise the current one is kept
+    factor: In(FACTOR_WIDTH, init=1)
+    factor_active: Out(FACTOR_WIDTH, init=1) # factor currently in use
+
+    def __init__(self, factors, *, taps_per_phase=16):
+        self._factors = sorted(set(int(f) for f in factors))
+        if 1 not in self._factors:
+            raise ValueError("factors must include 1")
+        if self._factors[-1] >= 1 << FACTOR_WIDTH:
+            raise ValueError(f"factors must be less than {1 << FACTOR_WIDTH}")
+        # needs to be a power of two to easily wrap the accumulator index
+        self._taps_per_phase = taps_per_phase
+        exact_log2(taps_per_phase)
+
+        # each factor's taps are stored by phase (the input set's position in
+        # its block) then by output, such that the output which completes
+        # first gets the first tap. the output i blocks after the input's gets
+        # tap i*factor + factor-1-phase
+        self._filter_rom_data = []
+        self._filter_base = []
+        for factor in self._factors:
+            self._filter_base.append(len(self._filter_rom_data))
+            taps = design_filter(factor, taps_per_phase)
+            for phase in range(factor):
+                for output in range(taps_per_phase):
+                    self._filter_rom_data.append(
+                        int(taps[output*factor + factor-1-phase]))
+
+        # we need to accept the sample, multiply it by each tap, then wait for
+        # the last result to come out before accepting the next, for each
+        # channel. plus 1% more, like the convolver. the convolver's clock must
+        # be at least this fast (relative to the mic sample frequency)
+        self.rel_freq = int(NUM_CHANS*(taps_per_phase+3)*1.01)+1
+
+        super().__init__()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        P = self._taps_per_phase
+        num_factors = len(self._factors)
+
+        # filter tap ROM, holding each factor's taps one after the other
+        filter_memory = Memory(width=FILTER_BITS,
+            depth=len(self._filter_rom_data), init=self._filter_rom_data)
+        m.submodules.filter_r = filter_r = filter_memory.read_port(
+            transparent=False)
+        m.d.comb += filter_r.en.eq(1) # always reading
+
+        # accumulators for each channel's outputs in progress. one more
+        # integer bit than needed in case the filter overshoots
+        acc_bits = CAP_DATA_BITS + FILTER_BITS + ceil_log2(P)
+        acc_memory = Memory(width=acc_bits, depth=NUM_CHANS*P)
+        m.submodules.acc_r = acc_r = acc_memory.read_port(transparent=False)
+        m.submodules.acc_w = acc_w = acc_memory.write_port()
+        m.d.comb += acc_r.en.eq(1) # always reading
+
+        # factor in use (as an index into the list), and where its taps start.
+        # switched at the start of a block
+        factor_index = Signal(range(num_factors),
+            init=self._factors.index(1))
+        factor = Array(Const(f, FACTOR_WIDTH)
+            for f in self._factors)[factor_index]
+        filter_base = Array(Const(b, range(len(self._filter_rom_data)))
+            for b in self._filter_base)[factor_index]
+        m.d.comb += self.factor_active.eq(factor)
+
+        # position of the current set in its block, and which block it is
+        # (mod P), which selects the accumulator of each output
+        phase = Signal(range(self._factors[-1]))
+        block = Signal(range(P))
+        chan = Signal(range(NUM_CHANS)) # channel of the current sample
+        sample = Signal(signed(CAP_DATA_BITS)) # and its value
+
+        # per-set state for the incoming sample, updated at the start of a set
+        curr_phase = Signal.like(phase)
+        curr_block = Signal.like(block)
+        curr_chan = Signal.like(chan)
+        new_block = Signal()
+        m.d.comb += [
+            new_block.eq(phase == factor-1),
+            curr_phase.eq(phase),
+            curr_block.eq(block),
+            curr_chan.eq(chan + 1),
+        ]
+        with m.If(self.samples_i.first):
+            m.d.comb += [
+                curr_phase.eq(Mux(new_block, 0, phase + 1)),
+                curr_block.eq(Mux(new_block, block + 1, block)),
+                curr_chan.eq(0),
+            ]
+
+        # multiply the sample by each of the P taps in turn, starting with the
+        # last so the accumulator which completes is done last
+        output = Signal(range(P))
+        p0_valid = Signal()
+        p0_last = Signal()
+        m.d.comb += [
+            acc_r.addr.eq(chan*P + (block + output)[:exact_log2(P)]),
+            filter_r.addr.eq(filter_base + phase*P + output),
+        ]
+
+        # the tap and accumulator come out of the RAMs the next cycle and are
+        # registered along with the product, then the sum is written back the
+        # cycle after that. if the accumulator completed, it's cleared for the
+        # output which will next use it and its sum is output instead
+        p1_valid = Signal()
+        p1_last = Signal()
+        p1_addr = Signal.like(acc_r.addr)
+        p2_valid = Signal()
+        p2_last = Signal()
+        p2_addr = Signal.like(acc_r.addr)
+        product = Signal(signed(CAP_DATA_BITS+FILTER_BITS))
+        acc = Signal(signed(acc_bits))
+        m.d.sync += [
+            p1_valid.eq(p0_valid),
+            p1_last.eq(p0_last),
+            p1_addr.eq(acc_r.addr),
+
+            p2_valid.eq(p1_valid),
+            p2_last.eq(p1_last),
+            p2_addr.eq(p1_addr),
+            product.eq(filter_r.data.as_signed() * sample),
+            acc.eq(acc_r.data.as_signed()),
+        ]
+        acc_sum = Signal(signed(acc_bits))
+        m.d.comb += [
+            acc_sum.eq(acc + product),
+            acc_w.addr.eq(p2_addr),
+            acc_w.data.eq(Mux(p2_last, 0, acc_sum)),
+            acc_w.en.eq(p2_valid),
+        ]
+
+        # scale the completed output back down, and clamp instead of wrapping
+        max_val = (1<<(CAP_DATA_BITS-1))-1
+        min_val = -(max_val)-1
+        result = Signal(signed(acc_bits-FILTER_FRAC_BITS))
+        m.d.comb += result.eq(acc_sum >> FILTER_FRAC_BITS)
+        with m.If(self.samples_o.ready):
+            m.d.sync += self.samples_o.valid.eq(0)
+        with m.If(p2_valid & p2_last):
+            m.d.sync += [
+                self.samples_o.data.eq(Mux(result < min_val, min_val,
+                    Mux(result > max_val, max_val, result))),
+                self.samples_o.first.eq(chan == 0),
+                self.samples_o.valid.eq(1),
+            ]
+
+        with m.FSM("IDLE"):
+            with m.State("IDLE"):
+                # only take the next sample once the previous output is gone
+                m.d.comb += self.samples_i.ready.eq(
+                    ~self.samples_o.valid | self.samples_o.ready)
+                with m.If(self.samples_i.valid & self.samples_i.ready):
+                    m.d.sync += [
+                        phase.eq(curr_phase),
+                        block.eq(curr_block),
+                        chan.eq(curr_chan),
+                        sample.eq(self.samples_i.data),
+                        output.eq(P-1),
+                    ]
+                    # switch factors at the start of a block. the switch is
+                    # nowhere near clean
+                    with m.If(self.samples_i.first & new_block):
+                        for fi, f in enumerate(self._factors):
+                            with m.If(self.factor == f):
+                                m.d.sync += factor_index.eq(fi)
+                    m.next = "PROCESS"
+
+            with m.State("PROCESS"):
+                m.d.comb += [
+                    p0_valid.eq(1),
+                    # the last set of the block completes the first output
+                    p0_last.eq((phase == factor-1) & (output == 0)),
+                ]
+                m.d.sync += output.eq(output - 1)
+                with m.If(output == 0):
+                    m.next = "DRAIN"
+
+            with m.State("DRAIN"):
+                # wait for the last result to come out of the pipeline
+                with m.If(p2_valid & ~p1_valid):
+                    m.next = "IDLE"
+
+        return m
+
+class DecimatorRegs(Component):
+    csr_bus: In(csr.Signature(addr_width=1, data_width=32))
+
+    # settings, synced to decimator domain (given by o_domain)
+    factor: Out(FACTOR_WIDTH, init=1)
+
+    # factor the decimator is currently using, in the decimator domain
+    factor_active: In(FACTOR_WIDTH, init=1)
+
+    class Factors(csr.Register, access="r"):
+        # bit N set if the decimator was built to support decimating by N
+        factors: Field(csr.action.R, 1 << FACTOR_WIDTH)
+
+    class Factor(csr.Register, access="rw"):
+        # factor to decimate the convolved channels by. takes effect at the
+        # start of the next block of sets
+        factor: Field(csr.action.RW, FACTOR_WIDTH, init=1)
+        active: Field(csr.action.R, FACTOR_WIDTH) # factor currently in use
+
+    def __init__(self, *, o_domain, factors=(1,)):
+        self._o_domain = o_domain
+        # factors the decimator supports (just 1 if there isn't one)
+        self._factors = factors
+
+        self._factors_reg = self.Factors()
+        self._factor = self.Factor()
+
+        csr_sig = self.__annotations__["csr_bus"].signature
+        builder = csr.Builder(
+            addr_width=csr_sig.addr_width, data_width=csr_sig.data_width)
+        builder.add("factors", self._factors_reg)
+        builder.add("factor", self._factor)
+
+        self._csr_bridge = csr.Bridge(builder.as_memory_map())
+
+        super().__init__() # initialize component and attributes from signature
+
+        self.csr_bus.memory_map = self._csr_bridge.bus.memory_map
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # bridge containing CSRs
+        m.submodules.csr_bridge = csr_bridge = self._csr_bridge
+        connect(m, flipped(self.csr_bus), csr_bridge.bus)
+
+        m.d.comb += self._factors_reg.f.factors.r_data.eq(
+            sum(1 << f for f in set(self._factors)))
+
+        m.submodules += FFSynchronizer(self._factor.f.factor.data,
+            self.factor, o_domain=self._o_domain, init=1)
+        m.submodules += FFSynchronizer(self.factor_active,
+            self._factor.f.active.r_data, init=1)
+
+        return m
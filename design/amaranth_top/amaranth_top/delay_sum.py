@@ -0,0 +1,341 @@
+from amaranth import *
+from amaranth.lib.wiring import Component, In, Out, connect, flipped
+from amaranth.utils import ceil_log2
+
+import numpy as np
+
+from .constants import NUM_MICS, CAP_DATA_BITS, NUM_CHANS, NUM_TAPS
+from .stream import SampleStream, SampleSetSerializer
+
+def delays_from_coefficients(coefficients):
+    # convert convolver coefficients, shaped (channel, tap, mic), which have at
+    # most one nonzero tap for each channel and mic into the delay (in sets of
+    # samples) and weight tables for the DelaySum. the last tap is the newest
+    # sample, so it has no delay
+    expected_shape = (NUM_CHANS, NUM_TAPS, NUM_MICS)
+    if coefficients.shape != expected_shape:
+        raise ValueError(
+            f"shape {coefficients.shape} != expected {expected_shape}")
+
+    nonzero = coefficients != 0
+    if np.any(nonzero.sum(axis=1) > 1):
+        raise ValueError("coefficients must have at most one nonzero tap "
+            "for each channel and mic")
+
+    taps = np.argmax(nonzero, axis=1) # the first tap (0) if there isn't one
+    delays = (NUM_TAPS-1) - taps
+    weights = np.take_along_axis(coefficients, taps[:, None, :], axis=1)[:, 0]
+    delays[weights == 0] = 0 # the mic isn't used anyway
+
+    return delays, weights
+
+def load_delay_table(path):
+    # load the delay and weight tables for the DelaySum from a text file with
+    # a row for each channel: the delay (in sets of samples) of each mic, then
+    # the weight of each mic
+    table = np.loadtxt(path, dtype=np.float64, ndmin=2)
+    expected_shape = (NUM_CHANS, 2*NUM_MICS)
+    if table.shape != expected_shape:
+        raise ValueError(
+            f"shape {table.shape} != expected {expected_shape}")
+
+    return table[:, :NUM_MICS], table[:, NUM_MICS:]
+
+def passthrough_delays():
+    # delay and weight tables which just pass mic N through to channel N (and
+    # leave the rest of the channels silent), for when there's no real table
+    delays = np.zeros((NUM_CHANS, NUM_MICS), dtype=np.int64)
+    weights = np.zeros((NUM_CHANS, NUM_MICS), dtype=np.float64)
+    for ci in range(min(NUM_CHANS, NUM_MICS)):
+        weights[ci, ci] = 1
+
+    return delays, weights
+
+# sums delayed samples from each mic to form each channel (i.e. delay-and-sum
+# beamforming) using just adders and RAM, so hundreds of channels don't need
+# hundreds of DSP blocks. the result is the same as the Convolver would compute
+# with equivalent coefficients
+class DelaySum(Component):
+    samples_i: In(SampleStream())
+    samples_i_count: In(32)
+
+    samples_o: Out(SampleStream())
+
+    def __init__(self, delays, weights=None, *, units=1):
+        # delay (in sets of samples) applied to each mic for each channel,
+        # shaped (channel, mic)
+        delays = np.asarray(delays)
+        expected_shape = (NUM_CHANS, NUM_MICS)
+        if delays.shape != expected_shape:
+            raise ValueError(
+                f"shape {delays.shape} != expected {expected_shape}")
+        if np.any(delays < 0) or np.any(delays != delays.astype(np.int64)):
+            raise ValueError("delays must be non-negative integers")
+        delays = delays.astype(np.int64)
+
+        # weight applied to each mic for each channel, also shaped (channel,
+        # mic). to avoid multiplying, each must be zero (so the mic isn't used)
+        # or a positive or negative power of two at most 1. if None, each mic is
+        # weighted equally such that the channel can't wrap
+        if weights is None:
+            weights = np.full(expected_shape, 2.0**-ceil_log2(NUM_MICS))
+        weights = np.asarray(weights, dtype=np.float64)
+        if weights.shape != expected_shape:
+            raise ValueError(
+                f"shape {weights.shape} != expected {expected_shape}")
+        nonzero = weights != 0
+        shifts = np.zeros(expected_shape, dtype=np.int64)
+        shifts[nonzero] = np.round(-np.log2(np.abs(weights[nonzero])))
+        if np.any(shifts < 0) or np.any(
+                np.abs(weights[nonzero]) != 2.0**-shifts[nonzero]):
+            raise ValueError("weights must be zero or a power of two at most 1")
+
+        # each sample is shifted left to line up the binary points before being
+        # summed, then the sum is shifted back, so no precision is lost
+        self._frac_bits = int(shifts.max())
+
+        # units each form every units-th channel in parallel, with their own
+        # copy of the sample history. each one forms one channel per round
+        self._units = units
+        self._rounds = (NUM_CHANS+units-1)//units
+
+        # list the (mic, delay, shift, negate) entries each unit visits for
+        # each round, padding each round with None so the units stay in step.
+        # each round gets at least one (padding) entry to produce the channel
+        self._unit_entries = [[] for _ in range(units)]
+        self._round_lens = []
+        for first_chan in range(0, NUM_CHANS, units):
+            round_entries = []
+            for ci in range(first_chan, first_chan+units):
+                round_entries.append([] if ci >= NUM_CHANS else
+                    [(mic, int(delays[ci, mic]), int(shifts[ci, mic]),
+                        bool(weights[ci, mic] < 0))
+                    for mic in np.flatnonzero(nonzero[ci])])
+            round_len = max(1, *(len(e) for e in round_entries))
+            for unit_entries, entries in zip(self._unit_entries, round_entries):
+                unit_entries.extend(entries + [None]*(round_len-len(entries)))
+            self._round_lens.append(round_len)
+        self._max_delay = int(delays[nonzero].max()) if nonzero.any() else 0
+
+        # the accumulator needs room for the lined up samples and their sum
+        self._accum_bits = (CAP_DATA_BITS + self._frac_bits
+            + ceil_log2(max(self._round_lens)) + 1)
+
+        # frequency relative to the microphone sample frequency (i.e. multiply
+        # that by this to get the expected operation frequency)
+        # for each sample frequency we need to load the set then visit each
+        # round's entries (and have time to shift out all the channels), so we
+        # do that, plus a cycle to start and 1% more to be sure we're always
+        # ahead of capture
+        set_cycles = NUM_MICS + sum(self._round_lens)
+        self.rel_freq = int((max(set_cycles, NUM_CHANS)+1)*1.01)
+
+        super().__init__()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # the sample history is a circular buffer where each new set of samples
+        # overwrites the oldest, like in the Sequencer, but only as long as the
+        # longest delay needs
+        TOTAL = (self._max_delay+1) * NUM_MICS # samples stored
+        # storage must be a power of two so that Quartus will infer BRAM
+        mem_size = 1 << ceil_log2(TOTAL)
+        # address of the newest set of samples in the circular buffers
+        newest = Signal(range(TOTAL))
+
+        # control ROM holding whether each entry is the first and last of its
+        # round, which is the same for all the units
+        num_entries = sum(self._round_lens)
+        ctrl_rom_data = []
+        for round_len in self._round_lens:
+            ctrl_rom_data += [int(i == 0) | (int(i == round_len-1) << 1)
+                for i in range(round_len)]
+        ctrl_memory = Memory(width=2, depth=num_entries, init=ctrl_rom_data)
+        m.submodules.ctrl_r = ctrl_r = ctrl_memory.read_port(
+            transparent=False)
+        entry_num = Signal(range(num_entries))
+        m.d.comb += [
+            ctrl_r.addr.eq(entry_num),
+            ctrl_r.en.eq(1), # always reading
+        ]
+
+        # the entry ROM data is available the cycle after the entry is visited,
+        # the sample data the cycle after that, then the lined up sample the
+        # cycle after that goes into the accumulator. the control signals are
+        # delayed along with them. done is set for the last entry of the set
+        entry_valid, sample_valid, term_valid = Signal(), Signal(), Signal()
+        entry_done, sample_done, term_done = Signal(), Signal(), Signal()
+        sample_first, term_first = Signal(), Signal()
+        sample_last, term_last = Signal(), Signal()
+        m.d.sync += [
+            sample_valid.eq(entry_valid),
+            sample_done.eq(entry_done),
+            sample_first.eq(ctrl_r.data[0]),
+            sample_last.eq(ctrl_r.data[1]),
+            term_valid.eq(sample_valid),
+            term_done.eq(sample_done),
+            term_first.eq(sample_first),
+            term_last.eq(sample_last),
+        ]
+
+        offset_shape = signed(ceil_log2(TOTAL)+1)
+        offset_mask = (1 << offset_shape.width)-1
+        shift_bits = ceil_log2(self._frac_bits+1)
+        unit_results = []
+        samp_w = []
+        for unit, entries in enumerate(self._unit_entries):
+            # memory to store this unit's copy of the sample history
+            sample_memory = Memory(width=CAP_DATA_BITS, depth=mem_size)
+            samp_r = sample_memory.read_port(transparent=False)
+            samp_w.append(sample_memory.write_port())
+            m.submodules[f"samp_r_{unit}"] = samp_r
+            m.submodules[f"samp_w_{unit}"] = samp_w[-1]
+
+            # ROM holding the offset from the newest set of samples to each
+            # entry's sample, how far to shift it left to line it up, whether
+            # to negate it, and whether it's a real entry and not padding
+            entry_rom_data = []
+            for entry in entries:
+                if entry is None: # padding, so the sample is zeroed
+                    entry_rom_data.append(0)
+                    continue
+                mic, delay, shift, negate = entry
+                offset = mic - delay*NUM_MICS
+                entry_rom_data.append((offset & offset_mask)
+                    | ((self._frac_bits-shift) << offset_shape.width)
+                    | (int(negate) << (offset_shape.width + shift_bits))
+                    | (1 << (offset_shape.width + shift_bits + 1)))
+            entry_memory = Memory(width=offset_shape.width+shift_bits+2,
+                depth=num_entries, init=entry_rom_data)
+            m.submodules[f"entry_r_{unit}"] = entry_r = \
+                entry_memory.read_port(transparent=False)
+            entry_offset = Signal(offset_shape)
+            entry_shift = Signal(shift_bits)
+            entry_negate = Signal()
+            entry_real = Signal()
+            m.d.comb += [
+                entry_r.addr.eq(entry_num),
+                entry_r.en.eq(1), # always reading
+                Cat(entry_offset, entry_shift, entry_negate, entry_real).eq(
+                    entry_r.data),
+            ]
+
+            # address of the current entry's sample, wrapped into the buffer
+            entry_addr = Signal(signed(offset_shape.width+1))
+            m.d.comb += [
+                entry_addr.eq(newest + entry_offset),
+                samp_r.addr.eq(Mux(entry_addr < 0,
+                    entry_addr + TOTAL, entry_addr)),
+                samp_r.en.eq(entry_valid),
+            ]
+
+            # the rest of the entry, registered along with the read
+            sample_shift = Signal.like(entry_shift)
+            sample_negate = Signal()
+            sample_real = Signal()
+            with m.If(entry_valid):
+                m.d.sync += [
+                    sample_shift.eq(entry_shift),
+                    sample_negate.eq(entry_negate),
+                    sample_real.eq(entry_real),
+                ]
+
+            # line up the sample and negate it if needed, which is registered
+            # for timing
+            sample = Signal(signed(CAP_DATA_BITS+1))
+            m.d.comb += sample.eq(Mux(sample_negate,
+                -samp_r.data.as_signed(), samp_r.data.as_signed()))
+            term = Signal(signed(self._accum_bits))
+            m.d.sync += term.eq(Mux(sample_real, sample << sample_shift, 0))
+
+            # accumulate the terms of each round, starting over on its first
+            accum = Signal(signed(self._accum_bits))
+            total = Signal.like(accum)
+            m.d.comb += total.eq(Mux(term_first, 0, accum) + term)
+            with m.If(term_valid):
+                m.d.sync += accum.eq(total)
+
+            # then shift the total back and onto the end of the unit's results
+            # on the last. once all the rounds are done, the first round's
+            # result has been shifted along to the end
+            results = [Signal(signed(CAP_DATA_BITS), name=f"result_{unit}_{r}")
+                for r in range(self._rounds)]
+            # clamp instead of wrapping if the shifted total doesn't fit, like
+            # the Convolver. it fits if the bits above the output's are all
+            # copies of its sign
+            max_val = (1<<(CAP_DATA_BITS-1))-1
+            shifted = Signal.like(total)
+            m.d.comb += shifted.eq(total >> self._frac_bits)
+            result = Signal(signed(CAP_DATA_BITS))
+            top_bits = shifted[CAP_DATA_BITS-1:]
+            with m.If(top_bits.all() | ~top_bits.any()):
+                m.d.comb += result.eq(shifted)
+            with m.Else():
+                m.d.comb += result.eq(Mux(total[-1], -max_val-1, max_val))
+            with m.If(term_valid & term_last):
+                m.d.sync += results[0].eq(result)
+                for prev, curr in zip(results[:-1], results[1:]):
+                    m.d.sync += curr.eq(prev)
+            unit_results.append(results)
+
+        # new sample data is available the cycle after the last total
+        sample_new = Signal()
+        m.d.sync += sample_new.eq(term_valid & term_done)
+
+        # main state machine
+        mic_num = Signal(range(NUM_MICS))
+        m.d.sync += [ # by default...
+            entry_valid.eq(0), # not visiting an entry
+            entry_done.eq(0),
+        ]
+        with m.FSM("IDLE"):
+            with m.State("IDLE"):
+                with m.If(self.samples_i.valid): # at least one sample
+                    with m.If(~self.samples_i.first): # not the first sample?
+                        m.d.comb += self.samples_i.ready.eq(1) # discard it
+                    with m.Elif(self.samples_i_count >= NUM_MICS):
+                        # we have a full set of samples (so we won't ever hit an
+                        # invalid stream word) and the first sample is
+                        # correctly flagged as the first
+                        m.d.sync += [
+                            mic_num.eq(0),
+                            # the oldest set of samples becomes the newest
+                            newest.eq(Mux(newest == TOTAL-NUM_MICS,
+                                0, newest + NUM_MICS)),
+                        ]
+                        m.next = "LOAD"
+
+            with m.State("LOAD"):
+                # write the new samples over the oldest ones in every unit
+                for w in samp_w:
+                    m.d.comb += [
+                        w.addr.eq(newest + mic_num),
+                        w.data.eq(self.samples_i.data),
+                        w.en.eq(1),
+                    ]
+                m.d.comb += self.samples_i.ready.eq(1)
+                m.d.sync += mic_num.eq(mic_num + 1)
+                with m.If(mic_num == NUM_MICS-1):
+                    m.d.sync += entry_num.eq(0)
+                    m.next = "PROCESS"
+
+            with m.State("PROCESS"):
+                m.d.sync += [
+                    entry_valid.eq(1),
+                    entry_num.eq(entry_num + 1), # next entry
+                ]
+                with m.If(entry_num == num_entries-1):
+                    m.d.sync += entry_done.eq(1)
+                    m.next = "IDLE" # done with the sequence
+
+        # send out all the processed data
+        m.submodules.serializer = serializer = SampleSetSerializer(NUM_CHANS)
+        connect(m, serializer.samples_o, flipped(self.samples_o))
+        m.d.comb += serializer.load.eq(sample_new)
+        for ci in range(0, NUM_CHANS):
+            results = unit_results[ci % self._units]
+            m.d.comb += serializer.data[ci].eq(
+                results[self._rounds-1 - ci//self._units])
+
+        return m
@@ -0,0 +1,654 @@
+from amaranth import *
+from amaranth.lib.wiring import Component, In, Out, connect, flipped
+from amaranth.utils import ceil_log2, exact_log2
+
+import numpy as np
+
+from .constants import NUM_MICS, CAP_DATA_BITS, NUM_CHANS
+from .stream import SampleStream, SampleSetSerializer
+from .misc import SignalConveyor
+
+TWIDDLE_BITS = 18 # DSP block input
+TWIDDLE_FRAC_BITS = TWIDDLE_BITS-2 # 1 sign and 1 integer bit to hold 1 exactly
+SPECTRUM_BITS = 18 # filter spectrum coefficients, also a DSP block input
+
+def bit_reverse(value, bits):
+    return Cat(*(value[i] for i in reversed(range(bits))))
+
+# FFT done in place on a RAM of complex values, one radix 2 butterfly at a time.
+# the input must be loaded in bit reversed order, then the output comes out in
+# natural order. the inverse transform halves the values each stage, which
+# divides by the length like it should and keeps them from growing
+class FFT(Component):
+    def __init__(self, fft_bits, data_bits):
+        self._fft_bits = fft_bits
+        self._data_bits = data_bits
+
+        super().__init__({
+            "start": In(1), # pulse to start transforming the RAM's contents
+            "inverse": In(1), # latched at the start
+            "busy": Out(1),
+
+            # access to the RAM while not busy. read data is available the cycle
+            # after the address. values are (real, imaginary)
+            "r_addr": In(fft_bits),
+            "r_data": Out(signed(data_bits)).array(2),
+            "w_en": In(1),
+            "w_addr": In(fft_bits),
+            "w_data": In(signed(data_bits)).array(2),
+        })
+
+    def elaborate(self, platform):
+        m = Module()
+
+        n_bits = self._fft_bits
+        fft_len = 1 << n_bits
+        D = self._data_bits
+
+        data_memory = Memory(width=2*D, depth=fft_len)
+        m.submodules.data_r = data_r = data_memory.read_port(transparent=False)
+        m.submodules.data_w = data_w = data_memory.write_port()
+        r_re = data_r.data[:D].as_signed()
+        r_im = data_r.data[D:].as_signed()
+        m.d.comb += [
+            data_r.en.eq(1), # always reading
+            self.r_data[0].eq(r_re),
+            self.r_data[1].eq(r_im),
+        ]
+
+        # ROM holding the twiddle factors e^(-2*pi*j*k/fft_len) for the first
+        # half circle as (real, imaginary)
+        k = np.arange(fft_len//2)
+        tw_mask = (1 << TWIDDLE_BITS)-1
+        tw_re = np.round(np.cos(2*np.pi*k/fft_len) * (1 << TWIDDLE_FRAC_BITS))
+        tw_im = np.round(-np.sin(2*np.pi*k/fft_len) * (1 << TWIDDLE_FRAC_BITS))
+        tw_memory = Memory(width=2*TWIDDLE_BITS, depth=fft_len//2,
+            init=[(int(re) & tw_mask) | ((int(im) & tw_mask) << TWIDDLE_BITS)
+                for re, im in zip(tw_re, tw_im)])
+        m.submodules.tw_r = tw_r = tw_memory.read_port(transparent=False)
+
+        inverse = Signal() # the inverse uses the conjugate twiddle factors
+        w_re = tw_r.data[:TWIDDLE_BITS].as_signed()
+        w_im = Mux(inverse, -tw_r.data[TWIDDLE_BITS:].as_signed(),
+            tw_r.data[TWIDDLE_BITS:].as_signed())
+
+        # each stage pairs up values half (the stage'th power of two) apart.
+        # butterfly i of a stage pairs the value at a, which is i with a zero
+        # inserted at the stage'th bit, with the one at a+half using twiddle
+        # factor (i mod half)*(fft_len/2/half)
+        stage = Signal(range(n_bits))
+        bfly = Signal(range(fft_len//2))
+        half = Signal(n_bits)
+        low_mask = Signal(n_bits)
+        addr_a = Signal(n_bits)
+        m.d.comb += [
+            half.eq(C(1, n_bits) << stage),
+            low_mask.eq(half - 1),
+            addr_a.eq(((bfly & ~low_mask) << 1) | (bfly & low_mask)),
+            tw_r.addr.eq(((bfly & low_mask) << (n_bits-1)) >> stage),
+            tw_r.en.eq(1), # always reading
+        ]
+
+        a_re, a_im = Signal(signed(D)), Signal(signed(D))
+        # b times the twiddle factor, which is at most as big as b
+        p_re, p_im = Signal(signed(D+1)), Signal(signed(D+1))
+        sum_re, sum_im = Signal(signed(D+2)), Signal(signed(D+2))
+        diff_re, diff_im = Signal(signed(D+2)), Signal(signed(D+2))
+        m.d.comb += [
+            sum_re.eq(a_re + p_re),
+            sum_im.eq(a_im + p_im),
+            diff_re.eq(a_re - p_re),
+            diff_im.eq(a_im - p_im),
+        ]
+
+        # one butterfly reads a then b, multiplies b by the twiddle factor, then
+        # writes a+b*w back to a and a-b*w back to b
+        with m.FSM("IDLE"):
+            with m.State("IDLE"):
+                m.d.comb += [
+                    data_r.addr.eq(self.r_addr),
+                    data_w.en.eq(self.w_en),
+                    data_w.addr.eq(self.w_addr),
+                    data_w.data.eq(Cat(self.w_data[0], self.w_data[1])),
+                ]
+                with m.If(self.start):
+                    m.d.sync += [
+                        stage.eq(0),
+                        bfly.eq(0),
+                        inverse.eq(self.inverse),
+                    ]
+                    m.next = "READ_A"
+
+            with m.State("READ_A"):
+                m.d.comb += [
+                    self.busy.eq(1),
+                    data_r.addr.eq(addr_a),
+                ]
+                m.next = "READ_B"
+
+            with m.State("READ_B"):
+                m.d.comb += [
+                    self.busy.eq(1),
+                    data_r.addr.eq(addr_a | half),
+                ]
+                m.d.sync += [
+                    a_re.eq(r_re),
+                    a_im.eq(r_im),
+                ]
+                m.next = "MULTIPLY"
+
+            with m.State("MULTIPLY"):
+                m.d.comb += self.busy.eq(1)
+                m.d.sync += [
+                    p_re.eq((r_re*w_re - r_im*w_im) >> TWIDDLE_FRAC_BITS),
+                    p_im.eq((r_re*w_im + r_im*w_re) >> TWIDDLE_FRAC_BITS),
+                ]
+                m.next = "WRITE_A"
+
+            with m.State("WRITE_A"):
+                m.d.comb += [
+                    self.busy.eq(1),
+                    data_w.en.eq(1),
+                    data_w.addr.eq(addr_a),
+                    data_w.data.eq(Cat(
+                        Mux(inverse, sum_re >> 1, sum_re)[:D],
+                        Mux(inverse, sum_im >> 1, sum_im)[:D])),
+                ]
+                m.next = "WRITE_B"
+
+            with m.State("WRITE_B"):
+                m.d.comb += [
+                    self.busy.eq(1),
+                    data_w.en.eq(1),
+                    data_w.addr.eq(addr_a | half),
+                    data_w.data.eq(Cat(
+                        Mux(inverse, diff_re >> 1, diff_re)[:D],
+                        Mux(inverse, diff_im >> 1, diff_im)[:D])),
+                ]
+                m.d.sync += bfly.eq(bfly + 1)
+                m.next = "READ_A"
+                with m.If(bfly == fft_len//2-1): # last butterfly of the stage
+                    m.d.sync += [
+                        bfly.eq(0),
+                        stage.eq(stage + 1),
+                    ]
+                    with m.If(stage == n_bits-1): # last stage
+                        m.next = "IDLE"
+
+        return m
+
+# convolves like the Convolver, but in the frequency domain using overlap-save.
+# each block of new samples is transformed along with enough older samples to
+# cover the filter length, multiplied by the filters' spectra, then transformed
+# back. this costs far fewer multiplies per sample for long filters, but the
+# output is delayed by two blocks and is only about as exact as the fixed point
+# transforms
+class FFTConvolver(Component):
+    samples_i: In(SampleStream())
+    samples_i_count: In(32)
+
+    samples_o: Out(SampleStream())
+
+    def __init__(self, coefficients, *, fft_len=None):
+        # coefficients as float values, same as the Convolver, but with any
+        # number of taps instead of NUM_TAPS
+        coefficients = np.asarray(coefficients)
+        num_taps = coefficients.shape[1] if coefficients.ndim == 3 else 0
+        expected_shape = (NUM_CHANS, num_taps, NUM_MICS)
+        if coefficients.shape != expected_shape or num_taps < 1:
+            raise ValueError(f"shape {coefficients.shape} != expected "
+                f"({NUM_CHANS}, taps, {NUM_MICS})")
+        assert NUM_MICS >= 2 # see mirrored bin writes below
+
+        # by default, long enough that at least half of each transform is new
+        # samples. longer is fewer operations per sample but more latency
+        if fft_len is None:
+            fft_len = max(1 << ceil_log2(2*(num_taps-1)), 2)
+        if fft_len < max(num_taps, 2) or fft_len & (fft_len-1):
+            raise ValueError(
+                "fft_len must be a power of two at least the number of taps")
+        self._fft_bits = exact_log2(fft_len)
+        # each transform overlaps the last by num_taps-1 samples, the rest are
+        # new and produce that many output samples
+        self._block_len = fft_len - num_taps + 1
+        # transforms of real values are conjugate symmetric, so we only need
+        # the first half (and middle) bins of each spectrum
+        num_bins = fft_len//2 + 1
+        self._num_bins = num_bins
+
+        # spectra of each channel's filter for each mic. the convolver's last
+        # tap is the newest sample, so the taps are reversed into delays
+        filters = np.zeros((NUM_CHANS, NUM_MICS, fft_len), dtype=np.float64)
+        filters[:, :, :num_taps] = \
+            coefficients[:, ::-1, :].transpose(0, 2, 1)
+        spectra = np.fft.fft(filters, axis=2)[:, :, :num_bins]
+
+        # a transformed set of samples grows by up to the transform length, and
+        # the sum over the mics of their products with the spectra by up to the
+        # biggest gain of the filters, so make room for both
+        gain = np.abs(spectra).sum(axis=1).max()
+        guard_bits = int(np.ceil(np.log2(gain))) if gain > 1 else 0
+        self._data_bits = CAP_DATA_BITS + self._fft_bits + 1 + guard_bits
+
+        # convert the spectra to signed fixed point with as many fractional
+        # bits as fit, to be truncated after multiplying
+        max_part = max(np.abs(spectra.real).max(), np.abs(spectra.imag).max())
+        max_val = (1 << (SPECTRUM_BITS-1))-1 # leave one bit for sign
+        self._spectrum_frac_bits = SPECTRUM_BITS-2
+        if max_part > 0:
+            self._spectrum_frac_bits = int(np.floor(np.log2(max_val/max_part)))
+        assert self._spectrum_frac_bits >= 0 # filters absurdly loud otherwise
+        scale = 1 << self._spectrum_frac_bits
+        spec_mask = (1 << SPECTRUM_BITS)-1
+        # ordered by channel, then bin, then mic, like they're visited
+        spectra = spectra.transpose(0, 2, 1).reshape(-1)
+        self._spectrum_rom_data = [
+            (int(re) & spec_mask) | ((int(im) & spec_mask) << SPECTRUM_BITS)
+            for re, im in zip(np.round(spectra.real * scale),
+                np.round(spectra.imag * scale))]
+
+        # frequency relative to the microphone sample frequency (i.e. multiply
+        # that by this to get the expected operation frequency)
+        # for each block we need to transform each mic's samples, then multiply
+        # and accumulate each channel's bins and transform them back, all over
+        # the sets of the block. each set also needs to be written, and the
+        # last block's outputs for the set read and shifted out. we do that
+        # (with a few cycles to spare for each step), plus 1% more to be sure
+        # we're always ahead of capture
+        fft_cycles = 5 * self._fft_bits * (fft_len//2) + 2
+        block_cycles = (
+            NUM_MICS * (fft_len + fft_cycles + num_bins + 4)
+            + NUM_CHANS * (num_bins*NUM_MICS + fft_cycles
+                + self._block_len + 8))
+        set_cycles = max(NUM_MICS+1, 2*NUM_CHANS+3)
+        self.rel_freq = int(
+            max(block_cycles/self._block_len, set_cycles)*1.01) + 1
+
+        super().__init__()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        n_bits = self._fft_bits
+        fft_len = 1 << n_bits
+        block_len = self._block_len
+        num_bins = self._num_bins
+        D = self._data_bits
+        mic_bits = ceil_log2(NUM_MICS)
+
+        m.submodules.fft = fft = FFT(n_bits, D)
+
+        # sample history for each mic, long enough to hold the transform's
+        # samples while the next block is written
+        hist_memory = Memory(width=CAP_DATA_BITS, depth=(2*fft_len) << mic_bits)
+        m.submodules.hist_r = hist_r = hist_memory.read_port(transparent=False)
+        m.submodules.hist_w = hist_w = hist_memory.write_port()
+        # slot the next set of samples is written to
+        next_slot = Signal(n_bits+1)
+
+        # spectrum of each mic's samples for the current block, ordered by bin,
+        # then mic
+        spec_memory = Memory(width=2*D, depth=num_bins*NUM_MICS)
+        m.submodules.spec_r = spec_r = spec_memory.read_port(transparent=False)
+        m.submodules.spec_w = spec_w = spec_memory.write_port()
+
+        # spectrum of each channel's filter for each mic
+        filt_memory = Memory(width=2*SPECTRUM_BITS,
+            depth=len(self._spectrum_rom_data), init=self._spectrum_rom_data)
+        m.submodules.filt_r = filt_r = filt_memory.read_port(transparent=False)
+
+        # output samples of each set for each channel, with two banks so one
+        # block can be output while the next is computed
+        out_memory = Memory(width=CAP_DATA_BITS,
+            depth=2*block_len*NUM_CHANS)
+        m.submodules.out_r = out_r = out_memory.read_port(transparent=False)
+        m.submodules.out_w = out_w = out_memory.write_port()
+        out_bank = Signal() # bank being computed
+
+        # input state machine, which writes each set into the history and
+        # starts computing each block
+        proc_start = Signal()
+        proc_busy = Signal()
+        win_start = Signal.like(next_slot) # slot of the oldest sample in block
+        emit = Signal() # start outputting a set
+        emit_idle = Signal()
+        emit_addr = Signal(range(2*block_len*NUM_CHANS))
+        set_num = Signal(range(block_len)) # set within the block
+        mic_num = Signal(range(NUM_MICS))
+        m.d.comb += [
+            hist_w.addr.eq(Cat(next_slot, mic_num)),
+            hist_w.data.eq(self.samples_i.data),
+        ]
+        with m.FSM("IDLE"):
+            with m.State("IDLE"):
+                with m.If(self.samples_i.valid): # at least one sample
+                    with m.If(~self.samples_i.first): # not the first sample?
+                        m.d.comb += self.samples_i.ready.eq(1) # discard it
+                    with m.Elif((self.samples_i_count >= NUM_MICS) & emit_idle
+                            & ((set_num != 0) | ~proc_busy)):
+                        # we have a full set of samples (so we won't ever hit an
+                        # invalid stream word) and the first sample is
+                        # correctly flagged as the first. the last set was
+                        # output and if it ended a block, that block can start
+                        m.d.comb += emit.eq(1)
+                        m.d.sync += mic_num.eq(0)
+                        with m.If(set_num == 0):
+                            # start computing the block that just ended into
+                            # the other bank, and output the one just computed
+                            m.d.comb += proc_start.eq(1)
+                            m.d.sync += [
+                                win_start.eq(next_slot - fft_len),
+                                out_bank.eq(~out_bank),
+                                emit_addr.eq(
+                                    Mux(out_bank, block_len*NUM_CHANS, 0)),
+                            ]
+                        m.next = "WRITE"
+
+            with m.State("WRITE"):
+                m.d.comb += [
+                    hist_w.en.eq(1),
+                    self.samples_i.ready.eq(1),
+                ]
+                m.d.sync += mic_num.eq(mic_num + 1)
+                with m.If(mic_num == NUM_MICS-1):
+                    m.d.sync += [
+                        next_slot.eq(next_slot + 1),
+                        set_num.eq(Mux(set_num == block_len-1, 0, set_num + 1)),
+                    ]
+                    m.next = "IDLE"
+
+        # block state machine, which computes each block of output samples
+        mic = Signal(range(NUM_MICS))
+        chan = Signal(range(NUM_CHANS))
+        index = Signal(n_bits+1) # of sample or bin within the step
+        spec_addr = Signal(range(num_bins*NUM_MICS))
+        filt_addr = Signal(range(len(self._spectrum_rom_data)))
+        out_addr = Signal(range(2*block_len*NUM_CHANS))
+        wait = Signal(2)
+
+        # RAM reads are written to the next RAM the cycle after
+        load_valid = Signal() # history to FFT
+        store_valid = Signal() # FFT to spectrum
+        unload_valid = Signal() # FFT to output
+        load_index = Signal(n_bits)
+        m.d.sync += [
+            load_valid.eq(0),
+            store_valid.eq(0),
+            unload_valid.eq(0),
+            load_index.eq(index),
+        ]
+        m.d.comb += [
+            hist_r.en.eq(1),
+            spec_r.en.eq(1),
+            filt_r.en.eq(1),
+            out_r.en.eq(1),
+
+            spec_w.en.eq(store_valid),
+            spec_w.addr.eq(spec_addr),
+            spec_w.data.eq(Cat(fft.r_data[0], fft.r_data[1])),
+
+            out_w.en.eq(unload_valid),
+            out_w.addr.eq(out_addr),
+        ]
+        # the inverse is real. clamp it instead of wrapping if it doesn't fit,
+        # like the Convolver. it fits if the bits above the output's are all
+        # copies of its sign
+        max_val = (1<<(CAP_DATA_BITS-1))-1
+        top_bits = fft.r_data[0][CAP_DATA_BITS-1:]
+        with m.If(top_bits.all() | ~top_bits.any()):
+            m.d.comb += out_w.data.eq(fft.r_data[0])
+        with m.Else():
+            m.d.comb += out_w.data.eq(
+                Mux(fft.r_data[0][-1], -max_val-1, max_val))
+        with m.If(load_valid):
+            m.d.comb += [
+                fft.w_en.eq(1),
+                fft.w_addr.eq(bit_reverse(load_index, n_bits)),
+                fft.w_data[0].eq(hist_r.data.as_signed()),
+                fft.w_data[1].eq(0),
+            ]
+
+        # the multiply-accumulate pipeline visits each mic of each bin, and
+        # writes each bin of the result into the FFT in bit reversed order
+        mac_valid = Signal()
+        mac_first = Signal() # first mic
+        mac_last = Signal() # last mic
+        mac_bin = Signal(n_bits)
+        m.submodules.sc = sc = SignalConveyor(
+            mac_valid, mac_first, mac_last, mac_bin)
+        m.d.comb += [
+            spec_r.addr.eq(spec_addr),
+            filt_r.addr.eq(filt_addr),
+        ]
+        # RAM data is available the cycle after, then register the products
+        x_re, x_im = spec_r.data[:D].as_signed(), spec_r.data[D:].as_signed()
+        h_re = filt_r.data[:SPECTRUM_BITS].as_signed()
+        h_im = filt_r.data[SPECTRUM_BITS:].as_signed()
+        prod_bits = D + SPECTRUM_BITS
+        rr, ii, ri, ir = (Signal(signed(prod_bits), name=n)
+            for n in ("prod_rr", "prod_ii", "prod_ri", "prod_ir"))
+        m.d.sync += [
+            rr.eq(x_re * h_re),
+            ii.eq(x_im * h_im),
+            ri.eq(x_re * h_im),
+            ir.eq(x_im * h_re),
+        ]
+        # then accumulate them, starting over with the first mic
+        accum_bits = prod_bits + 1 + mic_bits
+        acc_re, acc_im = Signal(signed(accum_bits)), Signal(signed(accum_bits))
+        total_re, total_im = Signal.like(acc_re), Signal.like(acc_im)
+        first = sc.get(+2, mac_first)
+        m.d.comb += [
+            total_re.eq(Mux(first, 0, acc_re) + rr - ii),
+            total_im.eq(Mux(first, 0, acc_im) + ri + ir),
+        ]
+        with m.If(sc.get(+2, mac_valid)):
+            m.d.sync += [
+                acc_re.eq(total_re),
+                acc_im.eq(total_im),
+            ]
+        # and register the bin's total (scaled back) on the last mic to write
+        # it. the next cycle, write its conjugate to the mirrored bin, which
+        # can't collide with the next bin as there are at least two mics
+        y_valid, y_mirror = Signal(), Signal()
+        y_bin = Signal(n_bits)
+        y_re, y_im = Signal(signed(D)), Signal(signed(D))
+        m.d.sync += [
+            y_valid.eq(sc.get(+2, mac_valid) & sc.get(+2, mac_last)),
+            # the first and middle bins are their own mirrors
+            y_mirror.eq(y_valid & (y_bin != 0) & (y_bin != fft_len//2)),
+        ]
+        with m.If(sc.get(+2, mac_valid) & sc.get(+2, mac_last)):
+            m.d.sync += [
+                y_bin.eq(sc.get(+2, mac_bin)),
+                y_re.eq(total_re >> self._spectrum_frac_bits),
+                y_im.eq(total_im >> self._spectrum_frac_bits),
+            ]
+        with m.If(y_valid):
+            m.d.comb += [
+                fft.w_en.eq(1),
+                fft.w_addr.eq(bit_reverse(y_bin, n_bits)),
+                fft.w_data[0].eq(y_re),
+                fft.w_data[1].eq(y_im),
+            ]
+        with m.Elif(y_mirror):
+            m.d.comb += [
+                fft.w_en.eq(1),
+                fft.w_addr.eq(bit_reverse(-y_bin, n_bits)),
+                fft.w_data[0].eq(y_re),
+                fft.w_data[1].eq(-y_im),
+            ]
+
+        with m.FSM("IDLE"):
+            with m.State("IDLE"):
+                with m.If(proc_start):
+                    m.d.sync += [
+                        mic.eq(0),
+                        index.eq(0),
+                        spec_addr.eq(0),
+                    ]
+                    m.next = "LOAD"
+
+            with m.State("LOAD"):
+                # load the mic's samples from the history
+                m.d.comb += [
+                    proc_busy.eq(1),
+                    hist_r.addr.eq(Cat((win_start + index)[:n_bits+1], mic)),
+                ]
+                m.d.sync += [
+                    load_valid.eq(1),
+                    index.eq(index + 1),
+                ]
+                with m.If(index == fft_len-1):
+                    m.next = "FFT" # the last write happens then
+
+            with m.State("FFT"):
+                m.d.comb += [
+                    proc_busy.eq(1),
+                    fft.start.eq(1),
+                    fft.inverse.eq(0),
+                ]
+                m.next = "FFT_WAIT"
+
+            with m.State("FFT_WAIT"):
+                m.d.comb += proc_busy.eq(1)
+                with m.If(~fft.busy):
+                    m.d.sync += [
+                        index.eq(0),
+                        spec_addr.eq(mic),
+                    ]
+                    m.next = "STORE"
+
+            with m.State("STORE"):
+                # store the first half of its spectrum
+                m.d.comb += [
+                    proc_busy.eq(1),
+                    fft.r_addr.eq(index),
+                ]
+                m.d.sync += [
+                    store_valid.eq(1),
+                    index.eq(index + 1),
+                ]
+                with m.If(store_valid):
+                    m.d.sync += spec_addr.eq(spec_addr + NUM_MICS)
+                with m.If(index == num_bins-1):
+                    m.d.sync += index.eq(0)
+                    m.next = "STORE_LAST" # the last write happens then
+
+            with m.State("STORE_LAST"):
+                m.d.comb += proc_busy.eq(1)
+                m.d.sync += mic.eq(mic + 1)
+                m.next = "LOAD"
+                with m.If(mic == NUM_MICS-1):
+                    m.d.sync += [
+                        mic.eq(0),
+                        chan.eq(0),
+                        spec_addr.eq(0),
+                        filt_addr.eq(0),
+                        out_addr.eq(Mux(out_bank, block_len*NUM_CHANS, 0)),
+                    ]
+                    m.next = "MAC"
+
+            with m.State("MAC"):
+                # multiply and accumulate the channel's spectrum for each mic
+                m.d.comb += [
+                    proc_busy.eq(1),
+                    mac_valid.eq(1),
+                    mac_first.eq(mic == 0),
+                    mac_last.eq(mic == NUM_MICS-1),
+                    mac_bin.eq(index),
+                ]
+                m.d.sync += [
+                    spec_addr.eq(spec_addr + 1),
+                    filt_addr.eq(filt_addr + 1),
+                    mic.eq(mic + 1),
+                ]
+                with m.If(mic == NUM_MICS-1):
+                    m.d.sync += [
+                        mic.eq(0),
+                        index.eq(index + 1),
+                    ]
+                    with m.If(index == num_bins-1):
+                        m.d.sync += wait.eq(0)
+                        m.next = "MAC_WAIT"
+
+            with m.State("MAC_WAIT"):
+                # until the last bin is about to be mirrored
+                m.d.comb += proc_busy.eq(1)
+                m.d.sync += wait.eq(wait + 1)
+                with m.If(wait == 2):
+                    m.next = "IFFT"
+
+            with m.State("IFFT"):
+                m.d.comb += [
+                    proc_busy.eq(1),
+                    fft.start.eq(1),
+                    fft.inverse.eq(1),
+                ]
+                m.next = "IFFT_WAIT"
+
+            with m.State("IFFT_WAIT"):
+                m.d.comb += proc_busy.eq(1)
+                with m.If(~fft.busy):
+                    m.d.sync += index.eq(fft_len - block_len)
+                    m.next = "UNLOAD"
+
+            with m.State("UNLOAD"):
+                # the last block_len samples are the valid output, which go to
+                # each set of the output bank
+                m.d.comb += [
+                    proc_busy.eq(1),
+                    fft.r_addr.eq(index),
+                ]
+                m.d.sync += [
+                    unload_valid.eq(1),
+                    index.eq(index + 1),
+                ]
+                with m.If(unload_valid):
+                    m.d.sync += out_addr.eq(out_addr + NUM_CHANS)
+                with m.If(index == fft_len-1):
+                    m.next = "UNLOAD_LAST"
+
+            with m.State("UNLOAD_LAST"):
+                m.d.comb += proc_busy.eq(1)
+                m.d.sync += [
+                    chan.eq(chan + 1),
+                    index.eq(0),
+                    spec_addr.eq(0),
+                    # the next channel's first sample of the bank
+                    out_addr.eq(out_addr - (block_len-1)*NUM_CHANS + 1),
+                ]
+                m.next = "MAC"
+                with m.If(chan == NUM_CHANS-1):
+                    m.next = "IDLE"
+
+        # output state machine, which reads the next set of the output bank
+        # into the serializer which then sends it out
+        m.submodules.serializer = serializer = SampleSetSerializer(NUM_CHANS)
+        connect(m, serializer.samples_o, flipped(self.samples_o))
+        m.d.comb += [
+            out_r.addr.eq(emit_addr),
+            serializer.shift_data.eq(out_r.data),
+        ]
+
+        chan_counter = Signal(range(NUM_CHANS+1))
+        with m.FSM("IDLE"):
+            with m.State("IDLE"):
+                m.d.comb += emit_idle.eq(serializer.idle)
+                with m.If(emit):
+                    m.d.sync += chan_counter.eq(0)
+                    m.next = "READ"
+
+            with m.State("READ"):
+                # the data comes out the cycle after, and is shifted in from the
+                # top so the first channel ends up at the bottom
+                m.d.sync += chan_counter.eq(chan_counter + 1)
+                with m.If(chan_counter != NUM_CHANS):
+                    m.d.sync += emit_addr.eq(emit_addr + 1)
+                with m.If(chan_counter != 0):
+                    m.d.comb += serializer.shift.eq(1)
+                with m.If(chan_counter == NUM_CHANS):
+                    m.d.comb += serializer.send.eq(1)
+                    m.next = "IDLE"
+
+        return m
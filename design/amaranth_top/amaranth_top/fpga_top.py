@@ -1,5 +1,6 @@
 from amaranth import *
 from amaranth.lib import io
+from amaranth.utils import exact_log2
 from amaranth.lib.wiring import Component, In, Out, connect
 from amaranth.lib.cdc import ResetSynchronizer
 from amaranth.build import Resource, Pins, Attrs
@@ -7,9 +8,9 @@ from amaranth.build import Resource, Pins, Attrs
 from amaranth_boards.de10_nano import DE10NanoPlatform
 
 from .top import Top
-from .constants import MIC_FREQ_HZ, NUM_MICS
+from .constants import (MIC_FREQ_HZ, NUM_MICS, NUM_TAPS, AUDIO_BUS_WIDTH,
+    DSP_CHAIN)
 from .mic import MicCapture
-from .convolve import Convolver
 from .cyclone_v_pll import IntelPLL
 from .axi3_csr import AXI3CSRBridge
 from .cyclone_v_hps import CycloneVHPS
@@ -17,9 +18,14 @@ from .bus import AudioRAMBus
 from .axi3 import AXI3Signature
 
 class AudioAdapter(Component):
-    audio: In(AudioRAMBus())
-    axi: Out(AXI3Signature(addr_width=32, data_width=32, id_width=8,
-        user_width={"aw": 5, "ar": 5}))
+    def __init__(self, data_width=AUDIO_BUS_WIDTH):
+        self._data_width = data_width
+
+        super().__init__({
+            "audio": In(AudioRAMBus(data_width)),
+            "axi": Out(AXI3Signature(addr_width=32, data_width=data_width,
+                id_width=8, user_width={"aw": 5, "ar": 5})),
+        })
 
     def elaborate(self, platform):
         m = Module()
@@ -29,8 +35,10 @@ class AudioAdapter(Component):
 
         m.d.comb += [
             axi.aw.id.eq(0), # always write with id 0
+            axi.aw.addr.eq(audio.addr), # already aligned to the beat size
             axi.aw.len.eq(audio.length),
-            axi.aw.size.eq(0b001), # two bytes at a time
+            # whole bus width at a time
+            axi.aw.size.eq(exact_log2(self._data_width//8)),
             axi.aw.burst.eq(0b01), # burst mode: increment
             # heard vague rumors that these should just all be 1 to activate
             # caching as expected...
@@ -41,8 +49,9 @@ class AudioAdapter(Component):
             axi.aw.valid.eq(audio.addr_valid),
             audio.addr_ready.eq(axi.aw.ready),
 
-            axi.w.data.eq( # route 16 bit data to both 32 bit halves
-                Cat(audio.data, audio.data)),
+            axi.w.data.eq(audio.data),
+            # enable both bytes of each valid sample
+            axi.w.strb.eq(Cat(Cat(l, l) for l in audio.data_lanes)),
             axi.w.valid.eq(audio.data_valid),
             axi.w.last.eq(audio.data_last),
             audio.data_ready.eq(axi.w.ready),
@@ -51,19 +60,6 @@ class AudioAdapter(Component):
             audio.txn_done.eq(axi.b.valid),
         ]
 
-        # transform 16 bit audio bus into 32 bit AXI bus
-        # remove bottom two address bits to stay 32 bit aligned
-        m.d.comb += axi.aw.addr.eq(audio.addr & 0xFFFFFFFC)
-        curr_half = Signal() # 16 bit half of the 32 bit word we're writing
-        with m.If(axi.aw.valid & axi.aw.ready):
-            # latch which half we are writing initially
-            m.d.sync += curr_half.eq(audio.addr[1])
-        with m.If(axi.w.valid & axi.w.ready):
-            # swap halves after every write
-            m.d.sync += curr_half.eq(~curr_half)
-        # set strobes to enable low or high bytes according to current half
-        m.d.comb += axi.w.strb.eq(Mux(curr_half, 0b1100, 0b0011))
-
         # plug off AXI port address write and read data ports
         m.d.comb += [
             axi.ar.valid.eq(0),
@@ -73,6 +69,12 @@ class AudioAdapter(Component):
         return m
 
 class FPGATop(Elaboratable):
+    def __init__(self, *, dsp_chain=DSP_CHAIN, coefficients=None,
+            delay_table=None):
+        self._dsp_chain = dsp_chain
+        self._coefficients = coefficients
+        self._delay_table = delay_table
+
     def elaborate(self, platform):
         m = Module()
 
@@ -143,8 +145,11 @@ class FPGATop(Elaboratable):
             main_pll.add_output(f"{mic_capture_freq} Hz"))
         m.submodules += ResetSynchronizer(reset, domain="mic_capture")
 
-        # set up the convolver domain
-        convolver_freq = MIC_FREQ_HZ * Convolver.REL_FREQ
+        # set up the convolver domain, whose frequency depends on the
+        # coefficients the top module loads
+        top = Top(dsp_chain=self._dsp_chain,
+            coefficients=self._coefficients, delay_table=self._delay_table)
+        convolver_freq = MIC_FREQ_HZ * top.convolver_rel_freq
         # round up to the next multiple of 1MHz so the PLL ratios will be
         # realizable and Quartus won't explode
         convolver_freq = ((convolver_freq//1e6)+1)*1e6
@@ -154,7 +159,7 @@ class FPGATop(Elaboratable):
         m.submodules += ResetSynchronizer(reset, domain="convolver")
 
         # wire up top module
-        m.submodules.top = top = Top()
+        m.submodules.top = top
         m.d.comb += [
             top.button_raw.eq(button),
             blink.eq(top.blink),
@@ -181,7 +186,8 @@ class FPGATop(Elaboratable):
             m.d.comb += top.mic_data_raw[ci].eq(buf.i)
 
         # hook up audio RAM bus to AXI port
-        m.submodules.f2h = f2h = hps.request_fpga2hps_port(data_width=32)
+        m.submodules.f2h = f2h = \
+            hps.request_fpga2hps_port(data_width=AUDIO_BUS_WIDTH)
         m.submodules.audio_adapter = audio_adapter = AudioAdapter()
         connect(m, top.audio_ram, audio_adapter.audio)
         connect(m, audio_adapter.axi, f2h)
@@ -199,8 +205,8 @@ class FPGATop(Elaboratable):
 
         return m
 
-def gen_build():
-    import sys
+def gen_build(build_dir, *, dsp_chain=DSP_CHAIN, coefficients=None,
+        delay_table=None):
     from pathlib import Path
 
     # constraints go in the .sdc file
@@ -227,7 +233,9 @@ def gen_build():
             "hps_secret_dummy_partition_module",
     ]
 
-    plan = DE10NanoPlatform().build(FPGATop(),
+    plan = DE10NanoPlatform().build(
+        FPGATop(dsp_chain=dsp_chain, coefficients=coefficients,
+            delay_table=delay_table),
         add_constraints="\n".join(constraints),
         add_settings="\n".join(settings),
         do_build=False,
@@ -235,7 +243,28 @@ def gen_build():
         # absolute paths!
         strip_internal_attrs=True)
 
-    plan.extract(Path(sys.argv[1]))
+    plan.extract(Path(build_dir))
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="fpga_top",
+        description="Generate the Quartus build for the FPGA design.")
+    parser.add_argument('build_dir', type=str,
+        help="Directory to generate the build in.")
+    parser.add_argument('--dsp-chain', action=argparse.BooleanOptionalAction,
+        default=DSP_CHAIN, help="Sum the convolver lanes through the DSP "
+            f"chain-out adders (default {DSP_CHAIN}).")
+    parser.add_argument('--coefficients', type=str, default=None,
+        help="Coefficient file to build in instead of the default one. Only "
+            f"the FFT engine can have other than {NUM_TAPS} taps.")
+    parser.add_argument('--delay-table', type=str, default=None,
+        help="Table of delays and weights for the delay-and-sum engine, if "
+            "enabled (default passes mics straight through).")
+    args = parser.parse_args()
+
+    gen_build(args.build_dir, dsp_chain=args.dsp_chain,
+        coefficients=args.coefficients, delay_table=args.delay_table)
 
 if __name__ == "__main__":
-    gen_build()
+    main()
@@ -0,0 +1,186 @@
+from amaranth import *
+from amaranth.lib.wiring import Component, In, connect, flipped
+
+from amaranth_soc import csr
+from amaranth_soc.csr import Field
+
+from .constants import CAP_DATA_BITS
+
+# the mean square of each sample moves 1/2**MS_SHIFT of the way towards each
+# new squared sample, a time constant of 4096 samples (85ms at 48KHz)
+MS_SHIFT = 12
+MS_BITS = 2*CAP_DATA_BITS-1 + MS_SHIFT # square of the largest sample, scaled
+PEAK_BITS = CAP_DATA_BITS # magnitude of the largest sample
+CLIP_BITS = 16
+
+# keep levels of each sample in the sets of a stream it watches (but does not
+# drive): the running mean square, the peak magnitude and a count of clipped
+# samples, i.e. those at full scale where the sample was saturated. the host
+# selects a sample, waits for it to be snapshotted, then reads its levels. the
+# peak and clip count are cleared by the snapshot, so they cover the time
+# since the previous one
+class LevelMeter(Component):
+    csr_bus: In(csr.Signature(addr_width=2, data_width=32))
+
+    # stream to watch. valid must only be asserted when a sample is transferred
+    data: In(signed(CAP_DATA_BITS))
+    first: In(1)
+    valid: In(1)
+
+    class Params(csr.Register, access="r"):
+        num: Field(csr.action.R, 16) # samples in each set
+        ms_shift: Field(csr.action.R, 8) # time constant as above
+
+    class Select(csr.Register, access="rw"):
+        # write to snapshot the levels of that sample
+        index: Field(csr.action.W, 16)
+        # set once the levels of the selected sample have been snapshotted
+        done: Field(csr.action.R, 1)
+
+    class Level(csr.Register, access="r"):
+        # mean square of the sample, in units of a squared sample
+        mean_square: Field(csr.action.R, MS_BITS-MS_SHIFT)
+
+    class Peak(csr.Register, access="r"):
+        # largest magnitude of the sample since the last snapshot
+        peak: Field(csr.action.R, PEAK_BITS)
+        # saturating count of the times it clipped since the last snapshot
+        clips: Field(csr.action.R, CLIP_BITS)
+
+    def __init__(self, num):
+        self._num = num
+
+        self._params = self.Params()
+        self._select = self.Select()
+        self._level = self.Level()
+        self._peak = self.Peak()
+
+        csr_sig = self.__annotations__["csr_bus"].signature
+        builder = csr.Builder(
+            addr_width=csr_sig.addr_width, data_width=csr_sig.data_width)
+        builder.add("params", self._params)
+        builder.add("select", self._select)
+        builder.add("level", self._level)
+        builder.add("peak", self._peak)
+
+        self._csr_bridge = csr.Bridge(builder.as_memory_map())
+
+        super().__init__() # initialize component and attributes from signature
+
+        self.csr_bus.memory_map = self._csr_bridge.bus.memory_map
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # bridge containing CSRs
+        m.submodules.csr_bridge = csr_bridge = self._csr_bridge
+        connect(m, flipped(self.csr_bus), csr_bridge.bus)
+
+        m.d.comb += [
+            self._params.f.num.r_data.eq(self._num),
+            self._params.f.ms_shift.r_data.eq(MS_SHIFT),
+        ]
+
+        # levels of each sample, each updated by reading them, then writing
+        # them back the next cycle
+        level_memory = Memory(width=MS_BITS+PEAK_BITS+CLIP_BITS,
+            depth=self._num)
+        m.submodules.level_r = level_r = level_memory.read_port(
+            transparent=False)
+        m.submodules.level_w = level_w = level_memory.write_port()
+        m.d.comb += level_r.en.eq(1) # always reading
+
+        # index of the current sample in its set
+        index = Signal(range(self._num))
+        curr_index = Signal.like(index)
+        m.d.comb += curr_index.eq(Mux(self.first, 0, index + 1))
+        with m.If(self.valid):
+            m.d.sync += index.eq(curr_index)
+
+        # set up the update (or snapshot) and work out the new sample's square,
+        # magnitude and whether it clipped
+        max_val = (1<<(CAP_DATA_BITS-1))-1
+        min_val = -(max_val)-1
+        p1_update = Signal()
+        p1_snap = Signal()
+        p1_addr = Signal.like(level_r.addr)
+        p1_square = Signal(2*CAP_DATA_BITS-1)
+        p1_mag = Signal(PEAK_BITS)
+        p1_clip = Signal()
+        m.d.sync += [
+            p1_update.eq(0),
+            p1_snap.eq(0),
+            p1_addr.eq(level_r.addr),
+            p1_square.eq(self.data * self.data),
+            p1_mag.eq(Mux(self.data < 0, -self.data, self.data)),
+            p1_clip.eq((self.data == max_val) | (self.data == min_val)),
+        ]
+
+        # snapshot requested by the host, taken when there's no sample to
+        # update. the host must select an index less than num
+        snap_pending = Signal()
+        snap_index = Signal(8)
+        with m.If(self.valid):
+            m.d.comb += level_r.addr.eq(curr_index)
+            m.d.sync += p1_update.eq(1)
+        with m.Elif(snap_pending):
+            m.d.comb += level_r.addr.eq(snap_index)
+            m.d.sync += [
+                p1_snap.eq(1),
+                snap_pending.eq(0),
+            ]
+
+        # the levels come out of the RAM the next cycle, unless they were
+        # written last cycle and the RAM doesn't have them yet
+        last_valid = Signal()
+        last_addr = Signal.like(level_w.addr)
+        last_data = Signal.like(level_w.data)
+        m.d.sync += [
+            last_valid.eq(level_w.en),
+            last_addr.eq(level_w.addr),
+            last_data.eq(level_w.data),
+        ]
+        old = Signal.like(level_w.data)
+        m.d.comb += old.eq(Mux(last_valid & (last_addr == p1_addr),
+            last_data, level_r.data))
+        old_ms = old[:MS_BITS]
+        old_peak = old[MS_BITS:][:PEAK_BITS]
+        old_clips = old[MS_BITS+PEAK_BITS:]
+
+        new_ms = Signal(MS_BITS)
+        new_peak = Signal(PEAK_BITS)
+        new_clips = Signal(CLIP_BITS)
+        m.d.comb += [
+            level_w.addr.eq(p1_addr),
+            level_w.data.eq(Cat(new_ms, new_peak, new_clips)),
+            level_w.en.eq(p1_update | p1_snap),
+        ]
+
+        with m.If(p1_snap):
+            # latch the levels for the host and restart the peak and clips
+            m.d.comb += new_ms.eq(old_ms)
+            m.d.sync += [
+                self._level.f.mean_square.r_data.eq(old_ms >> MS_SHIFT),
+                self._peak.f.peak.r_data.eq(old_peak),
+                self._peak.f.clips.r_data.eq(old_clips),
+                self._select.f.done.r_data.eq(1),
+            ]
+        with m.Else():
+            # move the mean square towards the square, as ms += (sq-ms)/2**N
+            # where our ms is scaled up by 2**N
+            m.d.comb += [
+                new_ms.eq(old_ms + p1_square - (old_ms >> MS_SHIFT)),
+                new_peak.eq(Mux(p1_mag > old_peak, p1_mag, old_peak)),
+                new_clips.eq(old_clips +
+                    (p1_clip & (old_clips != (1 << CLIP_BITS)-1))),
+            ]
+
+        # a new request restarts the snapshot
+        with m.If(self._select.f.index.w_stb):
+            m.d.sync += [
+                snap_pending.eq(1),
+                snap_index.eq(self._select.f.index.w_data),
+                self._select.f.done.r_data.eq(0),
+            ]
+
+        return m
@@ -1,6 +1,7 @@
 from amaranth import *
 from amaranth.lib.wiring import Component, In, Out, connect, flipped
 from amaranth.lib.cdc import FFSynchronizer
+from amaranth.utils import ceil_log2
 
 from amaranth_soc import csr
 from amaranth_soc.csr import Field
@@ -11,47 +12,66 @@ from .misc import FFDelay
 
 MIC_DATA_BITS = 24 # each word is a signed 24 bit number
 MIC_FRAME_BITS = 64 # 64 data bits per data frame from the microphone
+# the mic clock (and so the sample rate) can be divided by up to this much
+MIC_MAX_DIVIDER = 8
 
 class MicClockGenerator(Component):
     # generate the microphone clock suitable for wiring to the microphone's
-    # input pins. the generated clock is half the module clock.
+    # input pins. the generated clock is half the module clock divided by
+    # divider+1.
     mic_sck: Out(1)
     mic_ws: Out(1)
+    # pulsed on the cycle after the clock rises, when the mic data is to be
+    # sampled (after FF delay)
+    mic_sck_rose_sync: Out(1)
     # pulsed on the cycle the mic transmits the first frame data bit.
     # (cycle after WS falls, before FF delay) (note also the first data bit is
     # hi-z and these cycles are with reference to the module clock)
     mic_data_sof_sync: Out(1)
 
+    divider: In(range(MIC_MAX_DIVIDER))
+
     def elaborate(self, platform):
         m = Module()
 
         # cycle counter within the frame
         cycle = Signal(range(MIC_FRAME_BITS))
 
-        # toggle clock
-        m.d.sync += self.mic_sck.eq(~self.mic_sck)
-        # bump the cycle counter on the positive edge of the mic cycle
-        with m.If(~self.mic_sck):
-            m.d.sync += cycle.eq(cycle + 1)
+        # count out the module cycles in each half of the mic cycle. the
+        # divider might change at any time, so stop counting at it or past it
+        div_count = Signal(range(MIC_MAX_DIVIDER))
+        tick = Signal()
+        m.d.comb += tick.eq(div_count >= self.divider)
+        m.d.sync += div_count.eq(Mux(tick, 0, div_count + 1))
+
+        with m.If(tick):
+            # toggle clock
+            m.d.sync += self.mic_sck.eq(~self.mic_sck)
+            # bump the cycle counter on the positive edge of the mic cycle
+            with m.If(~self.mic_sck):
+                m.d.sync += cycle.eq(cycle + 1)
+        mic_sck_rose = Signal()
+        m.d.sync += mic_sck_rose.eq(tick & ~self.mic_sck)
 
         # lower word select on falling edge before cycle start
-        with m.If((cycle == MIC_FRAME_BITS-1) & self.mic_sck):
+        with m.If((cycle == MIC_FRAME_BITS-1) & self.mic_sck & tick):
             m.d.sync += self.mic_ws.eq(0)
         # raise word select on falling edge before second half of cycle
-        with m.If((cycle == (MIC_FRAME_BITS//2)-1) & self.mic_sck):
+        with m.If((cycle == (MIC_FRAME_BITS//2)-1) & self.mic_sck & tick):
             m.d.sync += self.mic_ws.eq(1)
 
         mic_data_sof = Signal()
-        m.d.comb += mic_data_sof.eq((cycle == 0) & self.mic_sck)
-        # generate delayed start of frame pulse for input modules due to the
-        # CDC delay they put on the data line
+        m.d.comb += mic_data_sof.eq((cycle == 0) & mic_sck_rose)
+        # generate delayed start of frame and sample pulses for input modules
+        # due to the CDC delay they put on the data line
         m.submodules += FFDelay(mic_data_sof, self.mic_data_sof_sync)
+        m.submodules += FFDelay(mic_sck_rose, self.mic_sck_rose_sync)
 
         return m
 
 class MicDataReceiver(Component):
     # receive data from a microphone
-    mic_sck: In(1)
+    mic_sck_rose_sync: In(1)
     mic_data_raw: In(1)
     mic_data_sof_sync: In(1)
 
@@ -74,7 +94,7 @@ class MicDataReceiver(Component):
 
         buffer = Signal(MIC_FRAME_BITS)
         # shift in new data on rising edge of clock into the MSB of buffer
-        with m.If(self.mic_sck):
+        with m.If(self.mic_sck_rose_sync):
             m.d.sync += buffer.eq(Cat(buffer[1:], Mux(
                 self.use_fake_mic, fake_data_sync, mic_data_sync)))
 
@@ -91,7 +111,6 @@ class MicDataReceiver(Component):
 
 class FakeMic(Component):
     # fake microphone output data in accordance with timing diagrams
-    # (assumes mic_sck is half "sync"'s clock rate)
     mic_sck: In(1)
     mic_ws: In(1)
 
@@ -201,6 +220,7 @@ class MicCaptureRegs(Component):
     # settings, synced to mic capture domain (given by o_domain)
     gain: Out(8)
     use_fake_mics: Out(1)
+    divider: Out(range(MIC_MAX_DIVIDER))
 
     class Gain(csr.Register, access="rw"):
         gain: Field(csr.action.RW, 8)
@@ -208,17 +228,24 @@ class MicCaptureRegs(Component):
     class FakeMics(csr.Register, access="rw"):
         use_fake_mics: Field(csr.action.RW, 1)
 
+    class Divider(csr.Register, access="rw"):
+        # the sample rate is the maximum divided by divider+1. the switch is
+        # nowhere near clean
+        divider: Field(csr.action.RW, ceil_log2(MIC_MAX_DIVIDER))
+
     def __init__(self, *, o_domain):
         self._o_domain = o_domain
 
         self._gain = self.Gain()
         self._fake_mics = self.FakeMics()
+        self._divider = self.Divider()
 
         csr_sig = self.__annotations__["csr_bus"].signature
         builder = csr.Builder(
             addr_width=csr_sig.addr_width, data_width=csr_sig.data_width)
         builder.add("gain", self._gain)
         builder.add("fake_mics", self._fake_mics)
+        builder.add("divider", self._divider)
 
         self._csr_bridge = csr.Bridge(builder.as_memory_map())
 
@@ -237,6 +264,8 @@ class MicCaptureRegs(Component):
             o_domain=self._o_domain)
         m.submodules += FFSynchronizer(self._fake_mics.f.use_fake_mics.data,
             self.use_fake_mics, o_domain=self._o_domain)
+        m.submodules += FFSynchronizer(self._divider.f.divider.data,
+            self.divider, o_domain=self._o_domain)
 
         return m
 
@@ -248,11 +277,12 @@ class MicCapture(Component):
     # settings, synced to our domain
     gain: In(8)
     use_fake_mics: In(1)
+    divider: In(range(MIC_MAX_DIVIDER))
 
     samples: Out(SampleStream())
 
-    # frequency relative to the microphone sample frequency (i.e. multiply that
-    # by this to get the expected operation frequency)
+    # frequency relative to the (maximum) microphone sample frequency (i.e.
+    # multiply that by this to get the expected operation frequency)
     # generated bit clock is half the module clock so we need to double
     REL_FREQ = 2*MIC_FRAME_BITS
 
@@ -264,6 +294,7 @@ class MicCapture(Component):
         m.d.comb += [
             self.mic_sck.eq(clk_gen.mic_sck),
             self.mic_ws.eq(clk_gen.mic_ws),
+            clk_gen.divider.eq(self.divider),
         ]
 
         # set up fake microphones for testing purposes
@@ -302,7 +333,8 @@ class MicCapture(Component):
             sample_out.extend((sample_r, sample_l))
 
             m.d.comb += [
-                mic_rx.mic_sck.eq(clk_gen.mic_sck), # data in
+                # data in
+                mic_rx.mic_sck_rose_sync.eq(clk_gen.mic_sck_rose_sync),
                 mic_rx.mic_data_sof_sync.eq(clk_gen.mic_data_sof_sync),
                 mic_rx.mic_data_raw.eq(self.mic_data_raw[mi//2]),
 
@@ -381,7 +413,7 @@ class MicDemo(Component):
 
         # wire clock to data receiver
         m.d.comb += [
-            mic_rcv.mic_sck.eq(mic_clk.mic_sck),
+            mic_rcv.mic_sck_rose_sync.eq(mic_clk.mic_sck_rose_sync),
             mic_rcv.mic_data_sof_sync.eq(mic_clk.mic_data_sof_sync),
         ]
 
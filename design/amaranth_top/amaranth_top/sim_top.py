@@ -5,7 +5,6 @@ from amaranth.sim.core import Simulator
 from .top import Top
 from .constants import MIC_FREQ_HZ
 from .mic import MicCapture
-from .convolve import Convolver
 from .bus import FakeAudioRAMBusWriteReceiver
 
 class SimTop(Elaboratable):
@@ -28,7 +27,7 @@ def run_sim():
     sim = Simulator(sim_top)
     sim.add_clock(1/50e6, domain="sync")
     sim.add_clock(1/(MIC_FREQ_HZ*MicCapture.REL_FREQ), domain="mic_capture")
-    sim.add_clock(1/(MIC_FREQ_HZ*Convolver.REL_FREQ), domain="convolver")
+    sim.add_clock(1/(MIC_FREQ_HZ*top.convolver_rel_freq), domain="convolver")
 
     # feed some data to the mic after a bit
     def mic_proc():
@@ -56,7 +55,7 @@ def run_sim():
             yield
 
         # request a buffer switch
-        yield from write(2, 1)
+        yield from write(16+2, 1)
 
         for _ in range(50):
             yield
@@ -69,7 +68,13 @@ def run_sim():
 
         # request to write raw mic data
         yield from write(4, 0) # and turn gain back down to see that accurately
-        yield from write(10, 1)
+        yield from write(96+2, 1)
+
+        for _ in range(2048):
+            yield
+
+        # request to stream into the ring buffer
+        yield from write(16+4, 1)
 
     sim.add_sync_process(mic_proc, domain="sync")
     sim.add_sync_process(reg_proc, domain="sync")
@@ -0,0 +1,120 @@
+import argparse
+
+from amaranth import *
+from amaranth.lib.wiring import Component, Out, connect
+from amaranth.sim import Simulator
+
+from .constants import NUM_CHANS, AUDIO_BUS_WIDTH
+from .stream import SampleStream, SampleWriter
+from .bus import FakeAudioRAMBusWriteReceiver
+
+# endlessly supplies sets of samples as fast as they are accepted
+class SampleSource(Component):
+    samples: Out(SampleStream())
+
+    def __init__(self, set_len):
+        super().__init__()
+
+        self._set_len = set_len
+
+    def elaborate(self, platform):
+        m = Module()
+
+        index = Signal(range(self._set_len))
+        m.d.comb += [
+            self.samples.valid.eq(1),
+            self.samples.first.eq(index == 0),
+        ]
+        with m.If(self.samples.ready):
+            m.d.sync += [
+                self.samples.data.eq(self.samples.data + 1),
+                index.eq(Mux(index == self._set_len-1, 0, index + 1)),
+            ]
+
+        return m
+
+class SimWriter(Elaboratable):
+    def __init__(self, *, latency, burst_beats, max_bursts, set_len):
+        self.source = SampleSource(set_len)
+        self.writer = SampleWriter(
+            burst_beats=burst_beats, max_bursts=max_bursts)
+        self.fake_rx = FakeAudioRAMBusWriteReceiver(latency=latency)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.source = source = self.source
+        m.submodules.writer = writer = self.writer
+        m.submodules.fake_rx = fake_rx = self.fake_rx
+
+        connect(m, source.samples, writer.samples)
+        connect(m, writer.audio_ram, fake_rx.audio_ram)
+
+        return m
+
+def run_sim(*, latency=128, burst_beats=16, max_bursts=4, cycles=20000,
+        set_len=NUM_CHANS):
+    sim_writer = SimWriter(latency=latency, burst_beats=burst_beats,
+        max_bursts=max_bursts, set_len=set_len)
+    sim = Simulator(sim_writer)
+    sim.add_clock(1/50e6, domain="sync")
+
+    abus = sim_writer.writer.audio_ram
+    samples = sim_writer.source.samples
+    results = {}
+
+    async def count_proc(ctx):
+        beats = 0
+        addrs = 0
+        accepted = 0
+        async for _, _, av, ar, dv, dr, v, r in ctx.tick().sample(
+                abus.addr_valid, abus.addr_ready,
+                abus.data_valid, abus.data_ready,
+                samples.valid, samples.ready):
+            addrs += av & ar
+            beats += dv & dr
+            accepted += v & r
+            results.update(beats=beats, bursts=addrs, samples=accepted)
+
+    async def bench(ctx):
+        await ctx.tick().repeat(cycles)
+
+    sim.add_process(count_proc)
+    sim.add_testbench(bench)
+    sim.run()
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sample "
+        "writer against a fake receiver with a given response latency.")
+    # at short latencies one burst in flight already keeps up with the
+    # source, so default to ones long enough for more in flight to matter
+    parser.add_argument("-l", "--latency", type=int, nargs="+",
+        default=[128, 256],
+        help="cycles from the end of a burst until its response")
+    parser.add_argument("-b", "--burst-beats", type=int, default=16,
+        help="beats in each full burst (power of two, at most 16)")
+    parser.add_argument("-n", "--max-bursts", type=int, nargs="+",
+        default=[1, 4], help="bursts which may be in flight at once")
+    parser.add_argument("-c", "--cycles", type=int, default=20000,
+        help="cycles to simulate")
+    args = parser.parse_args()
+
+    # the source supplies one sample per cycle, which the bus can't take
+    # faster than this
+    lanes = AUDIO_BUS_WIDTH//16
+    print(f"{AUDIO_BUS_WIDTH} bit bus, {lanes} samples per beat, "
+        f"{args.burst_beats} beat bursts, "
+        f"input limit {1/lanes:.3f} beats/cycle")
+    for latency in args.latency:
+        for max_bursts in args.max_bursts:
+            r = run_sim(latency=latency, burst_beats=args.burst_beats,
+                max_bursts=max_bursts, cycles=args.cycles)
+            print(f"latency {latency:4d}, {max_bursts:2d} in flight: "
+                f"{r['beats']/args.cycles:.3f} beats/cycle, "
+                f"{r['samples']/args.cycles:.3f} samples/cycle "
+                f"({r['bursts']} bursts)")
+
+if __name__ == "__main__":
+    main()
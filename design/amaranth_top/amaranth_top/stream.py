@@ -1,6 +1,8 @@
 from amaranth import *
 from amaranth.lib.wiring import Component, In, Out, Signature, connect, flipped
-from amaranth.lib.fifo import AsyncFIFO
+from amaranth.lib.fifo import AsyncFIFO, SyncFIFOBuffered
+from amaranth.lib.cdc import PulseSynchronizer
+from amaranth.utils import exact_log2
 
 from amaranth_soc import csr
 from amaranth_soc.csr import Field
@@ -25,12 +27,24 @@ class SampleStreamFIFO(Component):
 
     samples_count: Out(32)
 
-    def __init__(self, *, w_domain, r_domain="sync", depth=512):
+    # pulsed in the sync domain when a set of samples is dropped
+    frame_dropped: Out(1)
+
+    def __init__(self, *, w_domain, r_domain="sync", depth=512, frame_len=None):
         super().__init__()
 
-        self._fifo = AsyncFIFO(
-            width=1+CAP_DATA_BITS, depth=depth,
-            r_domain=r_domain, w_domain=w_domain)
+        self._w_domain = w_domain
+        # if given, sets of samples which won't fit are dropped entirely instead
+        # of stalling the writer and giving the reader a partial set
+        self._frame_len = frame_len
+
+        if w_domain == r_domain: # no need to cross domains
+            self._fifo = DomainRenamer(w_domain)(SyncFIFOBuffered(
+                width=1+CAP_DATA_BITS, depth=depth))
+        else:
+            self._fifo = AsyncFIFO(
+                width=1+CAP_DATA_BITS, depth=depth,
+                r_domain=r_domain, w_domain=w_domain)
 
     def elaborate(self, platform):
         m = Module()
@@ -39,8 +53,6 @@ class SampleStreamFIFO(Component):
         m.d.comb += [
             # write data
             fifo.w_data.eq(Cat(self.samples_w.data, self.samples_w.first)),
-            fifo.w_en.eq(self.samples_w.valid & self.samples_w.ready),
-            self.samples_w.ready.eq(fifo.w_rdy),
 
             # read data
             Cat(self.samples_r.data, self.samples_r.first).eq(fifo.r_data),
@@ -49,14 +61,216 @@ class SampleStreamFIFO(Component):
             self.samples_count.eq(fifo.r_level),
         ]
 
+        if self._frame_len is None:
+            m.d.comb += [
+                fifo.w_en.eq(self.samples_w.valid & self.samples_w.ready),
+                self.samples_w.ready.eq(fifo.w_rdy),
+            ]
+            return m
+
+        # decide at the start of each set whether the whole thing will fit. the
+        # write side level is conservative so if it fits now it always will
+        frame_fits = Signal()
+        m.d.comb += frame_fits.eq(fifo.w_level <= fifo.depth - self._frame_len)
+        dropping = Signal() # dropping the rest of the current set
+        discard = Signal() # discard the current word
+        # ready must not depend on valid, as a fork feeding several of these
+        # makes each output's valid depend on the others' ready
+        with m.If(self.samples_w.first):
+            m.d.comb += discard.eq(~frame_fits)
+        with m.Else():
+            m.d.comb += discard.eq(dropping)
+        with m.If(self.samples_w.valid & self.samples_w.first):
+            m.d[self._w_domain] += dropping.eq(~frame_fits)
+
+        m.d.comb += [
+            fifo.w_en.eq(self.samples_w.valid & ~discard),
+            self.samples_w.ready.eq(discard | fifo.w_rdy),
+        ]
+
+        # let the world know (in the sync domain) about the dropped set
+        frame_dropped = Signal()
+        m.d.comb += frame_dropped.eq(
+            self.samples_w.valid & self.samples_w.first & ~frame_fits)
+        if self._w_domain == "sync":
+            m.d.comb += self.frame_dropped.eq(frame_dropped)
+        else:
+            m.submodules.dropped_sync = dropped_sync = PulseSynchronizer(
+                i_domain=self._w_domain, o_domain="sync")
+            m.d.comb += [
+                dropped_sync.i.eq(frame_dropped),
+                self.frame_dropped.eq(dropped_sync.o),
+            ]
+
+        return m
+
+# send each set of samples to every enabled output. an output only receives
+# whole sets as the enables are latched at the start of each set
+class SampleStreamFork(Component):
+    def __init__(self, num_outputs):
+        self._num_outputs = num_outputs
+
+        super().__init__({
+            "samples_i": In(SampleStream()),
+            "samples_o": Out(SampleStream()).array(num_outputs),
+
+            # bit N set to send sets to output N
+            "enable": In(num_outputs),
+        })
+
+    def elaborate(self, platform):
+        m = Module()
+
+        samples_i = self.samples_i
+
+        enable = Signal.like(self.enable) # enables latched for the current set
+        curr_enable = Signal.like(enable)
+        m.d.comb += curr_enable.eq(Mux(samples_i.first, self.enable, enable))
+        with m.If(samples_i.valid & samples_i.ready):
+            m.d.sync += enable.eq(curr_enable)
+
+        # each enabled output must be ready before the sample goes to any
+        ready = Signal(self._num_outputs)
+        for oi, samples_o in enumerate(self.samples_o):
+            m.d.comb += ready[oi].eq(~curr_enable[oi] | samples_o.ready)
+        m.d.comb += samples_i.ready.eq(ready.all())
+
+        for oi, samples_o in enumerate(self.samples_o):
+            others = Cat(ready[:oi], ready[oi+1:])
+            m.d.comb += [
+                samples_o.data.eq(samples_i.data),
+                samples_o.first.eq(samples_i.first),
+                samples_o.valid.eq(
+                    samples_i.valid & curr_enable[oi] & others.all()),
+            ]
+
+        return m
+
+# pass through only the samples of each set selected by the mask
+class SampleStreamMask(Component):
+    def __init__(self, set_len):
+        self._set_len = set_len
+
+        super().__init__({
+            "samples_i": In(SampleStream()),
+            "samples_o": Out(SampleStream()),
+
+            # bit N set to pass sample N of each set. latched at the start of
+            # each set so the sets stay consistent
+            "mask": In(set_len, init=(1 << set_len)-1),
+        })
+
+    def elaborate(self, platform):
+        m = Module()
+
+        samples_i = self.samples_i
+        samples_o = self.samples_o
+
+        index = Signal(range(self._set_len)) # index of the sample in its set
+        mask = Signal.like(self.mask) # mask latched for the current set
+        need_first = Signal() # no sample of the current set passed yet
+
+        curr_index = Signal.like(index)
+        curr_mask = Signal.like(mask)
+        curr_need_first = Signal()
+        m.d.comb += [
+            curr_index.eq(Mux(samples_i.first, 0, index)),
+            curr_mask.eq(Mux(samples_i.first, self.mask, mask)),
+            curr_need_first.eq(samples_i.first | need_first),
+        ]
+
+        selected = Signal()
+        m.d.comb += [
+            selected.eq(curr_mask.bit_select(curr_index, 1)),
+
+            samples_o.data.eq(samples_i.data),
+            samples_o.first.eq(curr_need_first),
+            samples_o.valid.eq(samples_i.valid & selected),
+            # unselected samples are thrown away
+            samples_i.ready.eq(samples_o.ready | ~selected),
+        ]
+
+        with m.If(samples_i.valid & samples_i.ready):
+            m.d.sync += [
+                index.eq(curr_index + 1),
+                mask.eq(curr_mask),
+                need_first.eq(curr_need_first & ~selected),
+            ]
+
+        return m
+
+# send a set of samples (e.g. one per channel) out as a stream, first sample of
+# the set first. the set is latched all at once, or shifted in a sample at a
+# time by engines that produce it that way
+class SampleSetSerializer(Component):
+    def __init__(self, set_len):
+        self._set_len = set_len
+
+        super().__init__({
+            "samples_o": Out(SampleStream()),
+
+            # latch the set from `data` and start sending it
+            "load": In(1),
+            "data": In(signed(CAP_DATA_BITS)).array(set_len),
+            # shift `shift_data` in as the last sample of the set, moving the
+            # others towards the first. `send` starts sending the set,
+            # including a sample shifted in on the same cycle
+            "shift": In(1),
+            "shift_data": In(CAP_DATA_BITS),
+            "send": In(1),
+
+            # nothing is being sent. the inputs are ignored otherwise
+            "idle": Out(1),
+        })
+
+    def elaborate(self, platform):
+        m = Module()
+
+        samples_o = self.samples_o
+
+        # shift out all the sample data in sequence through the buffer
+        sample_buf = Signal(self._set_len*CAP_DATA_BITS)
+        # we shift the lower bits out
+        m.d.comb += samples_o.data.eq(sample_buf[:CAP_DATA_BITS])
+
+        counter = Signal(range(self._set_len))
+        with m.FSM("IDLE"):
+            with m.State("IDLE"):
+                m.d.comb += self.idle.eq(1)
+                with m.If(self.load):
+                    m.d.sync += sample_buf.eq(Cat(*self.data))
+                with m.Elif(self.shift):
+                    m.d.sync += sample_buf.eq(
+                        Cat(sample_buf[CAP_DATA_BITS:], self.shift_data))
+
+                with m.If(self.load | self.send):
+                    m.d.sync += [
+                        counter.eq(self._set_len-1), # reset output counter
+                        samples_o.first.eq(1), # prime first output flag
+                    ]
+                    m.next = "OUTPUT"
+
+            with m.State("OUTPUT"):
+                m.d.comb += samples_o.valid.eq(1)
+
+                with m.If(samples_o.ready):
+                    # shift out the next sample, which is not the first
+                    m.d.sync += [
+                        sample_buf.eq(sample_buf >> CAP_DATA_BITS),
+                        samples_o.first.eq(0),
+                        counter.eq(counter-1),
+                    ]
+
+                    with m.If(counter == 0): # last sample
+                        m.next = "IDLE"
+
         return m
 
 class SampleWriter(Component):
     samples: In(SampleStream())
-    samples_count: In(32)
 
     audio_ram: Out(AudioRAMBus())
-    csr_bus: In(csr.Signature(addr_width=2, data_width=32))
+    csr_bus: In(csr.Signature(addr_width=4, data_width=32))
 
     status_leds: Out(3)
 
@@ -75,11 +289,68 @@ class SampleWriter(Component):
         # last address in the buffer swapped from
         last_addr: Field(csr.action.R, 32)
 
-    def __init__(self):
+    class RingCtrl(csr.Register, access="rw"):
+        # request ring buffer mode. takes effect (and restarts the ring) at the
+        # start of the next set of samples, same as a swap
+        enable: Field(csr.action.RW, 1)
+        active: Field(csr.action.R, 1) # ring buffer mode currently active
+
+    class RingPos(csr.Register, access="r"):
+        # address just past the last sample written into the ring, along with
+        # the low bits of the wrap count so both can be read atomically
+        addr: Field(csr.action.R, 24)
+        wraps: Field(csr.action.R, 8)
+
+    class RingWraps(csr.Register, access="r"):
+        # number of times the ring has wrapped since it was (re)started
+        wraps: Field(csr.action.R, 32)
+
+    class RingRead(csr.Register, access="w"):
+        # position the host has read the ring up to (along with the LSB of its
+        # wrap count) so we know how much room is left
+        addr: Field(csr.action.W, 25)
+
+    class Overflow(csr.Register, access="rw"):
+        # set when we run out of room and drop a set of samples, write 1 to
+        # clear
+        overflow: Field(csr.action.RW1C, 1)
+
+    class Dropped(csr.Register, access="r"):
+        # saturating count of sets of samples dropped due to lack of room
+        count: Field(csr.action.R, 32)
+
+    def __init__(self, *, region_addr=0xBF00_0000, region_bits=24,
+            burst_beats=16, max_bursts=4):
+        # we write into a region of 2**region_bits bytes at region_addr (by
+        # default the 16MiB audio area thru ACP), either as two halves or as
+        # one big ring
+        if region_bits < 16 or region_bits > 24:
+            raise ValueError(f"unsupported region_bits {region_bits}")
+        if region_addr & ((1 << region_bits)-1):
+            raise ValueError("region_addr must be aligned to the region size")
+        self._region_addr = region_addr
+        self._region_bits = region_bits
+
+        # bursts are aligned to their size, so as long as they are no longer
+        # than the AXI3 maximum of 16 beats they can't cross a 4K page
+        if burst_beats not in (1, 2, 4, 8, 16):
+            raise ValueError(f"unsupported burst_beats {burst_beats}")
+        if max_bursts < 1:
+            raise ValueError(f"max_bursts must be positive, not {max_bursts}")
+        self._burst_beats = burst_beats
+        # bursts which may be in flight (sent but not yet acknowledged) at once
+        self._max_bursts = max_bursts
+
         self._test = self.Test()
         self._dummy = self.Dummy()
         self._swap_state = self.SwapState()
         self._swap_addr = self.SwapAddr()
+        self._ring_ctrl = self.RingCtrl()
+        self._ring_pos = self.RingPos()
+        self._ring_wraps = self.RingWraps()
+        self._ring_read = self.RingRead()
+        self._overflow = self.Overflow()
+        self._dropped = self.Dropped()
 
         csr_sig = self.__annotations__["csr_bus"].signature
         builder = csr.Builder(
@@ -88,6 +359,12 @@ class SampleWriter(Component):
         builder.add("dummy", self._dummy)
         builder.add("swap_state", self._swap_state)
         builder.add("swap_addr", self._swap_addr)
+        builder.add("ring_ctrl", self._ring_ctrl)
+        builder.add("ring_pos", self._ring_pos)
+        builder.add("ring_wraps", self._ring_wraps)
+        builder.add("ring_read", self._ring_read)
+        builder.add("overflow", self._overflow)
+        builder.add("dropped", self._dropped)
 
         self._csr_bridge = csr.Bridge(builder.as_memory_map())
 
@@ -102,87 +379,330 @@ class SampleWriter(Component):
         m.submodules.csr_bridge = csr_bridge = self._csr_bridge
         connect(m, flipped(self.csr_bus), csr_bridge.bus)
 
-        swap_desired = Signal() # the host desires a swap
-        m.d.comb += swap_desired.eq(self._swap_state.f.swap.data)
+        abus = self.audio_ram
+
+        # each bus beat carries several samples, and bursts are a whole number
+        # of beats aligned to their size so they never cross a 4K page
+        LANES = len(abus.data_lanes) # samples per beat
+        BEAT_BITS = exact_log2(2*LANES) # log2 of bytes per beat
+        BURST_BEATS = self._burst_beats
+        BURST_BITS = BEAT_BITS + exact_log2(BURST_BEATS)
+
+        # in ring buffer mode we fill the whole 16MiB area and wrap around
+        # instead of filling one half and waiting for the host to swap
+        ring_active = Signal()
+        ring_desired = self._ring_ctrl.f.enable.data
+        ring_wraps = Signal(32) # times the ring has wrapped
+
+        # we've swapped buffers but the last of the old buffer's data hasn't
+        # landed in memory yet, so the host can't be told
+        swap_pending = Signal()
+
+        swap_desired = Signal() # the host desires a swap (or a mode change)
+        m.d.comb += swap_desired.eq(~swap_pending &
+            (self._swap_state.f.swap.data | (ring_desired != ring_active)))
+
+        # the host tells us how far it has read the ring so we don't overwrite
+        # data it hasn't gotten to yet
+        REGION_BITS = self._region_bits
+        ring_read = Signal(REGION_BITS+1) # (address, LSB of wrap count)
+        with m.If(self._ring_read.f.addr.w_stb & ~swap_pending):
+            m.d.sync += ring_read.eq(self._ring_read.f.addr.w_data)
 
         curr_buf = Signal(1) # current buffer we're filling
-        # we are swapping (swap is desired and the current FIFO word is the
-        # start of a new set, so no more addr increments or FIFO acks)
-        swapping = Signal(1)
-
-        # write words from the stream when available
-        BURST_BEATS = 16
-        buf_addr = Signal(23) # 8MiB buffer
-        burst_counter = Signal(range(max(1, BURST_BEATS-1)))
-        m.d.comb += self.audio_ram.data.eq(self.samples.data)
-        # first flag is set and a swap is desired by the host
-        m.d.comb += swapping.eq(
-            self.samples.valid & self.samples.first & swap_desired)
-        with m.FSM("IDLE"):
-            with m.State("IDLE"):
-                with m.If(self.samples_count >= BURST_BEATS): # enough data?
-                    m.d.sync += [
-                        # write address (audio area thru ACP)
-                        self.audio_ram.addr.eq(
-                            Cat(buf_addr, curr_buf, Const(0xBF, 8))),
-                        self.audio_ram.length.eq(BURST_BEATS-1),
-                        # address signals are valid
-                        self.audio_ram.addr_valid.eq(1),
-                    ]
-                    m.next = "AWAIT"
+        buf_addr = Signal(REGION_BITS) # half the region (or the whole ring)
+
+        # we are full if there is not enough space left to finish the current
+        # set of samples and burst. this margin is plenty for that
+        FULL_MARGIN = 4096
+        ring_used = Signal(REGION_BITS+1) # bytes written the host hasn't read
+        m.d.comb += ring_used.eq(Cat(buf_addr, ring_wraps[0]) - ring_read)
+        full = Signal()
+        with m.If(ring_active):
+            m.d.comb += full.eq(ring_used > (1 << REGION_BITS) - FULL_MARGIN)
+        with m.Else():
+            m.d.comb += full.eq(
+                buf_addr > (1 << (REGION_BITS-1)) - FULL_MARGIN)
+
+        # we are stopping (swap is desired or we are full and the current FIFO
+        # word is the start of a new set, so no more addr increments or FIFO
+        # acks)
+        stopping = Signal(1)
+        m.d.comb += stopping.eq(self.samples.valid & self.samples.first &
+            (swap_desired | full))
+
+        # sets of samples thrown away because we are full
+        dropped = Signal() # pulsed when a set is dropped
+        dropped_count = Signal(32)
+        m.d.comb += [
+            self._overflow.f.overflow.set.eq(dropped),
+            self._dropped.f.count.r_data.eq(dropped_count),
+        ]
+        with m.If(dropped & (dropped_count != 0xFFFF_FFFF)): # saturate
+            m.d.sync += dropped_count.eq(dropped_count + 1)
+
+        # beats of data ready to go out on the bus, along with which samples in
+        # each are valid
+        m.submodules.beat_fifo = beat_fifo = SyncFIFOBuffered(
+            width=len(abus.data)+LANES, depth=2*BURST_BEATS)
+
+        # bursts of beats ready to be written, along with what to tell the host
+        # once they have landed in memory
+        def burst_fields():
+            return {
+                "addr": Signal(32), # address of first beat
+                "length": Signal(4), # beats in burst - 1
+                "has_data": Signal(), # clear if there is only a swap to finish
+                "end_addr": Signal.like(buf_addr), # address past last sample
+                "wraps": Signal(32), # ring wrap count past the last sample
+                "swap": Signal(), # the buffer is swapped after this burst
+                "last_buf": Signal(), # buffer swapped from
+                "ring": Signal(), # ring buffer mode after the swap
+            }
+        burst_i, burst_o = burst_fields(), burst_fields()
+        m.submodules.burst_fifo = burst_fifo = SyncFIFOBuffered(
+            width=len(Cat(*burst_i.values())), depth=4)
+        m.d.comb += [
+            burst_fifo.w_data.eq(Cat(*burst_i.values())),
+            Cat(*burst_o.values()).eq(burst_fifo.r_data),
+        ]
 
-            with m.State("AWAIT"):
-                with m.If(self.audio_ram.addr_ready):
-                    m.d.sync += [
-                        # deassert address valid
-                        self.audio_ram.addr_valid.eq(0),
-                        # our data is always valid
-                        self.audio_ram.data_valid.eq(1),
-                        # init burst
-                        burst_counter.eq(BURST_BEATS-1),
-                        # toggle LED
-                        self.status_leds[0].eq(~self.status_leds[0]),
-                    ]
-                    m.next = "BURST"
+        # address in memory of the current sample and its beat
+        sample_addr = Signal(32)
+        region = Const(self._region_addr >> REGION_BITS, 32-REGION_BITS)
+        m.d.comb += sample_addr.eq(Mux(ring_active,
+            Cat(buf_addr, region),
+            Cat(buf_addr[:-1], curr_buf, region)))
+        beat_addr = Signal(32)
+        m.d.comb += beat_addr.eq(
+            Cat(Const(0, BEAT_BITS), sample_addr[BEAT_BITS:]))
+
+        # beat currently being assembled from samples
+        beat_data = Signal(len(abus.data))
+        beat_lanes = Signal(LANES)
+        lane = buf_addr[1:BEAT_BITS] # lane the current sample goes into
+        next_data = Signal.like(beat_data) # beat with the current sample
+        next_lanes = Signal.like(beat_lanes)
+        m.d.comb += [
+            next_data.eq(beat_data),
+            next_data.word_select(lane, 16).eq(self.samples.data),
+            next_lanes.eq(beat_lanes | (1 << lane)),
+        ]
 
-            with m.State("BURST"):
-                with m.If(burst_counter == 0):
-                    m.d.comb += self.audio_ram.data_last.eq(1)
+        # burst currently being assembled from beats
+        burst_open = Signal()
+        burst_addr = Signal(32)
+        burst_beats = Signal(range(BURST_BEATS+1)) # beats already queued
+        beats_so_far = Signal.like(burst_beats)
+        m.d.comb += beats_so_far.eq(Mux(burst_open, burst_beats, 0))
 
-                with m.If(self.audio_ram.data_ready):
-                    with m.If(~swapping):
-                        m.d.comb += self.samples.ready.eq(1) # FIFO ack
-                        m.d.sync += buf_addr.eq(buf_addr + 2) # bump write addr
+        next_addr = Signal.like(buf_addr)
+        next_wraps = Signal(32)
+        m.d.comb += [
+            # only wraps in ring mode, as we stop at the end of the half buffer
+            next_addr.eq(buf_addr + 2),
+            next_wraps.eq(ring_wraps + (buf_addr == (1 << REGION_BITS) - 2)),
+
+            beat_fifo.w_data.eq(Cat(next_data, next_lanes)),
+
+            burst_i["addr"].eq(Mux(burst_open, burst_addr, beat_addr)),
+            burst_i["length"].eq(beats_so_far),
+            burst_i["has_data"].eq(1),
+            burst_i["end_addr"].eq(next_addr),
+            burst_i["wraps"].eq(next_wraps),
+            burst_i["last_buf"].eq(curr_buf),
+            burst_i["ring"].eq(ring_desired),
+        ]
 
-                    m.d.sync += burst_counter.eq(burst_counter-1)
-                    with m.If(burst_counter == 0):
+        def swap():
+            m.d.sync += [
+                curr_buf.eq(~curr_buf), # swap to next buffer
+                buf_addr.eq(0), # reset the address to start
+
+                # switch modes if requested and restart the ring
+                ring_active.eq(ring_desired),
+                ring_wraps.eq(0),
+                ring_read.eq(0),
+
+                # wait for the old buffer to land before telling the host
+                swap_pending.eq(1),
+            ]
+
+        # pack samples from the stream into beats and bursts
+        with m.FSM("RUN"):
+            with m.State("RUN"):
+                with m.If(self.samples.valid &
+                        beat_fifo.w_rdy & burst_fifo.w_rdy):
+                    with m.If(stopping):
+                        # queue up whatever we have of the current beat and
+                        # burst, along with the swap if that's why we stopped
+                        m.d.comb += [
+                            beat_fifo.w_data.eq(Cat(beat_data, beat_lanes)),
+                            beat_fifo.w_en.eq(beat_lanes.any()),
+                            burst_i["length"].eq(
+                                burst_beats + beat_lanes.any() - 1),
+                            burst_i["has_data"].eq(burst_open),
+                            burst_i["end_addr"].eq(buf_addr),
+                            burst_i["wraps"].eq(ring_wraps),
+                            burst_i["swap"].eq(swap_desired),
+                            burst_fifo.w_en.eq(burst_open | swap_desired),
+                        ]
                         m.d.sync += [
-                            # deassert valid
-                            self.audio_ram.data_valid.eq(0),
-                            # toggle LED
-                            self.status_leds[1].eq(~self.status_leds[1]),
+                            beat_lanes.eq(0),
+                            burst_open.eq(0),
                         ]
-                        m.next = "TWAIT"
 
-            with m.State("TWAIT"):
-                with m.If(self.audio_ram.txn_done):
-                    # toggle LED
-                    m.d.sync += self.status_leds[2].eq(~self.status_leds[2])
+                        # it's time to do the swap? then do it
+                        with m.If(swap_desired):
+                            swap()
+                        with m.Else(): # no room left, start dropping data
+                            m.next = "DISCARD"
 
-                    # it's time to finalize the swap? then do it
-                    with m.If(swapping):
+                    with m.Else():
+                        m.d.comb += self.samples.ready.eq(1) # FIFO ack
                         m.d.sync += [
-                            curr_buf.eq(~curr_buf), # swap to next buffer
-                            buf_addr.eq(0), # reset the address to start
-
-                            # save address for host
-                            self._swap_addr.f.last_addr.r_data.eq(buf_addr),
-                            # and the buffer it's for
-                            self._swap_state.f.last_buf.r_data.eq(curr_buf),
+                            buf_addr.eq(next_addr),
+                            ring_wraps.eq(next_wraps),
                         ]
-                        # acknowledge swap
-                        m.d.comb += self._swap_state.f.swap.clear.eq(1)
+                        with m.If(~burst_open):
+                            m.d.sync += [
+                                burst_open.eq(1),
+                                burst_addr.eq(beat_addr),
+                                burst_beats.eq(0),
+                            ]
+
+                        with m.If(buf_addr[1:BEAT_BITS].all()): # beat full?
+                            m.d.comb += beat_fifo.w_en.eq(1)
+                            m.d.sync += [
+                                beat_lanes.eq(0),
+                                burst_beats.eq(beats_so_far + 1),
+                            ]
+                            with m.If(buf_addr[1:BURST_BITS].all()): # burst?
+                                m.d.comb += burst_fifo.w_en.eq(1)
+                                m.d.sync += burst_open.eq(0)
+                        with m.Else():
+                            m.d.sync += [
+                                beat_data.eq(next_data),
+                                beat_lanes.eq(next_lanes),
+                            ]
+
+            with m.State("DISCARD"):
+                # throw away whole sets of samples until the host swaps or
+                # reads enough of the ring to make room again
+                with m.If(self.samples.valid):
+                    with m.If(self.samples.first & (swap_desired | ~full)):
+                        with m.If(~swap_desired):
+                            m.next = "RUN" # resume writing with this set
+                        with m.Elif(burst_fifo.w_rdy):
+                            # nothing to write, but the swap must still wait
+                            # for previous bursts to land
+                            m.d.comb += [
+                                burst_i["has_data"].eq(0),
+                                burst_i["end_addr"].eq(buf_addr),
+                                burst_i["wraps"].eq(ring_wraps),
+                                burst_i["swap"].eq(1),
+                                burst_fifo.w_en.eq(1),
+                            ]
+                            swap()
+                            m.next = "RUN"
+                    with m.Else():
+                        m.d.comb += self.samples.ready.eq(1) # FIFO ack
+                        with m.If(self.samples.first):
+                            m.d.comb += dropped.eq(1)
+
+        # bursts which have been sent (or only have a swap to finish) and are
+        # waiting to land in memory, in order
+        m.submodules.inflight_fifo = inflight_fifo = SyncFIFOBuffered(
+            width=len(burst_fifo.r_data), depth=self._max_bursts)
+        inflight = burst_fields()
+        m.d.comb += [
+            inflight_fifo.w_data.eq(burst_fifo.r_data),
+            Cat(*inflight.values()).eq(inflight_fifo.r_data),
+        ]
 
-                    m.next = "IDLE"
+        # lengths of bursts which have been addressed but not yet sent. there
+        # is always room as each is also in flight
+        m.submodules.length_fifo = length_fifo = SyncFIFOBuffered(
+            width=4, depth=self._max_bursts)
+        m.d.comb += length_fifo.w_data.eq(abus.length)
+
+        # address queued bursts as long as not too many are in flight
+        with m.If(abus.addr_valid & abus.addr_ready):
+            m.d.comb += length_fifo.w_en.eq(1)
+            m.d.sync += [
+                # deassert address valid
+                abus.addr_valid.eq(0),
+                # toggle LED
+                self.status_leds[0].eq(~self.status_leds[0]),
+            ]
+        with m.If(burst_fifo.r_rdy & inflight_fifo.w_rdy &
+                (~abus.addr_valid | abus.addr_ready)):
+            m.d.comb += [
+                burst_fifo.r_en.eq(1),
+                inflight_fifo.w_en.eq(1),
+            ]
+            with m.If(burst_o["has_data"]):
+                m.d.sync += [
+                    abus.addr.eq(burst_o["addr"]),
+                    abus.length.eq(burst_o["length"]),
+                    # address signals are valid
+                    abus.addr_valid.eq(1),
+                ]
+
+        # send the data for addressed bursts. the whole burst is queued before
+        # it is addressed so our data is always valid
+        burst_counter = Signal(4) # beats of the current burst sent so far
+        m.d.comb += [
+            Cat(abus.data, abus.data_lanes).eq(beat_fifo.r_data),
+            abus.data_valid.eq(length_fifo.r_rdy & beat_fifo.r_rdy),
+            abus.data_last.eq(burst_counter == length_fifo.r_data),
+        ]
+        with m.If(abus.data_valid & abus.data_ready):
+            m.d.comb += beat_fifo.r_en.eq(1)
+            m.d.sync += burst_counter.eq(burst_counter + 1)
+            with m.If(abus.data_last):
+                m.d.comb += length_fifo.r_en.eq(1)
+                m.d.sync += [
+                    burst_counter.eq(0),
+                    # toggle LED
+                    self.status_leds[1].eq(~self.status_leds[1]),
+                ]
+
+        # count up responses until the corresponding bursts can be retired
+        responses = Signal(range(self._max_bursts+1))
+        landed = Signal()
+        m.d.comb += landed.eq(inflight_fifo.r_rdy &
+            (~inflight["has_data"] | (responses != 0))) # nothing to wait for?
+        m.d.sync += responses.eq(
+            responses + abus.txn_done - (landed & inflight["has_data"]))
+        with m.If(abus.txn_done):
+            # toggle LED
+            m.d.sync += self.status_leds[2].eq(~self.status_leds[2])
+
+        with m.If(landed):
+            m.d.comb += inflight_fifo.r_en.eq(1)
+            # let the host know it can read up to here
+            m.d.sync += [
+                self._ring_pos.f.addr.r_data.eq(inflight["end_addr"]),
+                self._ring_pos.f.wraps.r_data.eq(inflight["wraps"]),
+                self._ring_wraps.f.wraps.r_data.eq(inflight["wraps"]),
+            ]
+            with m.If(inflight["swap"]):
+                m.d.sync += [
+                    # save address for host
+                    self._swap_addr.f.last_addr.r_data.eq(inflight["end_addr"]),
+                    # and the buffer it's for
+                    self._swap_state.f.last_buf.r_data.eq(inflight["last_buf"]),
+
+                    # the ring has restarted
+                    self._ring_ctrl.f.active.r_data.eq(inflight["ring"]),
+                    self._ring_pos.f.addr.r_data.eq(0),
+                    self._ring_pos.f.wraps.r_data.eq(0),
+                    self._ring_wraps.f.wraps.r_data.eq(0),
+
+                    swap_pending.eq(0),
+                ]
+                # acknowledge swap
+                m.d.comb += self._swap_state.f.swap.clear.eq(1)
 
         return m
@@ -9,11 +9,18 @@ from amaranth_soc.csr import Field
 
 import numpy as np
 
-from .bus import AudioRAMBus
-from .constants import MIC_FREQ_HZ, NUM_TAPS, NUM_MICS, NUM_CHANS
+from .bus import AudioRAMBus, AudioRAMBusArbiter
+from .constants import (MIC_FREQ_HZ, NUM_TAPS, NUM_MICS, NUM_CHANS, SPARSE_TAPS,
+    FOLDED_TAPS, DSP_CHAIN, DELAY_SUM, DELAY_SUM_UNITS, FFT_CONVOLVE,
+    DECIMATION_FACTORS)
 from .mic import MicCapture, MicCaptureRegs
-from .convolve import Convolver
-from .stream import SampleStreamFIFO, SampleWriter
+from .convolve import Convolver, ConvolverRegs
+from .delay_sum import DelaySum, load_delay_table, passthrough_delays
+from .fft_convolve import FFTConvolver
+from .decimate import Decimator, DecimatorRegs
+from .meter import LevelMeter
+from .stream import (SampleStreamFIFO, SampleStreamFork, SampleStreamMask,
+    SampleWriter)
 
 class Blinker(Component):
     button_raw: In(1)
@@ -37,27 +44,49 @@ class Blinker(Component):
         return m
 
 class SystemRegs(Component):
-    csr_bus: In(csr.Signature(addr_width=2, data_width=32))
+    # room for the masks of hundreds of channels
+    csr_bus: In(csr.Signature(addr_width=5, data_width=32))
 
     store_raw_data: Out(1)
+    raw_stream: Out(1)
+    mic_mask: Out(NUM_MICS, init=(1 << NUM_MICS)-1)
+    chan_mask: Out(NUM_CHANS, init=(1 << NUM_CHANS)-1)
 
     class SysParams1(csr.Register, access="r"):
         num_mics: Field(csr.action.R, 8)
-        num_chans: Field(csr.action.R, 8)
-        num_taps: Field(csr.action.R, 8)
+        num_chans: Field(csr.action.R, 16)
 
     class SysParams2(csr.Register, access="r"):
         mic_freq_hz: Field(csr.action.R, 16)
+        num_taps: Field(csr.action.R, 16)
 
     class RawDataCtrl(csr.Register, access="rw"):
         # 1 to store raw mic data, 0 to store convolved data. the switch is
         # nowhere near clean
         store_raw_data: Field(csr.action.RW, 1)
+        # 1 to also store raw mic data into the raw stream while the main stream
+        # stores convolved data
+        raw_stream: Field(csr.action.RW, 1)
+
+    # select which microphones (when storing raw data) or channels (otherwise)
+    # are stored. the rest are dropped before they are written to memory. these
+    # may span multiple words; write them lowest word first
+    class MicMask(csr.Register, access="rw"):
+        mask: Field(csr.action.RW, NUM_MICS, init=(1 << NUM_MICS)-1)
+
+    class ChanMask(csr.Register, access="rw"):
+        mask: Field(csr.action.RW, NUM_CHANS, init=(1 << NUM_CHANS)-1)
+
+    def __init__(self, *, num_taps=NUM_TAPS):
+        # taps of the built-in coefficients, which only the FFT engine lets be
+        # other than NUM_TAPS
+        self._num_taps = num_taps
 
-    def __init__(self):
         self._sys_params_1 = self.SysParams1()
         self._sys_params_2 = self.SysParams2()
         self._raw_data_ctrl = self.RawDataCtrl()
+        self._mic_mask = self.MicMask()
+        self._chan_mask = self.ChanMask()
 
         csr_sig = self.__annotations__["csr_bus"].signature
         builder = csr.Builder(
@@ -65,6 +94,8 @@ class SystemRegs(Component):
         builder.add("sys_params_1", self._sys_params_1)
         builder.add("sys_params_2", self._sys_params_2)
         builder.add("raw_data_ctrl", self._raw_data_ctrl)
+        builder.add("mic_mask", self._mic_mask)
+        builder.add("chan_mask", self._chan_mask)
 
         self._csr_bridge = csr.Bridge(builder.as_memory_map())
 
@@ -83,17 +114,81 @@ class SystemRegs(Component):
         m.d.comb += [
             self._sys_params_1.f.num_mics.r_data.eq(NUM_MICS),
             self._sys_params_1.f.num_chans.r_data.eq(NUM_CHANS),
-            self._sys_params_1.f.num_taps.r_data.eq(NUM_TAPS),
             self._sys_params_2.f.mic_freq_hz.r_data.eq(MIC_FREQ_HZ),
+            self._sys_params_2.f.num_taps.r_data.eq(self._num_taps),
         ]
 
         # forward register values
         m.d.sync += [
-            self.store_raw_data.eq(self._raw_data_ctrl.f.store_raw_data.data)
+            self.store_raw_data.eq(self._raw_data_ctrl.f.store_raw_data.data),
+            self.raw_stream.eq(self._raw_data_ctrl.f.raw_stream.data),
+            self.mic_mask.eq(self._mic_mask.f.mask.data),
+            self.chan_mask.eq(self._chan_mask.f.mask.data),
         ]
 
         return m
 
+class OverflowRegs(Component):
+    csr_bus: In(csr.Signature(addr_width=3, data_width=32))
+
+    # pulsed when each FIFO drops a set of samples because it is full
+    mic_dropped: In(1)
+    conv_i_dropped: In(1)
+    conv_o_dropped: In(1)
+    raw_i_dropped: In(1)
+
+    class Overflow(csr.Register, access="rw"):
+        # set when the corresponding FIFO drops a set, write 1 to clear
+        mic: Field(csr.action.RW1C, 1)
+        conv_i: Field(csr.action.RW1C, 1)
+        conv_o: Field(csr.action.RW1C, 1)
+        raw_i: Field(csr.action.RW1C, 1)
+
+    class Dropped(csr.Register, access="r"):
+        # saturating count of sets dropped by the corresponding FIFO
+        count: Field(csr.action.R, 32)
+
+    def __init__(self):
+        self._overflow = self.Overflow()
+        self._mic_dropped = self.Dropped()
+        self._conv_i_dropped = self.Dropped()
+        self._conv_o_dropped = self.Dropped()
+        self._raw_i_dropped = self.Dropped()
+
+        csr_sig = self.__annotations__["csr_bus"].signature
+        builder = csr.Builder(
+            addr_width=csr_sig.addr_width, data_width=csr_sig.data_width)
+        builder.add("overflow", self._overflow)
+        builder.add("mic_dropped", self._mic_dropped)
+        builder.add("conv_i_dropped", self._conv_i_dropped)
+        builder.add("conv_o_dropped", self._conv_o_dropped)
+        builder.add("raw_i_dropped", self._raw_i_dropped)
+
+        self._csr_bridge = csr.Bridge(builder.as_memory_map())
+
+        super().__init__() # initialize component and attributes from signature
+
+        self.csr_bus.memory_map = self._csr_bridge.bus.memory_map
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # bridge containing CSRs
+        m.submodules.csr_bridge = csr_bridge = self._csr_bridge
+        connect(m, flipped(self.csr_bus), csr_bridge.bus)
+
+        for name in ("mic", "conv_i", "conv_o", "raw_i"):
+            dropped = getattr(self, f"{name}_dropped")
+            count = Signal(32, name=f"{name}_count")
+            m.d.comb += [
+                self._overflow.f[name].set.eq(dropped),
+                getattr(self, f"_{name}_dropped").f.count.r_data.eq(count),
+            ]
+            with m.If(dropped & (count != 0xFFFF_FFFF)): # saturate
+                m.d.sync += count.eq(count + 1)
+
+        return m
+
 class Top(Component):
     button_raw: In(1)
     blink: Out(1)
@@ -107,20 +202,93 @@ class Top(Component):
     mic_ws: Out(1)
     mic_data_raw: In(NUM_MICS//2)
 
-    def __init__(self):
+    def __init__(self, *, dsp_chain=DSP_CHAIN, coefficients=None,
+            delay_table=None):
+        # coefficients is the path of a coefficient file like the built-in
+        # one, or an array shaped (channel, tap, mic). there must be NUM_TAPS
+        # taps, except for the FFT engine which takes any number. delay_table
+        # is the path of the table the delay-and-sum engine uses (if enabled),
+        # or a (delays, weights) pair of arrays
         csr_sig = self.__annotations__["csr_bus"].signature
         self._csr_decoder = csr.Decoder(
             addr_width=csr_sig.addr_width, data_width=csr_sig.data_width)
 
-        self._sample_writer = SampleWriter()
+        # the audio area is split between the main stream (raw or convolved
+        # data) and the raw stream (raw data alongside convolved data)
+        self._sample_writer = SampleWriter(
+            region_addr=0xBF00_0000, region_bits=23)
+        self._raw_writer = SampleWriter(
+            region_addr=0xBF80_0000, region_bits=23)
         self._mic_capture_regs = MicCaptureRegs(o_domain="mic_capture")
-        self._system_regs = SystemRegs()
+        self._overflow_regs = OverflowRegs()
+
+        # load prepared coefficient data
+        if coefficients is None:
+            coefficients = pathlib.Path(__file__).parent/"coefficients.txt"
+        if isinstance(coefficients, (str, pathlib.Path)):
+            coefficients = np.loadtxt(coefficients, dtype=np.float64)
+            coefficients = coefficients.reshape(NUM_CHANS, -1, NUM_MICS)
+            coefficients /= NUM_MICS # legacy; we should change the generator
+        coefficients = np.asarray(coefficients, dtype=np.float64)
+        if not FFT_CONVOLVE and coefficients.shape[1] != NUM_TAPS:
+            raise ValueError(f"must have {NUM_TAPS} taps, only the FFT engine "
+                "can have any number")
+        self._system_regs = SystemRegs(num_taps=coefficients.shape[1])
+
+        if DELAY_SUM:
+            # the delay-and-sum engine replaces the convolver and only ever
+            # uses the given table. without one it can only pass mics through
+            if delay_table is None:
+                delays, weights = passthrough_delays()
+            elif isinstance(delay_table, (str, pathlib.Path)):
+                delays, weights = load_delay_table(delay_table)
+            else:
+                delays, weights = delay_table
+            self._convolver = DelaySum(delays, weights, units=DELAY_SUM_UNITS)
+            self._convolver_regs = ConvolverRegs(o_domain="convolver",
+                trunc_bits=0, fixed=True)
+        elif FFT_CONVOLVE:
+            # so does the frequency domain convolver
+            self._convolver = FFTConvolver(coefficients)
+            self._convolver_regs = ConvolverRegs(o_domain="convolver",
+                trunc_bits=0, fixed=True)
+        else:
+            # the convolver starts out with these, but the host can load more
+            self._convolver = Convolver(coefficients,
+                sparse=SPARSE_TAPS, folded=FOLDED_TAPS, dsp_chain=dsp_chain)
+            self._convolver_regs = ConvolverRegs(o_domain="convolver",
+                trunc_bits=self._convolver.coeff_frac_bits,
+                folded=self._convolver.folded,
+                min_taps=self._convolver.min_taps,
+                pair_mask=self._convolver.pair_mask)
+        # convolver frequency relative to the mic sample frequency
+        self.convolver_rel_freq = self._convolver.rel_freq
+
+        # the decimator works on the convolver's output in its domain, so the
+        # convolver clock must be fast enough for it too
+        self._decimator = None
+        if len(DECIMATION_FACTORS) > 1:
+            self._decimator = Decimator(DECIMATION_FACTORS)
+            self.convolver_rel_freq = max(
+                self.convolver_rel_freq, self._decimator.rel_freq)
+        self._decimator_regs = DecimatorRegs(o_domain="convolver",
+            factors=DECIMATION_FACTORS if self._decimator else (1,))
+
+        # level meters for each mic and each convolved channel
+        self._mic_meter = LevelMeter(NUM_MICS)
+        self._chan_meter = LevelMeter(NUM_CHANS)
 
         # add subordinate buses to decoder
         # fix addresses for now for program consistency
-        self._csr_decoder.add(self._sample_writer.csr_bus, addr=0)
         self._csr_decoder.add(self._mic_capture_regs.csr_bus, addr=4)
-        self._csr_decoder.add(self._system_regs.csr_bus, addr=8)
+        self._csr_decoder.add(self._sample_writer.csr_bus, addr=16)
+        self._csr_decoder.add(self._overflow_regs.csr_bus, addr=32)
+        self._csr_decoder.add(self._raw_writer.csr_bus, addr=48)
+        self._csr_decoder.add(self._decimator_regs.csr_bus, addr=64)
+        self._csr_decoder.add(self._mic_meter.csr_bus, addr=68)
+        self._csr_decoder.add(self._chan_meter.csr_bus, addr=72)
+        self._csr_decoder.add(self._convolver_regs.csr_bus, addr=80)
+        self._csr_decoder.add(self._system_regs.csr_bus, addr=96)
 
         super().__init__() # initialize component and attributes from signature
 
@@ -155,50 +323,128 @@ class Top(Component):
         m.submodules.mic_capture_regs = cap_regs = self._mic_capture_regs
         m.d.comb += [
             mic_capture.gain.eq(cap_regs.gain),
-            mic_capture.use_fake_mics.eq(cap_regs.use_fake_mics)
+            mic_capture.use_fake_mics.eq(cap_regs.use_fake_mics),
+            mic_capture.divider.eq(cap_regs.divider),
         ]
 
         # FIFO to cross domains from mic capture
         m.submodules.mic_fifo = mic_fifo = \
-            SampleStreamFIFO(w_domain="mic_capture")
+            SampleStreamFIFO(w_domain="mic_capture", frame_len=NUM_MICS)
         connect(m, mic_capture.samples, mic_fifo.samples_w)
 
-        # load prepared coefficient data
-        coeff_path = pathlib.Path(__file__).parent/"coefficients.txt"
-        coefficients = np.loadtxt(coeff_path, dtype=np.float64)
-        coefficients = coefficients.reshape(NUM_CHANS, NUM_TAPS, NUM_MICS)
-        coefficients /= NUM_MICS # legacy; we should change the generator
-
         # FIFO to cross domains to the convolver
-        m.submodules.conv_i_fifo = conv_i_fifo = \
-            SampleStreamFIFO(w_domain="sync", r_domain="convolver")
+        m.submodules.conv_i_fifo = conv_i_fifo = SampleStreamFIFO(
+            w_domain="sync", r_domain="convolver", frame_len=NUM_MICS)
 
         # instantiate convolver in its domain
         m.submodules.convolver = convolver = \
-            DomainRenamer("convolver")(Convolver(coefficients))
+            DomainRenamer("convolver")(self._convolver)
         connect(m, conv_i_fifo.samples_r, convolver.samples_i)
         m.d.comb += convolver.samples_i_count.eq(conv_i_fifo.samples_count)
 
+        # hook up registers to switch and load coefficients (the other engines
+        # have none to load)
+        m.submodules.convolver_regs = conv_regs = self._convolver_regs
+        if isinstance(self._convolver, Convolver):
+            m.d.comb += [
+                convolver.coeff_bank.eq(conv_regs.coeff_bank),
+                conv_regs.coeff_bank_active.eq(convolver.coeff_bank_active),
+                convolver.trunc_bits[0].eq(conv_regs.trunc_bits[0]),
+                convolver.trunc_bits[1].eq(conv_regs.trunc_bits[1]),
+                convolver.taps[0].eq(conv_regs.taps[0]),
+                convolver.taps[1].eq(conv_regs.taps[1]),
+                conv_regs.taps_active.eq(convolver.taps_active),
+                convolver.coeff_w_en.eq(conv_regs.coeff_w_en),
+                convolver.coeff_w_chan.eq(conv_regs.coeff_w_chan),
+                convolver.coeff_w_addr.eq(conv_regs.coeff_w_addr),
+                convolver.coeff_w_data.eq(conv_regs.coeff_w_data),
+            ]
+
         # FIFO to cross domains from convolver to the writer
         m.submodules.conv_o_fifo = conv_o_fifo = \
-            SampleStreamFIFO(w_domain="convolver")
-        connect(m, convolver.samples_o, conv_o_fifo.samples_w)
+            SampleStreamFIFO(w_domain="convolver", frame_len=NUM_CHANS)
+
+        # decimate the convolved channels if we can
+        m.submodules.decimator_regs = dec_regs = self._decimator_regs
+        if self._decimator is not None:
+            m.submodules.decimator = decimator = \
+                DomainRenamer("convolver")(self._decimator)
+            connect(m, convolver.samples_o, decimator.samples_i)
+            connect(m, decimator.samples_o, conv_o_fifo.samples_w)
+            m.d.comb += [
+                decimator.factor.eq(dec_regs.factor),
+                dec_regs.factor_active.eq(decimator.factor_active),
+            ]
+        else:
+            connect(m, convolver.samples_o, conv_o_fifo.samples_w)
+
+        # drop unselected channels from convolved data. every channel comes
+        # through the FIFO so the decimator can filter and the meter can see
+        # them all. the mask is latched at the start of each set so it won't
+        # tear within one, but the host must discard data around a change
+        # anyway
+        m.submodules.chan_mask = chan_mask = SampleStreamMask(NUM_CHANS)
+        connect(m, conv_o_fifo.samples_r, chan_mask.samples_i)
+        m.d.comb += chan_mask.mask.eq(system_regs.chan_mask)
+
+        # FIFO to hold raw data so a stall storing it can't hold up the
+        # convolver (and vice versa)
+        m.submodules.raw_fifo = raw_fifo = \
+            SampleStreamFIFO(w_domain="sync", frame_len=NUM_MICS)
+
+        # send mic data to the convolver unless we are only storing raw data,
+        # and to the raw FIFO if we are storing it anywhere
+        m.submodules.mic_fork = mic_fork = SampleStreamFork(2)
+        connect(m, mic_fifo.samples_r, mic_fork.samples_i)
+        connect(m, mic_fork.samples_o[0], conv_i_fifo.samples_w)
+        connect(m, mic_fork.samples_o[1], raw_fifo.samples_w)
+        m.d.comb += mic_fork.enable.eq(Cat(
+            ~system_regs.store_raw_data,
+            system_regs.store_raw_data | system_regs.raw_stream))
+
+        # keep track of sets of samples dropped by the FIFOs
+        m.submodules.overflow_regs = overflow_regs = self._overflow_regs
+        m.d.comb += [
+            overflow_regs.mic_dropped.eq(mic_fifo.frame_dropped),
+            overflow_regs.conv_i_dropped.eq(conv_i_fifo.frame_dropped),
+            overflow_regs.conv_o_dropped.eq(conv_o_fifo.frame_dropped),
+            overflow_regs.raw_i_dropped.eq(raw_fifo.frame_dropped),
+        ]
 
-        # writer to save sample data to memory
+        # meter the mics and channels as they go by. the saturating stages
+        # before them (the gain processor and the convolver output) clamp to
+        # full scale, which the meters count as clipping
+        m.submodules.mic_meter = mic_meter = self._mic_meter
+        m.submodules.chan_meter = chan_meter = self._chan_meter
+        for meter, samples in ((mic_meter, mic_fifo.samples_r),
+                (chan_meter, conv_o_fifo.samples_r)):
+            m.d.comb += [
+                meter.data.eq(samples.data),
+                meter.first.eq(samples.first),
+                meter.valid.eq(samples.valid & samples.ready),
+            ]
+
+        # writers to save sample data to memory, sharing the bus
         m.submodules.sample_writer = sample_writer = self._sample_writer
-        connect(m, sample_writer.audio_ram, flipped(self.audio_ram))
+        m.submodules.raw_writer = raw_writer = self._raw_writer
+        m.submodules.arbiter = arbiter = AudioRAMBusArbiter(2)
+        connect(m, sample_writer.audio_ram, arbiter.audio_ram_i[0])
+        connect(m, raw_writer.audio_ram, arbiter.audio_ram_i[1])
+        connect(m, arbiter.audio_ram_o, flipped(self.audio_ram))
         m.d.comb += self.status_leds.eq(sample_writer.status_leds)
 
+        # drop unselected mics from raw data
+        m.submodules.mic_mask = mic_mask = SampleStreamMask(NUM_MICS)
+        connect(m, raw_fifo.samples_r, mic_mask.samples_i)
+        m.d.comb += mic_mask.mask.eq(system_regs.mic_mask)
+
         # switch between saving raw sample data and convolved data
         with m.If(system_regs.store_raw_data):
-            # connect mic fifo directly to sample writer
-            connect(m, mic_fifo.samples_r, sample_writer.samples)
-            m.d.comb += sample_writer.samples_count.eq(mic_fifo.samples_count)
+            connect(m, mic_mask.samples_o, sample_writer.samples)
         with m.Else():
-            # run mic data through convolver
-            connect(m, mic_fifo.samples_r, conv_i_fifo.samples_w)
-            connect(m, conv_o_fifo.samples_r, sample_writer.samples)
-            m.d.comb += sample_writer.samples_count.eq(
-                conv_o_fifo.samples_count)
+            connect(m, chan_mask.samples_o, sample_writer.samples)
+            # and save raw data alongside if requested
+            with m.If(system_regs.raw_stream):
+                connect(m, mic_mask.samples_o, raw_writer.samples)
 
         return m
@@ -0,0 +1,218 @@
+import time
+import wave
+import struct
+import argparse
+
+import numpy as np
+
+# lossless codec for blocks of sample sets, in the style of FLAC: each channel
+# is predicted from its previous samples by a fixed polynomial predictor, then
+# the residuals are Rice coded. unlike FLAC, each channel's unary quotients and
+# binary remainders are stored as two separate bit streams, so both can be
+# packed and unpacked for every sample at once with NumPy instead of one
+# codeword at a time
+
+CODEC = "papa-rice-1" # name in the stream description
+
+MAX_ORDER = 3 # highest order of the predictor
+VERBATIM = 0xFF # order which means the channel is stored as is
+
+# number of sets and channels, then for each channel its header, its warmup
+# samples (one per order), its remainders, then its quotients
+BLOCK_HEADER = struct.Struct("<IH")
+# predictor order, Rice parameter, and bytes of quotients
+CHANNEL_HEADER = struct.Struct("<BBI")
+
+def _rice_parameter(u):
+    # pick the Rice parameter which codes the values in the fewest bits.
+    # start from the estimate that the quotient is about 1, then check its
+    # neighbors
+    estimate = int(np.log2(max(u.mean(), 1)))
+    best = None
+    for k in range(max(estimate-1, 0), estimate+2):
+        bits = int((u >> k).sum()) + len(u)*(k+1)
+        if best is None or bits < best[1]:
+            best = (k, bits)
+
+    return best
+
+def encode(data):
+    # encode an array of int16 sample sets (one row per set) into bytes
+    num_sets, num_chans = data.shape
+    x = data.astype(np.int32)
+
+    # work out the residuals of each order of predictor for every channel at
+    # once, then pick the order with the smallest residuals for each
+    residuals = [x]
+    for order in range(1, MAX_ORDER+1):
+        residuals.append(np.diff(residuals[-1], axis=0))
+    costs = np.array([np.abs(r).sum(axis=0) for r in residuals])
+    orders = costs.argmin(axis=0)
+
+    out = [BLOCK_HEADER.pack(num_sets, num_chans)]
+    for ci in range(num_chans):
+        order = int(orders[ci])
+        if num_sets <= order:
+            out.append(CHANNEL_HEADER.pack(VERBATIM, 0, 0))
+            out.append(data[:, ci].astype("<i2").tobytes())
+            continue
+
+        # zigzag the residuals so they are small unsigned values
+        r = residuals[order][:, ci]
+        u = ((r << 1) ^ (r >> 31)).astype(np.uint32)
+        k, bits = _rice_parameter(u)
+        if bits >= 16*len(u): # not worth it
+            out.append(CHANNEL_HEADER.pack(VERBATIM, 0, 0))
+            out.append(data[:, ci].astype("<i2").tobytes())
+            continue
+
+        # remainders are k bits each, most significant first
+        rem_bits = (u[:, None] >> np.arange(k-1, -1, -1, dtype=np.uint32)) & 1
+        remainders = np.packbits(rem_bits.astype(np.uint8))
+        # quotients are that many 0 bits then a 1 bit
+        q = u >> k
+        stops = np.cumsum(q + 1) - 1
+        unary_bits = np.zeros(int(stops[-1])+1, dtype=np.uint8)
+        unary_bits[stops] = 1
+        quotients = np.packbits(unary_bits)
+
+        out.append(CHANNEL_HEADER.pack(order, k, len(quotients)))
+        out.append(data[:order, ci].astype("<i2").tobytes())
+        out.append(remainders.tobytes())
+        out.append(quotients.tobytes())
+
+    return b"".join(out)
+
+def decode(block):
+    # decode bytes from encode back into an array of int16 sample sets
+    block = memoryview(block)
+    num_sets, num_chans = BLOCK_HEADER.unpack_from(block)
+    pos = BLOCK_HEADER.size
+
+    data = np.empty((num_sets, num_chans), dtype=np.int16)
+    for ci in range(num_chans):
+        order, k, quotient_bytes = CHANNEL_HEADER.unpack_from(block, pos)
+        pos += CHANNEL_HEADER.size
+        if order == VERBATIM:
+            data[:, ci] = np.frombuffer(block, dtype="<i2", count=num_sets,
+                offset=pos)
+            pos += 2*num_sets
+            continue
+
+        warmup = np.frombuffer(block, dtype="<i2", count=order,
+            offset=pos).astype(np.int64)
+        pos += 2*order
+        n = num_sets - order
+
+        remainder_bytes = (n*k + 7)//8
+        remainders = np.unpackbits(np.frombuffer(block, dtype=np.uint8,
+            count=remainder_bytes, offset=pos), count=n*k)
+        pos += remainder_bytes
+        remainders = remainders.reshape(n, k).astype(np.uint32) @ \
+            (1 << np.arange(k-1, -1, -1, dtype=np.uint32))
+        # each quotient is the distance between its stop bit and the last
+        stops = np.flatnonzero(np.unpackbits(np.frombuffer(block,
+            dtype=np.uint8, count=quotient_bytes, offset=pos)))[:n]
+        pos += quotient_bytes
+        q = np.diff(stops, prepend=-1) - 1
+
+        u = (q.astype(np.int64) << k) | remainders
+        r = (u >> 1) ^ -(u & 1)
+
+        # integrate the residuals back up, starting each difference from the
+        # warmup samples
+        for level in range(order-1, -1, -1):
+            start = np.diff(warmup, level)[0]
+            r = np.concatenate(([start], start + np.cumsum(r)))
+        data[:, ci] = r
+
+    return data
+
+def bench(data, repeat):
+    # time encoding and decoding the array of sample sets in blocks of about
+    # 0.1s, like the server sends them
+    raw_bytes = data.nbytes
+    blocks = np.array_split(data, max(1, len(data)//4800))
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        encoded = [encode(block) for block in blocks]
+    encode_time = (time.perf_counter() - start)/repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        decoded = [decode(block) for block in encoded]
+    decode_time = (time.perf_counter() - start)/repeat
+
+    if not np.array_equal(np.concatenate(decoded), data):
+        raise ValueError("decoded data doesn't match!")
+
+    encoded_bytes = sum(len(block) for block in encoded)
+    print(f"{raw_bytes} bytes -> {encoded_bytes} bytes "
+        f"({100*encoded_bytes/raw_bytes:.1f}%)")
+    print(f"encode: {raw_bytes/encode_time/1e6:.2f} MB/s, "
+        f"decode: {raw_bytes/decode_time/1e6:.2f} MB/s")
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="codec",
+        description="Benchmark the lossless codec or decode recordings.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    bench_parser = subparsers.add_parser("bench",
+        help="Measure the codec's compression and throughput.")
+    bench_parser.add_argument('filename', type=str, nargs="?", default=None,
+        help=".wav file of data to use, default a synthetic test signal.")
+    bench_parser.add_argument('-c', '--channels', type=int, default=16,
+        help="Channels of the synthetic signal, default 16.")
+    bench_parser.add_argument('--seconds', type=float, default=5,
+        help="Length of the synthetic signal, default 5.")
+    bench_parser.add_argument('--repeat', type=int, default=3,
+        help="Times to repeat the measurement, default 3.")
+
+    decode_parser = subparsers.add_parser("decode",
+        help="Convert a compressed recording from wavdump to a .wav file.")
+    decode_parser.add_argument('input', type=str,
+        help="Compressed recording to read.")
+    decode_parser.add_argument('output', type=str,
+        help="File to save .wav data to.")
+
+    return parser.parse_args()
+
+def codec():
+    args = parse_args()
+
+    if args.command == "bench":
+        if args.filename is not None:
+            with wave.open(args.filename, "rb") as wav:
+                if wav.getsampwidth() != 2:
+                    raise ValueError("must be 16 bit samples")
+                data = np.frombuffer(wav.readframes(wav.getnframes()),
+                    dtype="<i2").reshape(-1, wav.getnchannels())
+        else:
+            # quiet tones with noise, roughly like a room through the mics
+            rate = 48000
+            t = np.arange(int(rate*args.seconds))[:, None] / rate
+            freqs = 200 + 50*np.arange(args.channels)
+            rng = np.random.default_rng(0)
+            data = (2000*np.sin(2*np.pi*freqs*t) +
+                rng.normal(0, 30, (len(t), args.channels))).astype(np.int16)
+        bench(data, args.repeat)
+
+    elif args.command == "decode":
+        # the recording is the framed protocol, so read it the same way
+        from .protocol import FrameReader
+        with open(args.input, "rb") as f:
+            reader = FrameReader(f)
+            with wave.open(args.output, "wb") as wav:
+                wav.setnchannels(len(reader.channels))
+                wav.setsampwidth(2)
+                wav.setframerate(reader.rate)
+                dropped = 0
+                for frame in reader:
+                    dropped += frame.dropped
+                    wav.writeframesraw(frame.data)
+        if dropped > 0:
+            print(f"recording is missing {dropped} dropped sets")
+
+if __name__ == "__main__":
+    codec()
@@ -1,11 +1,227 @@
 import os
 import mmap
 import time
+from collections import namedtuple
 
 import numpy as np
 
 from .volatile import VolatileU32Array
 
+# register window base addresses (in 32 bit words)
+REG_MIC = 4
+REG_SYSTEM = 96
+REG_WRITER = 16 # main stream's writer
+REG_OVERFLOW = 32
+REG_CONV = 80
+REG_RAW_WRITER = 48 # raw stream's writer
+REG_DECIMATOR = 64
+REG_MIC_METER = 68 # level meters for each mic
+REG_CHAN_METER = 72 # and each convolved channel
+
+# the mic sample rate can be divided by up to this much
+MAX_RATE_DIVIDER = 8
+
+BUF_BYTES = 0x100_0000 # size of the whole buffer area
+STREAM_BYTES = BUF_BYTES//2 # size of each stream's area of it
+
+# places in the pipeline where sets of samples can be dropped (in the order of
+# the FIFO overflow flags and counts), followed by each writer itself
+FIFO_POINTS = ("mic", "conv_i", "conv_o", "raw_i")
+DROP_POINTS = ("mic", "conv_i", "conv_o", "dma") # for the main stream
+RAW_DROP_POINTS = ("mic", "raw_i", "dma") # for the raw stream
+# points before the decimator, which count sets at the undecimated rate
+UNDECIMATED_POINTS = ("mic", "conv_i")
+
+# data returned by get_data: an array of sample sets (one row per set), a dict
+# of the number of sets dropped at each point since the last chunk, a set of the
+# points whose overflow flags were raised since the last chunk, and the sample
+# rate of the sets in Hz
+Chunk = namedtuple("Chunk", ["data", "dropped", "overflowed", "rate"])
+
+# levels returned by get_levels: arrays of the RMS level and peak magnitude
+# (relative to full scale) of each mic or channel, and the number of times it
+# clipped. the peaks and clips are since the last call
+Levels = namedtuple("Levels", ["rms", "peak", "clips"])
+
+def quantize_coefficients(coefficients, max_coefficient, coeff_bits):
+    # convert coefficients as float values to fixed point exactly like the
+    # convolver does when it's built. returns the fixed point values (as
+    # unsigned coeff_bits wide integers) and the number of fractional bits
+
+    # we need 2 integer bits for the coefficients, 1 for sign and 1 to
+    # accommodate coefficients == 1 (and slightly beyond). the rest we can make
+    # fraction bits.
+    coeff_frac_bits = coeff_bits-2
+
+    # the coefficients might all be rather small to make the sum 1. add more
+    # fractional bits for precision without exceeding the allotted bits.
+    if max_coefficient > 0:
+        max_val = (1 << (coeff_bits-1))-1 # leave one bit for sign
+        while int(max_coefficient * (1 << (coeff_frac_bits+1))) <= max_val:
+            coeff_frac_bits += 1 # another bit to multiply by another 2
+
+    # convert coefficients to signed fixed point with the calculated number
+    # of fractional bits
+    coefficients = (coefficients * (1 << coeff_frac_bits)).astype(np.int64)
+    # make sure they're all in range to fit (input wasn't outside -1 to 1)
+    if not np.all(np.abs(coefficients) < (1 << (coeff_bits-1))):
+        raise ValueError("coefficients must be within -1 to 1")
+    # mask to final bit width (which also makes the values unsigned)
+    coefficients &= (1 << coeff_bits)-1
+
+    return coefficients, coeff_frac_bits
+
+class Stream:
+    # one writer's stream of sample sets into its own area of the buffer,
+    # either swapping between two halves or as one big ring
+
+    def __init__(self, hw, reg, offset, drop_points, get_dim, get_rate):
+        self._hw = hw
+        self.r = hw.r
+        self._reg = reg
+        self._drop_points = drop_points
+        self._get_dim = get_dim # number of samples in each set
+        self._get_rate = get_rate # sample rate of the sets
+
+        # expose as two regions of signed 16 bit words
+        self.d = np.frombuffer(hw._buf_mmap, dtype=np.int16,
+            count=STREAM_BYTES//2, offset=offset).reshape(2, -1)
+        # and as one big ring of them
+        self._ring = self.d.reshape(-1)
+        self._ring_words = len(self._ring)
+
+        # wait for any existing buffer swap or mode change to have completed
+        while self.r[reg+2] & 1: pass
+        while ((ctrl := self.r[reg+4]) & 1) != ((ctrl >> 1) & 1): pass
+        self._ring_mode = bool(ctrl & 1)
+
+        # pick up reading the ring from wherever the writer currently is
+        pos = self.r[reg+5]
+        wraps = self.r[reg+6]
+        # account for a wrap happening between the two reads
+        self._ring_wraps = wraps - ((wraps - (pos >> 24)) & 0xFF)
+        self._ring_read = self._get_ring_write()
+        self._ring_read -= self._ring_read % self._get_dim()
+        self._release_ring()
+
+        # start counting dropped sets from now
+        self._overflowed = set() # flags raised but not yet returned
+        self._drop_counts = [0]*len(drop_points)
+        self._read_drops()
+
+    def _get_ring_write(self):
+        # get the absolute sample position the writer has written the ring up to
+        pos = self.r[self._reg+5]
+        # only the low bits of the wrap count are available alongside the
+        # address, but we check often enough to never miss 256 wraps
+        self._ring_wraps += ((pos >> 24) - self._ring_wraps) & 0xFF
+
+        return self._ring_wraps*self._ring_words + ((pos & 0xFF_FFFF) >> 1)
+
+    def _release_ring(self):
+        # tell the writer how far we've read so it can reuse that space. it
+        # only needs the LSB of the wrap count to know how much room is left
+        self.r[self._reg+7] = (self._ring_read*2) % (STREAM_BYTES*2)
+
+    def _read_drops(self):
+        # read and clear the overflow flags, then return them along with the
+        # number of sets dropped at each point since we last checked
+        self._hw._poll_overflow()
+        dma_flag = self.r[self._reg+8]
+        self.r[self._reg+8] = dma_flag
+        if dma_flag & 1:
+            self._overflowed.add("dma")
+
+        counts = []
+        for point in self._drop_points:
+            if point == "dma":
+                counts.append(self.r[self._reg+9])
+            else:
+                counts.append(self.r[REG_OVERFLOW+1+FIFO_POINTS.index(point)])
+        dropped = {}
+        for pi, point in enumerate(self._drop_points):
+            # counters saturate so they can't have wrapped
+            dropped[point] = counts[pi] - self._drop_counts[pi]
+        self._drop_counts = counts
+        overflowed = frozenset(self._overflowed)
+        self._overflowed.clear()
+
+        return dropped, overflowed
+
+    def swap_buffers(self):
+        # swap buffers and return (old buffer, old address). in ring mode this
+        # instead restarts the ring at the beginning of the next sample set
+
+        # ask for buffers to be swapped
+        self.r[self._reg+2] = 1
+        # loop until it occurs (at about 48KHz so no point sleeping)
+        while (status := self.r[self._reg+2]) & 1: pass
+
+        # the ring (if active) was restarted so start reading from the top
+        self._ring_wraps = 0
+        self._ring_read = 0
+
+        which = (status >> 1) & 1 # which buffer did we swap from?
+        where = self.r[self._reg+3] # what was the last address in it?
+        return (which, where)
+
+    def set_ring_mode(self, ring_mode=True):
+        # set whether the writer fills the whole stream area as a ring, which
+        # the host drains at its leisure, or swaps between two halves
+
+        self._ring_mode = bool(ring_mode)
+        self.r[self._reg+4] = int(self._ring_mode)
+        # wait for the mode to switch at the start of the next sample set,
+        # which also restarts the ring
+        while bool(self.r[self._reg+4] & 2) != self._ring_mode: pass
+
+        self._ring_wraps = 0
+        self._ring_read = 0
+
+    def get_data(self):
+        # return a Chunk with a reference to the data buffered since the last
+        # call, along with what was dropped to get it
+
+        if self._ring_mode:
+            data = self._get_ring_data()
+        else:
+            # swap buffers then get a reference to the buffered data
+            which_buf, buf_pos = self.swap_buffers()
+            buf_pos >>= 1 # convert from bytes to words
+
+            data = self.d[which_buf, :buf_pos].reshape(-1, self._get_dim())
+
+        return Chunk(data, *self._read_drops(), self._get_rate())
+
+    def _get_ring_data(self):
+        # return the complete sample sets between where we last read and where
+        # the writer currently is. the data we returned last time is released
+        # now, and the writer drops data instead of overwriting what we have yet
+        # to release
+        self._release_ring()
+
+        dim = self._get_dim()
+        ring_words = self._ring_words
+        ring_write = self._get_ring_write()
+
+        avail = ring_write - self._ring_read
+        if avail > ring_words: # writer has lapped us (should be impossible)
+            self._ring_read = ring_write - (ring_write % dim)
+            raise ValueError("ring buffer overflowed")
+
+        avail -= avail % dim # only return complete sets
+        start = self._ring_read % ring_words
+        end = start + avail
+        self._ring_read += avail
+
+        if end <= ring_words: # contiguous so we can return a reference
+            data = self._ring[start:end]
+        else: # wrapped around so we have to stitch the two pieces together
+            data = np.concatenate(
+                (self._ring[start:], self._ring[:end-ring_words]))
+
+        return data.reshape(-1, dim)
+
 class HW:
     def __init__(self):
         # open file descriptors to memory so we can map it. one is sync
@@ -23,59 +239,164 @@ class HW:
 
         # 16 MiB buffer area at end of 1GiB SDRAM
         self._buf_mmap = mmap.mmap(self._buf_fd,
-            0x100_0000, offset=0x3f00_0000)
+            BUF_BYTES, offset=0x3f00_0000)
         # 1KiB register area at start of FPGA lightweight slave region
         self._reg_mmap = mmap.mmap(self._reg_fd,
             0x400, offset = 0xff20_0000)
 
-        # expose as numpy arrays
-
-        # expose as two regions of signed 16 bit words
-        self.d = np.frombuffer(self._buf_mmap, dtype=np.int16).reshape(2, -1)
         # expose uint32 register data through volatile pointer
         self.r = VolatileU32Array(memoryview(self._reg_mmap).cast('L'))
 
         self._closed = False
 
         # access test register to make sure the bus seems alive
-        val = self.r[0]
+        val = self.r[REG_WRITER+0]
         val = ((val + 0x1234) * 3) & 0xFFFF_FFFF # permute the value somehow
-        self.r[0] = val
-        if self.r[0] != val:
+        self.r[REG_WRITER+0] = val
+        if self.r[REG_WRITER+0] != val:
             raise ValueError("test register not responding")
 
         # read system parameters
-        p1 = self.r[8]
-        p2 = self.r[9]
+        p1 = self.r[REG_SYSTEM+0]
+        p2 = self.r[REG_SYSTEM+1]
         self.num_mics = p1 & 0xFF
-        self.num_chans = (p1 >> 8) & 0xFF
-        self.num_taps = (p1 >> 16) & 0xFF
-        self.mic_freq_hz = p2 & 0xFFFF
-
-        self._store_raw_data = bool(self.r[10]) # need to know for data shape
-
-        # wait for any existing buffer swap to have completed
-        while self.r[2] & 1: pass
+        self.num_chans = (p1 >> 8) & 0xFFFF
+        self.max_mic_freq_hz = p2 & 0xFFFF
+        self.num_taps = (p2 >> 16) & 0xFFFF
+        # the mics might be running slower than the maximum
+        self.mic_freq_hz = round(
+            self.max_mic_freq_hz / (self.r[REG_MIC+2] + 1))
+
+        # the factors the convolved channels can be decimated by (just 1 if the
+        # design can't), and the one in use
+        factors = self.r[REG_DECIMATOR+0]
+        self.decimation_factors = tuple(
+            f for f in range(factors.bit_length()) if factors & (1 << f))
+        self._decimation = (self.r[REG_DECIMATOR+1] >> 4) & 0xF
+
+        # need to know for data shape
+        raw_data_ctrl = self.r[REG_SYSTEM+2]
+        self._store_raw_data = bool(raw_data_ctrl & 1)
+        self._raw_stream = bool(raw_data_ctrl & 2)
+        self._masks = {raw: self._read_mask(raw) for raw in (False, True)}
+
+        # the main stream has raw or convolved data, and the raw stream has raw
+        # data alongside convolved data if enabled
+        self._streams = []
+        self.main = Stream(self, REG_WRITER, 0, DROP_POINTS,
+            lambda: self._get_dim(self._store_raw_data), self.get_rate)
+        self._streams.append(self.main)
+        self.raw = Stream(self, REG_RAW_WRITER, STREAM_BYTES, RAW_DROP_POINTS,
+            lambda: self._get_dim(True), lambda: self.get_rate(True))
+        self._streams.append(self.raw)
+
+        # expose the main stream's halves as before
+        self.d = self.main.d
+
+    def _get_dim(self, raw):
+        # number of samples in each set
+        return bin(self._masks[raw]).count("1")
+
+    def _poll_overflow(self):
+        # read and clear the FIFO overflow flags, remembering them for each
+        # stream that cares about them until it returns them
+        flags = self.r[REG_OVERFLOW+0]
+        self.r[REG_OVERFLOW+0] = flags
+        for pi, point in enumerate(FIFO_POINTS):
+            if flags & (1 << pi):
+                for stream in self._streams:
+                    if point in stream._drop_points:
+                        stream._overflowed.add(point)
+
+    def _get_mask_regs(self, raw):
+        # return the first register and number of registers holding the mask of
+        # mics (if raw) or channels which are stored
+        mic_words = (self.num_mics+31)//32
+        if raw:
+            return REG_SYSTEM+3, mic_words
+        return REG_SYSTEM+3+mic_words, (self.num_chans+31)//32
+
+    def _read_mask(self, raw):
+        reg, words = self._get_mask_regs(raw)
+        mask = 0
+        for wi in range(words): # lowest word first to latch the whole thing
+            mask |= self.r[reg+wi] << (32*wi)
+        return mask
+
+    def get_rate(self, raw=None):
+        # return the sample rate in Hz of the mics (if raw) or channels, which
+        # are decimated. defaults to the current mode
+
+        if raw is None:
+            raw = self._store_raw_data
+        if raw:
+            return self.mic_freq_hz
+        return round(self.mic_freq_hz / self._decimation)
+
+    def count_lost(self, dropped, rate):
+        # count the sets lost according to a Chunk's dropped counts, at the
+        # Chunk's rate, which is lower than the mics' if it was decimated
+
+        factor = round(self.mic_freq_hz / rate)
+        return sum(count // factor if point in UNDECIMATED_POINTS else count
+            for point, count in dropped.items())
+
+    def get_channels(self, raw=None):
+        # return the indices of the mics (if raw) or channels which are stored,
+        # i.e. what each column of the data is. defaults to the current mode
+
+        if raw is None:
+            raw = self._store_raw_data
+        mask = self._masks[bool(raw)]
+        return tuple(ci for ci in range(mask.bit_length()) if mask & (1 << ci))
+
+    def set_channels(self, channels=None, raw=None, wait=True):
+        # set which mics (if raw) or channels are stored, as an iterable of
+        # indices (default all). the rest are dropped by the hardware before
+        # ever being written to memory. defaults to the current mode
+
+        if raw is None:
+            raw = self._store_raw_data
+        raw = bool(raw)
+        num = self.num_mics if raw else self.num_chans
+        if channels is None:
+            channels = range(num)
+
+        mask = 0
+        for ci in channels:
+            ci = int(ci)
+            if ci < 0 or ci >= num:
+                raise ValueError(f"must be 0 <= channel < {num}")
+            mask |= 1 << ci
+        if mask == 0:
+            raise ValueError("must select at least one channel")
+
+        self._masks[raw] = mask
+        reg, words = self._get_mask_regs(raw)
+        for wi in range(words): # highest word last to commit the whole thing
+            self.r[reg+wi] = (mask >> (32*wi)) & 0xFFFF_FFFF
+
+        if wait and raw == self._store_raw_data:
+            # the data shape changes at the start of some set soon, so wait
+            # for the switch to happen then discard the in-between stuff
+            time.sleep((1/self.mic_freq_hz) * (self.num_taps + 10))
+            self.swap_buffers()
+        elif wait and raw and self._raw_stream:
+            # same for the raw stream, which doesn't go thru the convolver
+            time.sleep((1/self.mic_freq_hz) * 10)
+            self.raw.swap_buffers()
 
     def swap_buffers(self):
-        # swap buffers and return (old buffer, old address)
+        # swap the main stream's buffers, see Stream.swap_buffers
+        return self.main.swap_buffers()
 
-        # ask for buffers to be swapped
-        self.r[2] = 1
-        # loop until it occurs (at about 48KHz so no point sleeping)
-        while (status := self.r[2]) & 1: pass
-
-        which = (status >> 1) & 1 # which buffer did we swap from?
-        where = self.r[3] # what was the last address in that buffer?
-        return (which, where)
+    def set_ring_mode(self, ring_mode=True):
+        # set the main stream's ring mode, see Stream.set_ring_mode
+        self.main.set_ring_mode(ring_mode)
 
     def get_data(self):
-        # swap buffers then return a reference to the buffered data
-        which_buf, buf_pos = self.swap_buffers()
-        buf_pos >>= 1 # convert from bytes to words
-
-        dim = self.num_mics if self._store_raw_data else self.num_chans
-        return self.d[which_buf, :buf_pos].reshape(-1, dim)
+        # get the main stream's data, see Stream.get_data
+        return self.main.get_data()
 
     def set_gain(self, gain):
         # set the value to multiply the microphone data by (i.e. gain)
@@ -84,18 +405,37 @@ class HW:
         if gain < 1 or gain > 256:
             raise ValueError("must be 1 <= gain <= 256")
 
-        self.r[4] = gain - 1
+        self.r[REG_MIC+0] = gain - 1
 
     def set_use_fake_mics(self, use_fake_mics=True):
         # set whether fake mics should be used or not
 
-        self.r[5] = 1 if use_fake_mics else 0
+        self.r[REG_MIC+1] = 1 if use_fake_mics else 0
+
+    def set_rate_divider(self, divider, wait=True):
+        # set what the maximum mic sample rate is divided by, e.g. 2 to capture
+        # at 24KHz instead of 48KHz. mic_freq_hz is updated to the new rate
+
+        divider = int(divider)
+        if divider < 1 or divider > MAX_RATE_DIVIDER:
+            raise ValueError(f"must be 1 <= divider <= {MAX_RATE_DIVIDER}")
+
+        self.r[REG_MIC+2] = divider - 1
+        self.mic_freq_hz = round(self.max_mic_freq_hz / divider)
+
+        if wait:
+            # wait for the data to be at the new rate then discard the
+            # in-between stuff
+            time.sleep((1/self.mic_freq_hz) * (self.num_taps + 10))
+            self.swap_buffers()
+            if self._raw_stream:
+                self.raw.swap_buffers()
 
     def set_store_raw_data(self, store_raw_data=True, wait=True):
         # set whether to store raw data or not
 
         self._store_raw_data = bool(store_raw_data)
-        self.r[10] = int(self._store_raw_data)
+        self._write_raw_data_ctrl()
 
         if wait:
             # wait enough time for the switch to happen and data to be processed
@@ -103,11 +443,167 @@ class HW:
             time.sleep((1/self.mic_freq_hz) * (self.num_taps + 10))
             self.swap_buffers()
 
+    def set_raw_stream(self, raw_stream=True, wait=True):
+        # set whether to store raw data into the raw stream while the main
+        # stream stores convolved data
+
+        self._raw_stream = bool(raw_stream)
+        self._write_raw_data_ctrl()
+
+        if wait:
+            # wait for the switch to happen then discard the in-between stuff
+            time.sleep((1/self.mic_freq_hz) * 10)
+            self.raw.swap_buffers()
+
+    def _write_raw_data_ctrl(self):
+        self.r[REG_SYSTEM+2] = \
+            int(self._store_raw_data) | (int(self._raw_stream) << 1)
+
+    def set_decimation(self, factor, wait=True):
+        # set the factor to decimate the convolved channels by, which must be
+        # one of decimation_factors. the channels are lowpass filtered first
+
+        factor = int(factor)
+        if factor not in self.decimation_factors:
+            raise ValueError("must be one of " +
+                ", ".join(str(f) for f in self.decimation_factors))
+
+        self.r[REG_DECIMATOR+1] = factor
+        self._decimation = factor
+
+        # the decimator only switches at the start of a block, and gets no
+        # blocks while raw data is being stored, so it switches once it gets
+        # them again and there's nothing to wait for
+        if wait and not self._store_raw_data:
+            # wait for the switch to happen then discard the in-between stuff
+            while ((self.r[REG_DECIMATOR+1] >> 4) & 0xF) != factor: pass
+            time.sleep((1/self.mic_freq_hz) * 10)
+            self.swap_buffers()
+
+    def _read_levels(self, reg):
+        num = self.r[reg+0] & 0xFFFF
+        mean_square = np.empty(num, dtype=np.float64)
+        peak = np.empty(num, dtype=np.float64)
+        clips = np.empty(num, dtype=np.uint32)
+        for i in range(num):
+            # snapshot the levels and wait for them to be ready
+            self.r[reg+1] = i
+            while not (self.r[reg+1] & 0x1_0000): pass
+            mean_square[i] = self.r[reg+2]
+            peak_clips = self.r[reg+3]
+            peak[i] = peak_clips & 0xFFFF
+            clips[i] = peak_clips >> 16
+
+        full_scale = 1 << 15
+        return Levels(np.sqrt(mean_square)/full_scale, peak/full_scale, clips)
+
+    def get_levels(self):
+        # read the levels of every mic (after the gain is applied) and every
+        # convolved channel. returns a Levels for the mics and one for the
+        # channels. the channels are only metered while convolved data is
+        # being stored
+
+        return self._read_levels(REG_MIC_METER), \
+            self._read_levels(REG_CHAN_METER)
+
+    def get_active_taps(self):
+        # return the number of taps the convolver is currently using
+
+        return (self.r[REG_CONV+1] >> 2) & 0xFFFF
+
+    def load_coefficients(self, coefficients, wait=True):
+        # load new convolver coefficients as float values, shaped (channel, tap,
+        # mic) and within -1 to 1. they are loaded into the bank the convolver
+        # isn't using, which it then switches to at the start of the next set.
+        # if the convolver supports it, there can be fewer taps than num_taps,
+        # which then takes less time. the last tap is applied to the newest
+        # samples. if the convolver is sparse, they must be zero at the (tap,
+        # mic) pairs it was built without
+
+        coefficients = np.asarray(coefficients, dtype=np.float64)
+        params = self.r[REG_CONV+0]
+        coeff_bits = params & 0xFF
+        if (params >> 9) & 1:
+            raise ValueError("design has a delay-and-sum or FFT engine whose "
+                "coefficients are fixed")
+        min_taps = (params >> 10) & 0xFFFF
+        taps = coefficients.shape[1] if coefficients.ndim == 3 else 0
+        expected_shape = (self.num_chans, taps, self.num_mics)
+        if coefficients.shape != expected_shape or taps > self.num_taps:
+            raise ValueError(f"shape {coefficients.shape} != expected "
+                f"{(self.num_chans, self.num_taps, self.num_mics)}")
+        if taps < min_taps:
+            raise ValueError(f"must have at least {min_taps} taps")
+        if (params >> 8) & 1: # folded, so only the first half of taps is used
+            if not np.array_equal(coefficients, coefficients[:, ::-1, :]):
+                raise ValueError("coefficients must be symmetric along taps")
+            coefficients = coefficients[:, :(taps+1)//2, :]
+
+        # max over all to ensure all channels use the same scaling
+        coefficients, coeff_frac_bits = quantize_coefficients(coefficients,
+            np.absolute(coefficients).max(), coeff_bits)
+        if coeff_frac_bits >= 64:
+            raise ValueError("coefficients are too small")
+
+        if (params >> 26) & 1: # sparse, so only some pairs are used
+            used = self._read_pair_mask(coefficients.shape[1:])
+            if np.any(coefficients[:, ~used] != 0):
+                raise ValueError("coefficients must be zero at the (tap, mic) "
+                    "pairs the convolver was built without")
+
+        # the convolver only switches banks at the start of a set, and gets no
+        # sets while raw data is being stored, so don't wait for it then. it's
+        # idle, so overwriting the bank in use if a switch is still pending
+        # does no harm, and the switch happens once it gets sets again
+        idle = self._store_raw_data
+
+        # wait for any previous switch to complete, then load the other bank
+        ctrl = self.r[REG_CONV+1]
+        while not idle and (ctrl & 1) != ((ctrl >> 1) & 1):
+            ctrl = self.r[REG_CONV+1]
+        bank = 1 - (ctrl & 1)
+        for ci in range(self.num_chans):
+            values = coefficients[ci].reshape(-1).tolist()
+            self._write_coefficients(ci, bank, values)
+            # writes are lost if the convolver runs too slowly to keep up, so
+            # write the channel again waiting for room if any were
+            if (self.r[REG_CONV+1] >> 18) & 1:
+                self._write_coefficients(ci, bank, values, wait=True)
+        self.r[REG_CONV+2+bank] = coeff_frac_bits
+        self.r[REG_CONV+6+bank] = taps
+
+        # and switch to it
+        self.r[REG_CONV+1] = bank
+        if wait and not idle:
+            while ((self.r[REG_CONV+1] >> 1) & 1) != bank: pass
+
+    def _write_coefficients(self, chan, bank, values, wait=False):
+        # address autoincrements after each coefficient
+        self.r[REG_CONV+4] = (chan << 16) | (bank << 31)
+        for value in values:
+            while wait and (self.r[REG_CONV+1] >> 19) & 1: pass
+            self.r[REG_CONV+5] = value
+
+    def _read_pair_mask(self, shape):
+        # read which (tap, mic) pairs a sparse convolver uses, shaped (tap, mic)
+        num_pairs = shape[0]*shape[1]
+        used = np.zeros(num_pairs, dtype=bool)
+        for wi in range((num_pairs+31)//32):
+            self.r[REG_CONV+8] = wi
+            word = self.r[REG_CONV+9]
+            for n in range(min(32, num_pairs - 32*wi)):
+                used[32*wi+n] = (word >> n) & 1
+
+        return used.reshape(shape)
+
     def close(self):
         if self._closed:
             raise ValueError
 
         self.d = None
+        self.main = None
+        self.raw = None
+        self._streams = None
         self.r = None
 
         self._buf_mmap.close()
@@ -0,0 +1,297 @@
+import json
+import socket
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+from . import codec
+
+# framed stream protocol the server speaks to clients which ask for it with
+# "framed" in their request line. the server first sends a handshake: MAGIC,
+# then the JSON stream description's length as a u32, then the description. it
+# then sends each buffer as a frame: a FRAME_HEADER followed by the samples,
+# one row per set. if the description names a codec, the samples are instead
+# encoded by it, and preceded by the encoded length as a u32. everything is
+# little endian. recordings are saved in the same format
+#
+# the server can also send the stream as UDP packets. each packet holds either
+# the handshake, which is repeated every so often so receivers can join at any
+# time, or a PACKET_HEADER followed by as many sets as fit in the MTU
+
+MAGIC = b"PAPA"
+VERSION = 1
+HANDSHAKE_HEADER = struct.Struct("<4sI") # MAGIC, description length
+
+FRAME_MAGIC = b"PAFR" # so a confused reader notices
+# FRAME_MAGIC, number of sets in the frame, index of its first set, host time
+# (seconds since the epoch) its last set was read from the hardware, sets lost
+# just before the frame, and the overflow flags raised since the last frame
+# (bit N for drop_points[N])
+FRAME_HEADER = struct.Struct("<4sIQdII")
+
+PACKET_MAGIC = b"PAPK"
+# PACKET_MAGIC, sequence number (wrapping), number of sets in the packet, then
+# the rest as in FRAME_HEADER
+PACKET_HEADER = struct.Struct("<4sIIQdII")
+# IPv4 and UDP headers, which come out of the MTU too
+UDP_OVERHEAD = 28
+
+ENCODED_LENGTH = struct.Struct("<I")
+
+# a frame of data: an array of sample sets (one row per set) and the rest of
+# the header as above. the sample index counts sets at the stream's rate since
+# the server started, lost ones included, so it never goes backwards and any
+# gap before a frame is its dropped count
+Frame = namedtuple("Frame",
+    ["index", "timestamp", "dropped", "overflowed", "data"])
+
+def pack_handshake(rate, channels, raw, drop_points, dtype=np.int16,
+        compress=False):
+    # describe the stream: its sample rate in Hz, the mics (if raw) or
+    # channels in each set, the sample dtype, the names of the points where
+    # sets can be dropped (for the overflow flags), and the codec the frames
+    # are compressed with, if any
+    description = json.dumps({
+        "version": VERSION,
+        "rate": rate,
+        "channels": list(channels),
+        "dtype": np.dtype(dtype).str,
+        "mode": "raw" if raw else "convolved",
+        "drop_points": list(drop_points),
+        "codec": codec.CODEC if compress else None,
+    }).encode("utf-8")
+
+    return HANDSHAKE_HEADER.pack(MAGIC, len(description)) + description
+
+def pack_frame_header(frame, drop_points):
+    overflowed = sum(1 << pi for pi, point in enumerate(drop_points)
+        if point in frame.overflowed)
+
+    return FRAME_HEADER.pack(FRAME_MAGIC, len(frame.data), frame.index,
+        frame.timestamp, frame.dropped, overflowed)
+
+def pack_frame_data(frame, compress=False):
+    # return a list of buffers holding the frame's samples, encoded if asked
+    if not compress:
+        return [memoryview(frame.data).cast("B")]
+
+    encoded = codec.encode(frame.data)
+    return [ENCODED_LENGTH.pack(len(encoded)), encoded]
+
+class FrameReader:
+    # read a framed stream from a socket which has already sent its request
+    # line, or from a recording opened in binary mode. the stream's
+    # description is available as attributes once constructed
+
+    def __init__(self, sock):
+        self._recv_into = getattr(sock, "recv_into", None) or sock.readinto
+
+        magic, length = HANDSHAKE_HEADER.unpack(
+            self._recv_exactly(HANDSHAKE_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("not a framed stream")
+        description = json.loads(self._recv_exactly(length))
+        if description["version"] != VERSION:
+            raise ValueError(f"unsupported version {description['version']}")
+
+        self.description = description
+        self.rate = description["rate"]
+        self.channels = tuple(description["channels"])
+        self.dtype = np.dtype(description["dtype"])
+        self.raw = description["mode"] == "raw"
+        self.drop_points = tuple(description["drop_points"])
+        self.codec = description.get("codec")
+        if self.codec not in (None, codec.CODEC):
+            raise ValueError(f"unsupported codec {self.codec}")
+
+        self._next_index = None
+
+    def _recv_exactly(self, length):
+        data = bytearray(length)
+        view = memoryview(data)
+        while len(view) > 0:
+            received = self._recv_into(view)
+            if received == 0:
+                raise EOFError("connection closed")
+            view = view[received:]
+
+        return data
+
+    def read_frame(self):
+        # read the next frame. raises EOFError once the server has closed the
+        # connection
+        magic, num_sets, index, timestamp, dropped, overflowed = \
+            FRAME_HEADER.unpack(self._recv_exactly(FRAME_HEADER.size))
+        if magic != FRAME_MAGIC:
+            raise ValueError("lost frame sync")
+
+        if self.codec is not None:
+            length, = ENCODED_LENGTH.unpack(
+                self._recv_exactly(ENCODED_LENGTH.size))
+            data = codec.decode(self._recv_exactly(length))
+            if data.shape != (num_sets, len(self.channels)):
+                raise ValueError("decoded frame is the wrong shape")
+        else:
+            num_samples = num_sets * len(self.channels)
+            data = np.frombuffer(
+                self._recv_exactly(num_samples * self.dtype.itemsize),
+                dtype=self.dtype).reshape(num_sets, len(self.channels))
+
+        # the server guarantees this, but make sure the gaps add up
+        if self._next_index is not None and \
+                index != self._next_index + dropped:
+            raise ValueError("sample index doesn't match dropped count")
+        self._next_index = index + num_sets
+
+        overflowed = frozenset(point
+            for pi, point in enumerate(self.drop_points)
+            if overflowed & (1 << pi))
+        return Frame(index, timestamp, dropped, overflowed, data)
+
+    def __iter__(self):
+        try:
+            while True:
+                yield self.read_frame()
+        except EOFError:
+            pass
+
+def packetize(frame, channels, seq, mtu, drop_points):
+    # split a frame into UDP packets which fit in the MTU, starting with
+    # sequence number seq. yields (header, data) for each
+    set_bytes = max(1, channels) * frame.data.itemsize
+    sets_per_packet = max(1, (mtu - UDP_OVERHEAD - PACKET_HEADER.size)
+        // set_bytes)
+    overflowed = sum(1 << pi for pi, point in enumerate(drop_points)
+        if point in frame.overflowed)
+
+    dropped = frame.dropped
+    for start in range(0, len(frame.data), sets_per_packet):
+        data = frame.data[start:start+sets_per_packet]
+        yield PACKET_HEADER.pack(PACKET_MAGIC, seq & 0xFFFF_FFFF, len(data),
+            frame.index + start, frame.timestamp, dropped, overflowed), data
+        # the loss and flags only go with the first packet
+        dropped, overflowed = 0, 0
+        seq += 1
+
+def open_udp(port, group=None):
+    # open a socket to receive the UDP stream sent to the given port, joining
+    # the multicast group if it was sent to one
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("", port))
+    if group is not None:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+            struct.pack("=4s4s", socket.inet_aton(group),
+                socket.inet_aton("0.0.0.0")))
+
+    return sock
+
+class PacketReader:
+    # read a UDP packet stream from a socket, e.g. from open_udp. packets
+    # which arrive out of order are put back in order, waiting for up to
+    # `window` later packets to arrive before giving up on a missing one.
+    # frames are returned one per packet, with what was lost before each in
+    # its dropped count, whether the hardware dropped it or the network did.
+    # the stream's description is available as attributes once the first
+    # frame is returned. if the sender restarts, the reader starts over with
+    # the new stream
+
+    def __init__(self, sock, window=32):
+        self._sock = sock
+        self._window = window
+
+        self.description = None
+        self._pending = {} # packets received ahead of the next one we want
+        self._next_seq = None
+        self._next_index = None
+        self._last_timestamp = float("-inf") # of the last frame returned
+
+        # how many packets were lost by the network, and how many arrived too
+        # late to be put back in order
+        self.lost_packets = 0
+        self.late_packets = 0
+
+    def _describe(self, packet):
+        magic, length = HANDSHAKE_HEADER.unpack_from(packet)
+        description = json.loads(packet[HANDSHAKE_HEADER.size:][:length])
+        if description["version"] != VERSION:
+            raise ValueError(f"unsupported version {description['version']}")
+
+        if self.description is not None and description != self.description:
+            # the sender restarted with different settings, so the packets
+            # we have won't fit them
+            self._restart(None)
+        self.description = description
+        self.rate = description["rate"]
+        self.channels = tuple(description["channels"])
+        self.dtype = np.dtype(description["dtype"])
+        self.raw = description["mode"] == "raw"
+        self.drop_points = tuple(description["drop_points"])
+
+    def _receive(self):
+        # receive the next data packet, handling any descriptions on the way
+        while True:
+            packet = self._sock.recv(65536)
+            if packet[:4] == MAGIC:
+                self._describe(packet)
+            elif packet[:4] == PACKET_MAGIC and self.description is not None:
+                return packet
+
+    def _restart(self, seq):
+        # start over with the stream from the given sequence number
+        self._pending.clear()
+        self._next_seq = seq
+        self._next_index = None
+
+    def _take(self, seq):
+        # turn the packet with the given sequence number into a frame
+        packet = self._pending.pop(seq)
+        _, _, num_sets, index, timestamp, dropped, overflowed = \
+            PACKET_HEADER.unpack_from(packet)
+        data = np.frombuffer(packet, dtype=self.dtype,
+            offset=PACKET_HEADER.size).reshape(num_sets, len(self.channels))
+
+        # count what the network lost too
+        if self._next_index is not None and index >= self._next_index:
+            dropped = index - self._next_index
+        self._next_index = index + num_sets
+        self._next_seq = (seq + 1) & 0xFFFF_FFFF
+        self._last_timestamp = timestamp
+
+        overflowed = frozenset(point
+            for pi, point in enumerate(self.drop_points)
+            if overflowed & (1 << pi))
+        return Frame(index, timestamp, dropped, overflowed, data)
+
+    def read_frame(self):
+        while True:
+            if self._next_seq in self._pending:
+                return self._take(self._next_seq)
+
+            if len(self._pending) > self._window:
+                # give up on the missing packets and move to the next we have
+                ahead = min(self._pending,
+                    key=lambda seq: (seq - self._next_seq) & 0xFFFF_FFFF)
+                self.lost_packets += (ahead - self._next_seq) & 0xFFFF_FFFF
+                return self._take(ahead)
+
+            packet = self._receive()
+            _, seq, _, _, timestamp, _, _ = PACKET_HEADER.unpack_from(packet)
+            if self._next_seq is None:
+                self._next_seq = seq
+            # sequence numbers more than half the space behind are ahead
+            if ((seq - self._next_seq) & 0xFFFF_FFFF) < 1 << 31:
+                self._pending[seq] = packet
+            elif timestamp > self._last_timestamp:
+                # behind, but captured after what we already returned, so the
+                # sender restarted its sequence. the old stream's missing
+                # packets won't be worth waiting for
+                self._restart(seq)
+                self._pending[seq] = packet
+            else:
+                self.late_packets += 1
+
+    def __iter__(self):
+        while True:
+            yield self.read_frame()
@@ -1,11 +1,23 @@
 import sys
 import time
+import errno
 import socket
+import asyncio
 import argparse
+import collections
 
 import numpy as np
 
-from .hw import HW
+from .hw import HW, DROP_POINTS
+from .protocol import (Frame, pack_handshake, pack_frame_header,
+    pack_frame_data, packetize)
+
+# how long a client has after connecting to send a request line before it gets
+# the default channels and limit
+REQUEST_TIMEOUT = 0.25
+
+# how often the UDP stream's description is repeated, in seconds
+DESCRIPTION_INTERVAL = 1.0
 
 # https://stackoverflow.com/a/28950776
 def get_ip():
@@ -21,34 +33,357 @@ def get_ip():
         s.close()
     return IP
 
-def capture(hw, sock, channels, limit_samples):
-    # swap buffers at the beginning since the current one probably overflowed
-    hw.swap_buffers()
+def parse_request(line, channels, rate):
+    # parse a client's request line, e.g. "select=0,3,5 limit=10", into the
+    # columns of the served channels it wants (or None for all of them), its
+    # limit in samples (or None for the server's), whether it wants the
+    # framed protocol, and whether it wants the frames compressed.
+    # "channels=N" asks for the first N instead, "framed" asks for the
+    # protocol, and "compress" asks for it with compression
+    columns = None
+    limit_samples = None
+    framed = False
+    compress = False
+    for item in line.split():
+        key, _, value = item.partition("=")
+        if key == "framed":
+            framed = True
+        elif key == "compress":
+            framed, compress = True, True
+        elif key == "select":
+            wanted = [int(c) for c in value.split(",")]
+            if not all(c in channels for c in wanted):
+                raise ValueError("can only select from served channels " +
+                    ",".join(str(c) for c in channels))
+            columns = [channels.index(c) for c in wanted]
+        elif key == "channels":
+            num = int(value)
+            if num < 1 or num > len(channels):
+                raise ValueError(f"must be 1 <= channels <= {len(channels)}")
+            columns = list(range(num))
+        elif key == "limit":
+            limit_samples = int(rate * float(value))
+        else:
+            raise ValueError(f"unknown request {key!r}")
+
+    if columns == list(range(len(channels))):
+        columns = None # saves gathering them
+    return columns, limit_samples, framed, compress
+
+class Client:
+    # a connected client, the columns of the served data it wants, and a
+    # bounded queue of frames waiting to be sent to it. if it falls behind,
+    # the oldest frames are dropped so it can't hold up capture
+
+    def __init__(self, sock, address, columns, limit_samples, queue_len):
+        self.sock = sock
+        self.address = address
+        self.columns = columns # None if it wants all of them
+        self.limit_samples = limit_samples # <= 0 for unlimited
+        self.queue = collections.deque(maxlen=queue_len)
+        self.ready = asyncio.Event()
+        self.done = False
+
+        # what was lost along with frames dropped from the queue or that were
+        # empty, which is added to the next frame we send
+        self._dropped = 0
+        self._overflowed = set()
+
+        # what's left of the buffer being sent, while the socket is full
+        self._sending = None
+
+    def put(self, frame):
+        if self.done: return
+        if len(frame.data) == 0:
+            # nothing to send, but what was lost still goes to the next frame
+            self._dropped += frame.dropped
+            self._overflowed.update(frame.overflowed)
+            return
+
+        data = frame.data
+        if self.columns is not None:
+            # gather a copy, in the order we send it
+            data = np.ascontiguousarray(data[:, self.columns])
+        if self.limit_samples > 0:
+            data = data[:self.limit_samples]
+            self.limit_samples -= len(data)
+            if self.limit_samples == 0:
+                self.done = True
+
+        if len(self.queue) == self.queue.maxlen:
+            print(f"client {self.address} is behind, dropped buffer")
+            dropped = self.queue.popleft()
+            self._dropped += dropped.dropped + len(dropped.data)
+            self._overflowed.update(dropped.overflowed)
+        self.queue.append(frame._replace(data=data))
+        self.ready.set()
+
+    def get(self):
+        # take the next frame to send, accounting for any dropped before it
+        frame = self.queue.popleft()
+        frame = frame._replace(dropped=frame.dropped + self._dropped,
+            overflowed=frame.overflowed | self._overflowed)
+        self._dropped = 0
+        self._overflowed = set()
+
+        return frame
+
+    async def send(self, buffer):
+        # send all of the buffer. while the socket is full, the rest is kept
+        # where release() can find it
+        loop = asyncio.get_running_loop()
+        self._sending = memoryview(buffer).cast("B")
+        try:
+            while len(self._sending) > 0:
+                try:
+                    sent = self.sock.send(self._sending)
+                except BlockingIOError:
+                    sent = 0
+                self._sending = self._sending[sent:]
+                if len(self._sending) > 0:
+                    writable = loop.create_future()
+                    loop.add_writer(self.sock, writable.set_result, None)
+                    try:
+                        await writable
+                    finally:
+                        loop.remove_writer(self.sock)
+        finally:
+            self._sending = None
+
+    def release(self, data):
+        # the hardware is about to reuse the memory holding data, so copy out
+        # whatever of it is still waiting to be sent. most of the time nothing
+        # is, so it's sent straight from the DMA buffer
+        for qi, frame in enumerate(self.queue):
+            if np.may_share_memory(frame.data, data):
+                self.queue[qi] = frame._replace(data=frame.data.copy())
+        if self._sending is not None and \
+                np.may_share_memory(self._sending, data):
+            self._sending = memoryview(bytes(self._sending))
+
+class UDPSender:
+    # sends every frame as UDP packets to one address, which may be a
+    # multicast group, so the cost stays the same however many hosts receive
+    # it. sent straight away, so there's no queue to fall behind in; if the
+    # socket can't keep up the packets are dropped and the receivers notice.
+    # on any other error it's done and stops sending
+
+    def __init__(self, address, description, *, mtu=1500, ttl=1):
+        self._address = address
+        self._description = description
+        self._mtu = mtu
+        self._channels = None
+        self._seq = 0
+        self._last_description = None
+        self.done = False
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self._sock.setblocking(False)
+
+    def put(self, frame):
+        if self.done or len(frame.data) == 0: return
+
+        # repeat the description every so often so receivers can join
+        now = time.monotonic()
+        if self._last_description is None or \
+                now - self._last_description >= DESCRIPTION_INTERVAL:
+            self._send([self._description])
+            self._last_description = now
 
-    print("capture is starting!")
-    unlimited = limit_samples <= 0
-    while unlimited or limit_samples > 0:
+        for header, data in packetize(frame, frame.data.shape[1], self._seq,
+                self._mtu, DROP_POINTS):
+            self._send([header, memoryview(data).cast("B")])
+            self._seq += 1
+
+    def _send(self, buffers):
+        if self.done: return
         try:
-            data = hw.get_data()
-        except ValueError:
-            print("oops, probably overflowed")
-            continue
+            self._sock.sendmsg(buffers, (), 0, self._address)
+        except (BlockingIOError, InterruptedError, ConnectionRefusedError):
+            pass # lost, like any other packet
+        except OSError as e:
+            if e.errno == errno.ENOBUFS:
+                return # the interface queue is full, so lost too
+            print(f"can't send to UDP address {self._address}: {e}")
+            self.done = True
+
+    def release(self, data):
+        pass # everything was sent straight away
+
+    def close(self):
+        self._sock.close()
 
-        print(f"got {len(data)} samples")
+class Server:
+    # reads each buffer from the hardware once and hands it out to every
+    # connected client
 
-        if limit_samples > 0:
-            data = data[:limit_samples]
-            limit_samples -= len(data)
+    def __init__(self, hw, channels, limit_samples, *, raw=False,
+            interval=0.1, queue_len=8, sndbuf=None, udp=None, mtu=1500,
+            ttl=1):
+        self._hw = hw
+        self._channels = list(channels) # served channels, in the data's order
+        self._raw = raw
+        self._limit_samples = limit_samples
+        self._interval = interval
+        self._queue_len = queue_len
+        self._sndbuf = sndbuf
 
-        data_bytes = data[:, :channels].reshape(-1).view(np.uint8)
-        while len(data_bytes) > 0: # while we have data to transmit
-            sent = sock.send(data_bytes[:4096]) # send a reasonable amount
-            if sent == 0: return # connection probably broken
-            data_bytes = data_bytes[sent:] # discard bytes we sent
+        self._clients = set()
+        self._have_clients = asyncio.Event()
+        self._index = 0 # index of the next set we'll read
 
-        time.sleep(0.1)
+        # the UDP stream is always sent, so capture never stops
+        self._udp_sender = None
+        if udp is not None:
+            self._udp_sender = UDPSender(udp, pack_handshake(hw.get_rate(),
+                self._channels, raw, DROP_POINTS), mtu=mtu, ttl=ttl)
+            self._clients.add(self._udp_sender)
 
-    print("desired number of samples sent")
+    async def serve(self, port):
+        loop = asyncio.get_running_loop()
+
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind(("0.0.0.0", port))
+        server_socket.listen()
+        server_socket.setblocking(False)
+
+        capture_task = asyncio.create_task(self._capture())
+        try:
+            while True:
+                client_socket, address = await loop.sock_accept(server_socket)
+                asyncio.create_task(self._handle(client_socket, address))
+        finally:
+            capture_task.cancel()
+            server_socket.close()
+            if self._udp_sender is not None:
+                self._udp_sender.close()
+
+    async def _read_request(self, sock):
+        # read the client's request line, if it sends one in time
+        loop = asyncio.get_running_loop()
+        line = bytearray()
+        async def read_line():
+            while not line.endswith(b"\n"):
+                more = await loop.sock_recv(sock, 256)
+                if len(more) == 0: break
+                line.extend(more)
+        try:
+            await asyncio.wait_for(read_line(), REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+        return line.decode("ascii", errors="replace")
+
+    async def _handle(self, sock, address):
+        loop = asyncio.get_running_loop()
+        print(f"client {address} connected")
+        sock.setblocking(False)
+        if self._sndbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self._sndbuf)
+
+        client = None
+        try:
+            try:
+                columns, limit_samples, framed, compress = parse_request(
+                    await self._read_request(sock),
+                    self._channels, self._hw.get_rate())
+            except ValueError as e:
+                await loop.sock_sendall(sock, f"error: {e}\n".encode("ascii"))
+                return
+            if limit_samples is None:
+                limit_samples = self._limit_samples
+            if framed:
+                channels = self._channels if columns is None else \
+                    [self._channels[c] for c in columns]
+                await loop.sock_sendall(sock, pack_handshake(
+                    self._hw.get_rate(), channels, self._raw, DROP_POINTS,
+                    compress=compress))
+
+            client = Client(sock, address, columns, limit_samples,
+                self._queue_len)
+            self._clients.add(client)
+            self._have_clients.set()
+
+            while not client.done or len(client.queue) > 0:
+                await client.ready.wait()
+                client.ready.clear()
+                while len(client.queue) > 0:
+                    # only frames which actually get sent are compressed
+                    frame = client.get()
+                    if framed:
+                        await client.send(pack_frame_header(frame, DROP_POINTS))
+                    for buffer in pack_frame_data(frame, compress):
+                        await client.send(buffer)
+            print(f"client {address} has its samples")
+        except (ConnectionResetError, ConnectionAbortedError,
+                BrokenPipeError):
+            print(f"client {address} left rudely")
+        finally:
+            if client is not None:
+                self._clients.discard(client)
+            sock.close()
+
+    async def _capture(self):
+        hw = self._hw
+        capturing = False
+        data = None
+        while True:
+            # don't bother reading the hardware while nobody is listening
+            if len(self._clients) == 0:
+                capturing = False
+                self._have_clients.clear()
+                await self._have_clients.wait()
+            if not capturing:
+                capturing = True
+                # swap buffers at the beginning since the current one probably
+                # overflowed
+                hw.swap_buffers()
+                print("capture is starting!")
+                next_time = time.monotonic()
+
+            # let data build up for the rest of the interval so each buffer is
+            # worth the overhead of handing out, unless sending took longer
+            next_time += self._interval
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                next_time -= delay
+                await asyncio.sleep(0) # let the clients send
+
+            # the data we handed out last is overwritten once we get more, so
+            # any clients still holding onto it must copy it first
+            if data is not None:
+                for client in list(self._clients):
+                    client.release(data)
+                data = None
+
+            try:
+                data, dropped, overflowed, rate = hw.get_data()
+            except ValueError:
+                print("oops, probably overflowed")
+                continue
+            timestamp = time.time()
+
+            if any(dropped.values()):
+                print("dropped sets: " + ", ".join(
+                    f"{count} at {point}" for point, count in dropped.items()))
+            lost = hw.count_lost(dropped, rate)
+
+            # the data is a reference into the DMA buffer, which the clients
+            # send straight from until it's released
+            frame = Frame(self._index + lost, timestamp, lost, overflowed,
+                np.ascontiguousarray(data))
+            self._index += lost + len(data)
+            for client in list(self._clients):
+                client.put(frame)
+            if self._udp_sender is not None and self._udp_sender.done:
+                # it hit an error, so stop capturing for it
+                self._clients.discard(self._udp_sender)
+                self._udp_sender.close()
+                self._udp_sender = None
 
 def parse_args():
     parser = argparse.ArgumentParser(prog="server",
@@ -56,61 +391,94 @@ def parse_args():
     parser.add_argument('-c', '--channels', type=int, metavar="N", default=None,
         help="Number of channels to send (from first N mics/channels), "
              "default all available.")
+    parser.add_argument('-s', '--select', type=str, metavar="LIST",
+        default=None, help="Comma separated list of mics/channels to send "
+             "instead, e.g. 0,3,5.")
     parser.add_argument('-g', '--gain', type=int, default=1,
         help="Gain value to multiply microphone data by, default 1.")
+    parser.add_argument('-d', '--divider', type=int, default=1,
+        help="Divide the mic sample rate by this, default 1 (i.e. maximum).")
+    parser.add_argument('--decimate', type=int, metavar="FACTOR", default=1,
+        help="Decimate the convolved output channels by this, default 1.")
     parser.add_argument('-f', '--fake', action="store_true",
         help="Capture from fake microphones instead of real ones.")
     parser.add_argument('-r', '--raw', action="store_true",
         help="Send raw mic data instead of convolved output channels.")
+    parser.add_argument('--ring', action="store_true",
+        help="Stream into a ring buffer instead of swapping buffer halves.")
     parser.add_argument('--port', type=int, default=2048,
         help="TCP port to listen on for connections.")
     parser.add_argument('--limit', type=float, default=0,
         help="Seconds of data to send per connection, default 0 for unlimited.")
+    parser.add_argument('--interval', type=float, default=0.1,
+        help="Seconds between grabbing buffers of data to send, default 0.1.")
+    parser.add_argument('--queue', type=int, metavar="N", default=8,
+        help="Buffers to hold for each client before dropping the oldest, "
+             "default 8.")
+    parser.add_argument('--sndbuf', type=int, metavar="BYTES", default=None,
+        help="Size of the socket send buffer, default the system's.")
+    parser.add_argument('--udp', type=str, metavar="HOST:PORT", default=None,
+        help="Also send all the data as UDP packets to this address, which "
+             "may be a multicast group.")
+    parser.add_argument('--mtu', type=int, default=1500,
+        help="Largest UDP packet to send, including IP headers, default 1500.")
+    parser.add_argument('--ttl', type=int, default=1,
+        help="Multicast TTL of the UDP packets, default 1 (local network).")
 
     return parser.parse_args()
 
-def serve(hw, channels, port, limit_samples):
+def serve(hw, port, channels, limit_samples, **kwargs):
+    # serve the channels the hardware is storing to any number of clients. on
+    # connecting, each may send a line like "select=0,3,5 limit=10" to get a
+    # subset of those channels or a different limit (in seconds). adding
+    # "framed" gets it the framed protocol in protocol.py instead of bare
+    # samples, and "compress" gets it with the frames losslessly compressed by
+    # the codec in codec.py. if given a udp address, all the channels are sent
+    # there too
     host = get_ip()
     print(f"listening at IP {host} port {port}")
 
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(("0.0.0.0", port))
-    server_socket.listen(1)
-
-    try:
-        while True:
-            (client_socket, address) = server_socket.accept()
-            try:
-                capture(hw, client_socket, channels, limit_samples)
-                print("client said goodbye")
-            except (ConnectionResetError, ConnectionAbortedError,
-                    BrokenPipeError):
-                print("client left rudely")
-            finally:
-                client_socket.close()
-    finally:
-        server_socket.close()
+    asyncio.run(Server(hw, channels, limit_samples, **kwargs).serve(port))
 
 def server():
     args = parse_args()
 
+    udp = None
+    if args.udp is not None:
+        host, _, port = args.udp.rpartition(":")
+        udp = (host, int(port))
+
     hw = HW()
+    hw.set_rate_divider(args.divider, wait=False)
     capture_frequency = hw.mic_freq_hz
     print(f"capture frequency is {capture_frequency}Hz")
 
     hw.set_gain(args.gain)
     hw.set_use_fake_mics(args.fake)
-    hw.set_store_raw_data(args.raw)
+    hw.set_ring_mode(args.ring)
 
     channels = args.channels
     max_channels = hw.num_mics if args.raw else hw.num_chans
-    if channels is None:
-        channels = max_channels
-    if channels < 1 or channels > max_channels:
+    if args.select is not None:
+        channels = [int(c) for c in args.select.split(",")]
+    elif channels is None:
+        channels = range(max_channels)
+    elif channels < 1 or channels > max_channels:
         raise ValueError(f"must be 1 <= channels <= {max_channels}")
+    else:
+        channels = range(channels)
+    # only the selected channels are written to memory, the switch to raw data
+    # takes care of discarding whatever was written before
+    hw.set_channels(channels, raw=args.raw, wait=False)
+    hw.set_decimation(args.decimate, wait=False)
+    hw.set_store_raw_data(args.raw)
 
     try:
-        serve(hw, channels, args.port, int(capture_frequency * args.limit))
+        serve(hw, args.port, hw.get_channels(),
+            int(hw.get_rate() * args.limit), raw=args.raw,
+            interval=args.interval,
+            queue_len=args.queue, sndbuf=args.sndbuf, udp=udp, mtu=args.mtu,
+            ttl=args.ttl)
     except KeyboardInterrupt:
         print("bye")
 
@@ -5,24 +5,62 @@ import argparse
 
 import numpy as np
 
-from .hw import HW
+from .hw import HW, DROP_POINTS
+from .protocol import (Frame, pack_handshake, pack_frame_header,
+    pack_frame_data)
 
-def capture(hw, wav, channels):
+def capture(hw, write):
     # swap buffers at the beginning since the current one probably overflowed
     hw.swap_buffers()
 
     print("capture is starting!")
+    index = 0
     while True:
         try:
-            data = hw.get_data()
+            data, dropped, overflowed, rate = hw.get_data()
         except ValueError:
             print("oops, probably overflowed")
             continue
+        timestamp = time.time()
 
         print(f"got {len(data)} samples")
-        wav.writeframesraw(np.ascontiguousarray(data[:, :channels]))
+        if any(dropped.values()):
+            print("dropped sets: " + ", ".join(
+                f"{count} at {point}" for point, count in dropped.items()))
+        lost = hw.count_lost(dropped, rate)
+        write(Frame(index + lost, timestamp, lost, overflowed,
+            np.ascontiguousarray(data)))
+        index += lost + len(data)
         time.sleep(0.1)
 
+def write_wav(wav):
+    def write(frame):
+        wav.writeframesraw(frame.data)
+
+    return write
+
+def write_compressed(f):
+    # save in the framed protocol with the frames compressed, which codec.py
+    # can decode back to a .wav file
+    # what was lost with empty frames, which aren't saved, goes with the next
+    lost = 0
+    overflowed = frozenset()
+    def write(frame):
+        nonlocal lost, overflowed
+        if len(frame.data) == 0:
+            lost += frame.dropped
+            overflowed |= frame.overflowed
+            return
+        frame = frame._replace(dropped=frame.dropped + lost,
+            overflowed=frame.overflowed | overflowed)
+        lost, overflowed = 0, frozenset()
+
+        f.write(pack_frame_header(frame, DROP_POINTS))
+        for buffer in pack_frame_data(frame, compress=True):
+            f.write(buffer)
+
+    return write
+
 def parse_args():
     parser = argparse.ArgumentParser(prog="wavdump",
         description="Dump WAV data from mic capture interface.")
@@ -31,12 +69,24 @@ def parse_args():
     parser.add_argument('-c', '--channels', type=int, metavar="N", default=None,
         help="Number of channels to capture (from first N mics/channels), "
              "default all available.")
+    parser.add_argument('-s', '--select', type=str, metavar="LIST",
+        default=None, help="Comma separated list of mics/channels to capture "
+             "instead, e.g. 0,3,5.")
     parser.add_argument('-g', '--gain', type=int, default=1,
         help="Gain value to multiply microphone data by, default 1.")
+    parser.add_argument('-d', '--divider', type=int, default=1,
+        help="Divide the mic sample rate by this, default 1 (i.e. maximum).")
+    parser.add_argument('--decimate', type=int, metavar="FACTOR", default=1,
+        help="Decimate the convolved output channels by this, default 1.")
     parser.add_argument('-f', '--fake', action="store_true",
         help="Capture from fake microphones instead of real ones.")
     parser.add_argument('-r', '--raw', action="store_true",
         help="Store raw mic data instead of convolved output channels.")
+    parser.add_argument('--ring', action="store_true",
+        help="Stream into a ring buffer instead of swapping buffer halves.")
+    parser.add_argument('--compress', action="store_true",
+        help="Save losslessly compressed data instead of a .wav file, which "
+             "the codec tool can decode.")
 
     return parser.parse_args()
 
@@ -44,30 +94,48 @@ def wavdump():
     args = parse_args()
 
     hw = HW()
+    hw.set_rate_divider(args.divider, wait=False)
     print(f"capture frequency is {hw.mic_freq_hz}Hz")
 
     hw.set_gain(args.gain)
     hw.set_use_fake_mics(args.fake)
-    hw.set_store_raw_data(args.raw)
+    hw.set_ring_mode(args.ring)
 
     channels = args.channels
     max_channels = hw.num_mics if args.raw else hw.num_chans
-    if channels is None:
-        channels = max_channels
-    if channels < 1 or channels > max_channels:
+    if args.select is not None:
+        channels = [int(c) for c in args.select.split(",")]
+    elif channels is None:
+        channels = range(max_channels)
+    elif channels < 1 or channels > max_channels:
         raise ValueError(f"must be 1 <= channels <= {max_channels}")
+    else:
+        channels = range(channels)
+    # only the selected channels are written to memory, the switch to raw data
+    # takes care of discarding whatever was written before
+    hw.set_channels(channels, raw=args.raw, wait=False)
+    hw.set_decimation(args.decimate, wait=False)
+    hw.set_store_raw_data(args.raw)
+    channels = hw.get_channels()
 
-    wav = wave.open(args.filename, "wb")
-    wav.setnchannels(channels)
-    wav.setsampwidth(2)
-    wav.setframerate(hw.mic_freq_hz)
+    if args.compress:
+        out = open(args.filename, "wb")
+        out.write(pack_handshake(hw.get_rate(), channels, args.raw,
+            DROP_POINTS, compress=True))
+        write = write_compressed(out)
+    else:
+        out = wave.open(args.filename, "wb")
+        out.setnchannels(len(channels))
+        out.setsampwidth(2)
+        out.setframerate(hw.get_rate())
+        write = write_wav(out)
 
     try:
-        capture(hw, wav, channels)
+        capture(hw, write)
     except KeyboardInterrupt:
         print("bye")
     finally:
-        wav.close()
+        out.close()
 
 if __name__ == "__main__":
     wavdump()